@@ -0,0 +1,703 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import fnmatch
+import io
+import json
+import re
+import threading
+import types
+from collections import Counter, OrderedDict
+
+from sim import EPOCH
+
+# Constants
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+# Simulated service latency per call, in seconds
+DEFAULT_LATENCY = {
+    'default': 0.05,
+    'ssm:StartAutomationExecution': 0.3,
+    'ssm:SendCommand': 0.15,
+    'ssm:PutParameter': 0.08,
+    'ec2:CreateVolume': 0.5,
+    'ec2:DescribeSnapshots': 0.2,
+    'stepfunctions:StartExecution': 0.1,
+    'sqs:SendMessage': 0.02
+}
+# Service-side rate limits as (calls per second, burst), looked up by
+# operation and then by API family (service plus leading verb).  These
+# approximate the default account quotas; anything not listed is unlimited.
+DEFAULT_LIMITS = {
+    'ssm:Get': (40, 40),
+    'ssm:PutParameter': (3, 5),
+    'ssm:SendCommand': (5, 10),
+    'ssm:List': (20, 40),
+    'ssm:StartAutomationExecution': (5, 10),
+    'ssm:GetCommandInvocation': (20, 40),
+    'ec2:Describe': (100, 100),
+    'ec2:CreateVolume': (5, 10),
+    'stepfunctions:ListExecutions': (2, 100),
+    'stepfunctions:StartExecution': (150, 800),
+    'autoscaling:CompleteLifecycleAction': (20, 40)
+}
+LIST_OUTPUT_LIMIT = 2500 # characters of plugin output returned by ListCommandInvocations
+GET_OUTPUT_LIMIT = 24000 # characters returned by GetCommandInvocation
+MONGO_PORT = 27017
+MAX_MEMBERS = 50
+MAX_VOTERS = 7
+HYDRATION_CHUNKS = 100 # 1GiB chunks in a restored data volume
+
+"""
+Simulated AWS backend for the benchmark: just enough of SSM (parameters,
+Run Command, Automation), EC2, Auto Scaling, Step Functions and SQS for
+the workflow handlers, plus a model of the nodes and the MongoDB replica
+set that the Run Command scripts act on.
+
+Clients returned by the fake boto3 module honour the retries setting of
+the botocore Config they are given and fire the same before-call,
+needs-retry, after-call and after-call-error events as botocore, so
+workflow/aws_clients.py runs unchanged.
+"""
+
+class ClientError(Exception):
+
+    def __init__(self, error_response, operation_name):
+        self.response = error_response
+        self.operation_name = operation_name
+        Exception.__init__(self, "An error occurred ({0}) when calling the {1} operation: {2}".format(
+            error_response['Error']['Code'], operation_name, error_response['Error'].get('Message', '')))
+
+class _Exceptions(object):
+    """Modeled exception classes, created on first use and shared by all clients."""
+
+    def __init__(self):
+        self._classes = {'ClientError': ClientError}
+
+    def __getattr__(self, code):
+        if code.startswith('_'):
+            raise AttributeError(code)
+        if code not in self._classes:
+            self._classes[code] = type(str(code), (ClientError,), {})
+        return self._classes[code]
+
+EXCEPTIONS = _Exceptions()
+
+def error(code, operation, message=''):
+    return getattr(EXCEPTIONS, code)({'Error': {'Code': code, 'Message': message}}, operation)
+
+def utc(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+def iso_time(sim_now):
+    return utc(EPOCH + sim_now).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def departing_host(text):
+    """The member a termination hook removal script is removing."""
+    return json.loads(re.search(r'var host = ("[^"]+");', text).group(1))
+
+def api_family(key):
+    service, operation = key.split(':', 1)
+    verb = re.match(r'[A-Z][a-z]*', operation)
+    return "{0}:{1}".format(service, verb.group(0) if verb else operation)
+
+class _EventHooks(object):
+    """The subset of botocore's event system that aws_clients.py uses."""
+
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, event_name, handler):
+        self._handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for prefix, handler in self._handlers:
+            if event_name == prefix or event_name.startswith(prefix + '.'):
+                handler(event_name=event_name, **kwargs)
+
+class _OperationModel(object):
+
+    def __init__(self, name):
+        self.name = name
+
+class FakeClient(object):
+
+    def __init__(self, backend, service, config=None):
+        self._backend = backend
+        self._service = service
+        self.meta = types.SimpleNamespace(events=_EventHooks(), service_name=service)
+        self.exceptions = EXCEPTIONS
+        retries = getattr(config, 'retries', None) or {}
+        # Like botocore, max_attempts counts retries; legacy mode retries 4 times
+        self._max_attempts = int(retries.get('max_attempts', 4)) + 1
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        operation = ''.join(part.capitalize() for part in name.split('_'))
+        return lambda **params: self._call(operation, params)
+
+    def _call(self, operation, params):
+        model = _OperationModel(operation)
+        suffix = "{0}.{1}".format(self._service, operation)
+        context = {}
+        # Like botocore, before-call fires once per call and retries happen below it
+        self.meta.events.emit('before-call.' + suffix, model=model, params=params, context=context)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                parsed = self._backend.invoke(self._service, operation, params)
+                failure = None
+            except ClientError as e:
+                parsed = e.response
+                failure = e
+            self.meta.events.emit('needs-retry.' + suffix, response=(None, parsed),
+                operation=model, attempts=attempts, caught_exception=None)
+            if failure is None:
+                parsed.setdefault('ResponseMetadata', {})['RetryAttempts'] = attempts - 1
+                self.meta.events.emit('after-call.' + suffix, model=model, parsed=parsed, http_response=None, context=context)
+                return parsed
+            if failure.response['Error']['Code'] in THROTTLE_CODES and attempts < self._max_attempts:
+                # Full-jitter exponential backoff, as botocore's standard retry mode
+                self._backend.sim.sleep(self._backend.rng.uniform(0, min(20, 2 ** (attempts - 1))))
+                continue
+            self.meta.events.emit('after-call-error.' + suffix, exception=failure, context=context)
+            raise failure
+
+class _Config(object):
+    """Stand-in for botocore.config.Config; the fake clients only read retries."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def boto3_modules(backend_holder):
+    """
+    Build replacement boto3 and botocore.config modules.  backend_holder
+    is read every time a client is created, so a fresh backend can be
+    installed per scenario.
+    """
+    boto3 = types.ModuleType('boto3')
+    boto3.client = lambda service, config=None, **kwargs: FakeClient(backend_holder['backend'], service, config)
+    botocore = types.ModuleType('botocore')
+    config = types.ModuleType('botocore.config')
+    config.Config = _Config
+    botocore.config = config
+    return {'boto3': boto3, 'botocore': botocore, 'botocore.config': config}
+
+class Node(object):
+
+    def __init__(self, instance_id, index, dns, az, launched_at):
+        self.instance_id = instance_id
+        self.index = index
+        self.dns = dns
+        self.az = az
+        self.launched_at = launched_at
+        self.ready_at = None # mongod running
+        self.hydrate_from = None
+        self.hydrate_secs = 0
+
+    def mongod_running(self, now):
+        return self.ready_at is not None and now >= self.ready_at
+
+    def hydration_chunks(self, now):
+        if self.hydrate_from is None or now <= self.hydrate_from:
+            return 0
+        return min(HYDRATION_CHUNKS, int((now - self.hydrate_from) * HYDRATION_CHUNKS / self.hydrate_secs))
+
+    def hydration(self, now):
+        if self.hydrate_from is None:
+            return 100
+        if now <= self.hydrate_from:
+            return 0
+        return min(100, int((now - self.hydrate_from) * 100 / self.hydrate_secs))
+
+class ReplicaSet(object):
+    """Member states as rs.status() would report them, derived from the clock."""
+
+    def __init__(self, name, initial_sync_secs):
+        self.name = name
+        self.initial_sync_secs = initial_sync_secs
+        self.initiated = False
+        self.members = OrderedDict() # host:port -> {'added', 'synced', 'votes', 'priority', 'promoted'}
+        self.removed = OrderedDict() # host:port -> time removed
+
+    def primary(self):
+        return next(iter(self.members)) if self.members else None
+
+    def state(self, host, now):
+        member = self.members[host]
+        if host == self.primary():
+            return 'PRIMARY'
+        return 'SECONDARY' if now >= member['synced'] else 'STARTUP2'
+
+    def voters(self):
+        return sum(m['votes'] for m in self.members.values())
+
+    def too_many_voters(self, voters):
+        return {'ok': 0, 'errmsg': "Replica set configuration contains {0} voting members, but must be at most {1}".format(voters, MAX_VOTERS),
+            'code': 103}
+
+    def initiate(self, members, now):
+        """members is a list of (host, votes, priority)."""
+        if self.initiated:
+            return {'ok': 0, 'errmsg': 'already initialized', 'code': 23}
+        voters = sum(votes for host, votes, priority in members)
+        if voters > MAX_VOTERS:
+            return self.too_many_voters(voters)
+        self.initiated = True
+        for host, votes, priority in members:
+            # A new replica set has no data to copy
+            self.members[host] = {'added': now, 'synced': now, 'votes': votes, 'priority': priority, 'promoted': None}
+        return {'ok': 1}
+
+    def add(self, host, votes, priority, now):
+        if host in self.members:
+            return {'ok': 0, 'errmsg': "Found two member configurations with same host field, members.0.host == members.{0}.host == {1}".format(len(self.members), host)}
+        if len(self.members) >= MAX_MEMBERS:
+            return {'ok': 0, 'errmsg': 'Replica set configuration contains more than {0} members'.format(MAX_MEMBERS)}
+        if self.voters() + votes > MAX_VOTERS:
+            return self.too_many_voters(self.voters() + votes)
+        self.members[host] = {'added': now, 'synced': now + self.initial_sync_secs, 'votes': votes, 'priority': priority,
+            'promoted': None}
+        return {'ok': 1}
+
+    def reconfig(self, targets, now):
+        """Apply {host: {'votes', 'priority'}} in one configuration change."""
+        voters = sum(targets.get(h, m)['votes'] for h, m in self.members.items())
+        if voters > MAX_VOTERS:
+            return self.too_many_voters(voters)
+        for host, target in targets.items():
+            member = self.members[host]
+            if target['votes'] and not member['votes']:
+                member['promoted'] = now
+            member.update(votes=target['votes'], priority=target['priority'])
+        return {'ok': 1}
+
+    def remove(self, host, now):
+        """Step host down if it is primary and drop it in one reconfig; the next member takes over."""
+        stepped_down = host == self.primary()
+        if host not in self.members:
+            return {'ok': 1, 'errmsg': '', 'primary': self.primary() or '', 'state': '', 'stepped_down': False, 'removed': False}
+        state = self.state(host, now)
+        del self.members[host]
+        self.removed[host] = now
+        return {'ok': 1, 'errmsg': '', 'primary': self.primary() or '', 'state': state, 'stepped_down': stepped_down,
+            'removed': True}
+
+    def status(self, now, host=None):
+        if not self.initiated or (host is not None and host not in self.members and host not in self.removed):
+            return {'ok': 0, 'codeName': 'NotYetInitialized', 'members': []}
+        if host is not None and host not in self.members:
+            # A removed member reports REMOVED and cannot see the others
+            return {'ok': 0, 'codeName': 'InvalidReplicaSetConfig', 'members': []}
+        members = []
+        for host, member in self.members.items():
+            state = self.state(host, now)
+            optime = now if state != 'STARTUP2' else member['added']
+            members.append({'host': host, 'state': state, 'health': 1,
+                'optime': int(optime * 1000), 'syncSource': '' if state == 'PRIMARY' else self.primary(),
+                'votes': member['votes'], 'priority': member['priority'], 'hidden': False, 'arbiterOnly': False})
+        return {'ok': 1, 'codeName': '', 'members': members}
+
+    def healthy(self, host, now):
+        return host in self.members and self.state(host, now) in ['PRIMARY', 'SECONDARY']
+
+class FakeAWS(object):
+
+    def __init__(self, sim, rng, settings, latency=None, limits=None):
+        self.sim = sim
+        self.rng = rng
+        self.settings = settings
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.lock = threading.Lock()
+        self._buckets = {}
+        self._ids = Counter()
+
+        self.params = {}
+        self.param_history = {} # (name, version) -> parameter, for name:version selectors
+        self.nodes = OrderedDict() # instance id -> Node
+        self.snapshots = []
+        self.volumes = {}
+        self.fast_restore = set() # (snapshot id, az)
+        self.automations = OrderedDict()
+        self.commands = OrderedDict()
+        self.objects = {} # (bucket, key) -> bytes
+        self.lifecycle_results = {} # token -> (result, time)
+        self.replica_set = ReplicaSet(settings.get('replica_set_name', 'rs'), settings.get('initial_sync_secs', 120))
+
+        # Set by the scenario
+        self.on_automation_done = None
+        self.on_start_execution = None
+        self.on_list_executions = None
+        self.on_send_message = None
+
+    def new_id(self, prefix, width=17):
+        with self.lock:
+            self._ids[prefix] += 1
+            return "{0}-{1:0{2}x}".format(prefix, self._ids[prefix], width)
+
+    # Dispatch, latency and throttling
+
+    def _limit(self, key):
+        for k in [key, api_family(key)]:
+            if k in self.limits:
+                return k, self.limits[k]
+        return None, None
+
+    def _take_token(self, key):
+        bucket_key, limit = self._limit(key)
+        if limit is None:
+            return True
+        rate, burst = limit
+        with self.lock:
+            tokens, updated = self._buckets.get(bucket_key, (float(burst), self.sim.now))
+            tokens = min(float(burst), tokens + (self.sim.now - updated) * rate)
+            if tokens < 1:
+                self._buckets[bucket_key] = (tokens, self.sim.now)
+                return False
+            self._buckets[bucket_key] = (tokens - 1, self.sim.now)
+            return True
+
+    def invoke(self, service, operation, params):
+        key = "{0}:{1}".format(service, operation)
+        with self.lock:
+            self.calls[key] += 1
+        self.sim.sleep(self.latency.get(key, self.latency['default']))
+        if not self._take_token(key):
+            with self.lock:
+                self.throttled[key] += 1
+            raise error('ThrottlingException', operation, 'Rate exceeded')
+        method = getattr(self, "{0}_{1}".format(service, operation), None)
+        if method is None:
+            raise NotImplementedError("Simulated backend does not implement {0}".format(key))
+        params = dict(params)
+        params.pop('DryRun', None)
+        return method(**params)
+
+    # SSM parameters
+
+    def ssm_GetParameter(self, Name, WithDecryption=False):
+        name, _, version = Name.partition(':')
+        if version:
+            if (name, int(version)) not in self.param_history:
+                raise error('ParameterVersionNotFound', 'GetParameter')
+            return {'Parameter': dict(self.param_history[(name, int(version))], Name=name)}
+        if Name not in self.params:
+            raise error('ParameterNotFound', 'GetParameter')
+        return {'Parameter': dict(self.params[Name], Name=Name)}
+
+    def ssm_GetParameters(self, Names, WithDecryption=False):
+        if len(Names) > 10:
+            raise error('ValidationException', 'GetParameters', 'Member must have length less than or equal to 10')
+        found = [dict(self.params[n], Name=n) for n in Names if n in self.params]
+        return {'Parameters': found, 'InvalidParameters': [n for n in Names if n not in self.params]}
+
+    def ssm_GetParametersByPath(self, Path, Recursive=False, NextToken=None, MaxResults=10, WithDecryption=False):
+        names = sorted(n for n in self.params if n.startswith(Path) and (Recursive or '/' not in n[len(Path):]))
+        start = int(NextToken or 0)
+        page = names[start:start + MaxResults]
+        response = {'Parameters': [dict(self.params[n], Name=n) for n in page]}
+        if start + MaxResults < len(names):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def ssm_PutParameter(self, Name, Value, Type='String', Overwrite=False, **kwargs):
+        with self.lock:
+            if Name in self.params and not Overwrite:
+                raise error('ParameterAlreadyExists', 'PutParameter')
+            version = self.params.get(Name, {}).get('Version', 0) + 1
+            self.params[Name] = {'Value': Value, 'Type': Type, 'Version': version}
+            self.param_history[(Name, version)] = self.params[Name]
+        return {'Version': version}
+
+    def ssm_DeleteParameter(self, Name):
+        with self.lock:
+            if Name not in self.params:
+                raise error('ParameterNotFound', 'DeleteParameter')
+            del self.params[Name]
+        return {}
+
+    # SSM Automation
+
+    def ssm_StartAutomationExecution(self, DocumentName, Parameters):
+        execution_id = self.new_id('auto', 8)
+        instance_id = Parameters['InstanceId'][0]
+        node = self.nodes.get(instance_id)
+        automation = self.settings['automations'][DocumentName]
+        seconds = automation['secs'] * (1 + self.rng.uniform(-1, 1) * self.settings['automation_jitter'])
+        steps = []
+        start = self.sim.now
+        weights = automation['steps']
+        total = float(sum(weights.values()))
+        for name, weight in weights.items():
+            steps.append({'StepName': name, 'StepStatus': 'Success', 'start': start, 'end': start + seconds * weight / total})
+            start = steps[-1]['end']
+        execution = {'id': execution_id, 'document': DocumentName, 'parameters': Parameters,
+            'start': self.sim.now, 'end': None, 'status': 'InProgress', 'steps': steps}
+        self.automations[execution_id] = execution
+        if node is not None and Parameters.get('Hydrate', ['false'])[0] == 'true':
+            attach = steps[0]['end'] if steps else self.sim.now
+            node.hydrate_from = attach
+            node.hydrate_secs = self.settings['hydration_secs']
+        self.sim.spawn(self._finish_automation, execution, node, delay=seconds)
+        return {'AutomationExecutionId': execution_id}
+
+    def _finish_automation(self, execution, node):
+        execution['end'] = self.sim.now
+        if node is None:
+            execution['status'] = 'Failed'
+        else:
+            execution['status'] = 'Success'
+            if self.settings['automations'][execution['document']]['ready']:
+                node.ready_at = self.sim.now
+        if self.on_automation_done is not None:
+            self.on_automation_done(execution, node)
+
+    def ssm_GetAutomationExecution(self, AutomationExecutionId):
+        execution = self.automations.get(AutomationExecutionId)
+        if execution is None:
+            raise error('AutomationExecutionNotFoundException', 'GetAutomationExecution')
+        steps = []
+        for step in execution['steps']:
+            if step['start'] > self.sim.now:
+                break
+            done = step['end'] <= self.sim.now
+            steps.append({'StepName': step['StepName'],
+                'StepStatus': step['StepStatus'] if done else 'InProgress',
+                'ExecutionStartTime': utc(self.sim.time() - (self.sim.now - step['start'])),
+                'ExecutionEndTime': utc(self.sim.time() - (self.sim.now - step['end'])) if done else None})
+        result = {'AutomationExecutionId': AutomationExecutionId,
+            'AutomationExecutionStatus': execution['status'],
+            'Parameters': execution['parameters'],
+            'StepExecutions': steps,
+            'ExecutionStartTime': utc(self.sim.time() - (self.sim.now - execution['start']))}
+        if execution['end'] is not None:
+            result['ExecutionEndTime'] = utc(self.sim.time() - (self.sim.now - execution['end']))
+        if execution['status'] == 'Failed':
+            result['FailureMessage'] = 'Instance not found'
+        return {'AutomationExecution': result}
+
+    # SSM Run Command
+
+    def ssm_SendCommand(self, InstanceIds, DocumentName, Parameters, TimeoutSeconds=3600,
+                        OutputS3BucketName=None, OutputS3KeyPrefix='', **kwargs):
+        for iid in InstanceIds:
+            if iid not in self.nodes:
+                raise error('InvalidInstanceId', 'SendCommand')
+        command_id = self.new_id('cmd', 12)
+        text = '\n'.join(Parameters.get('commands', []))
+        invocations = OrderedDict()
+        for iid in InstanceIds:
+            invocations[iid] = {'registered': self.sim.now + self.settings['invocation_register_secs'],
+                'finished': None, 'status': 'InProgress', 'details': 'InProgress', 'stdout': '', 'stderr': ''}
+            self.sim.spawn(self._finish_command, command_id, iid, text, delay=self.command_secs(text))
+        self.commands[command_id] = {'invocations': invocations, 'text': text, 'requested': self.sim.now,
+            'bucket': OutputS3BucketName, 'prefix': OutputS3KeyPrefix}
+        return {'Command': {'CommandId': command_id, 'InstanceIds': InstanceIds, 'Status': 'Pending',
+            'RequestedDateTime': utc(self.sim.time())}}
+
+    def command_secs(self, text):
+        kind = 'mongo' if 'mongo ' in text else 'shell'
+        seconds = self.settings['command_secs'][kind]
+        if 'replSetStepDown' in text and departing_host(text) == self.replica_set.primary():
+            seconds += self.settings['election_secs']
+        return seconds
+
+    def _finish_command(self, command_id, iid, text):
+        invocation = self.commands[command_id]['invocations'][iid]
+        status, stdout, stderr = self.run_script(self.nodes[iid], text)
+        invocation.update(status=status, details=status, stdout=stdout, stderr=stderr, finished=self.sim.now)
+        command = self.commands[command_id]
+        if command['bucket']:
+            # The agent uploads the full output next to the inline copy
+            key = "{0}/{1}/{2}/awsrunShellScript/0.awsrunShellScript/stdout".format(command['prefix'], command_id, iid)
+            self.objects[(command['bucket'], key)] = stdout.encode('utf-8')
+
+    def _invocation(self, command_id, iid, details):
+        command = self.commands[command_id]
+        invocation = command['invocations'][iid]
+        result = {'CommandId': command_id, 'InstanceId': iid, 'Status': invocation['status'],
+            'StatusDetails': invocation['details'], 'RequestedDateTime': utc(EPOCH + command['requested'])}
+        if details:
+            plugin = {'Name': 'aws:runShellScript', 'Status': invocation['status'],
+                'Output': invocation['stdout'][:LIST_OUTPUT_LIMIT],
+                'ResponseStartDateTime': utc(EPOCH + invocation['registered'])}
+            if invocation['finished'] is not None:
+                plugin['ResponseFinishDateTime'] = utc(EPOCH + invocation['finished'])
+            result['CommandPlugins'] = [plugin]
+        return result
+
+    def ssm_GetCommandInvocation(self, CommandId, InstanceId, **kwargs):
+        command = self.commands.get(CommandId)
+        if command is None or InstanceId not in command['invocations'] or \
+                command['invocations'][InstanceId]['registered'] > self.sim.now:
+            raise error('InvocationDoesNotExist', 'GetCommandInvocation')
+        invocation = command['invocations'][InstanceId]
+        result = self._invocation(CommandId, InstanceId, False)
+        del result['RequestedDateTime']
+        # Get reports execution times as ISO strings
+        result['ExecutionStartDateTime'] = iso_time(invocation['registered'])
+        result['ExecutionEndDateTime'] = iso_time(invocation['finished']) if invocation['finished'] is not None else ''
+        result['StandardOutputContent'] = invocation['stdout'][:GET_OUTPUT_LIMIT]
+        result['StandardErrorContent'] = invocation['stderr'][:GET_OUTPUT_LIMIT]
+        return result
+
+    def ssm_ListCommandInvocations(self, CommandId, InstanceId=None, Details=False, NextToken=None, MaxResults=50):
+        command = self.commands.get(CommandId)
+        if command is None:
+            return {'CommandInvocations': []}
+        iids = [iid for iid, inv in command['invocations'].items()
+            if inv['registered'] <= self.sim.now and (InstanceId is None or iid == InstanceId)]
+        start = int(NextToken or 0)
+        response = {'CommandInvocations': [self._invocation(CommandId, iid, Details) for iid in iids[start:start + MaxResults]]}
+        if start + MaxResults < len(iids):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def run_script(self, node, text):
+        """Return (status, stdout, stderr) for the shell commands the handlers send."""
+        now = self.sim.now
+        rs = self.replica_set
+        host = "{0}:{1}".format(node.dns, MONGO_PORT)
+        if 'mongod.pid' in text:
+            stdout = '  PID TTY          TIME CMD\n'
+            if node.mongod_running(now):
+                stdout += ' 4242 ?        00:00:05 mongod\n'
+            if 'HYDRATION ' in text:
+                stdout += 'HYDRATION {0} {1}\n'.format(node.hydration(now), node.hydration_chunks(now))
+            return 'Success', stdout, ''
+        if 'mongo ' in text and not node.mongod_running(now):
+            return 'Failed', '', 'Error: couldn\'t connect to server 127.0.0.1:27017, connection attempt failed'
+        if 'rs.initiate' in text:
+            members = [(h, 0 if nonvoting else 1, 0 if nonvoting else 1)
+                for h, nonvoting in re.findall(r'host : "([^"]+)"(, priority : 0, votes : 0)?', text)]
+            outcome = rs.initiate(members, now)
+            return 'Success', 'MongoDB shell version v4.0.5\n' + json.dumps(outcome, separators=(', ', ' : ')), ''
+        if 'rs.add' in text:
+            hosts = json.loads(re.search(r'var hosts = (\[[^\]]*\])', text).group(1))
+            votes = re.search(r'votes: (\d+)', text)
+            priority = re.search(r'priority: (\d+)', text)
+            lines = []
+            for h in hosts:
+                if rs.primary() != host:
+                    outcome = {'ok': 0, 'errmsg': 'not master'}
+                else:
+                    outcome = rs.add(h, int(votes.group(1)) if votes else 1, int(priority.group(1)) if priority else 1, now)
+                    if outcome['ok'] == 1:
+                        # Give the run a chance to notice the member becoming SECONDARY
+                        self.sim.spawn(lambda: None, delay=rs.initial_sync_secs)
+                lines.append('RSADD ' + json.dumps({'host': h, 'ok': outcome['ok'], 'errmsg': outcome.get('errmsg', '')}))
+            return 'Success', '\n'.join(lines) + '\n', ''
+        if 'replSetStepDown' in text:
+            outcome = rs.remove(departing_host(text), now)
+            return 'Success', 'RSREMOVE ' + json.dumps(outcome) + '\n', ''
+        if 'rs.reconfig' in text:
+            targets = json.loads(re.search(r'var targets = (\{.*?\}\}); ', text).group(1))
+            if rs.primary() != host:
+                outcome = {'ok': 0, 'errmsg': 'not master'}
+            else:
+                outcome = rs.reconfig(targets, now)
+            return 'Success', 'RSRECONFIG ' + json.dumps({'ok': outcome['ok'], 'errmsg': outcome.get('errmsg', ''),
+                'done': list(targets) if outcome['ok'] == 1 else []}) + '\n', ''
+        if 'rs.status' in text:
+            status = rs.status(now, host)
+            lines = ['RSSTATUS ' + json.dumps({'ok': status['ok'], 'codeName': status['codeName'], 'count': len(status['members'])})]
+            lines.extend('RSMEMBER ' + json.dumps(m) for m in status['members'])
+            return 'Success', '\n'.join(lines) + '\n', ''
+        return 'Success', '', ''
+
+    # S3
+
+    def s3_GetObject(self, Bucket, Key, **kwargs):
+        data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise error('NoSuchKey', 'GetObject', 'The specified key does not exist.')
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    # EC2
+
+    def ec2_DescribeInstances(self, InstanceIds):
+        instances = []
+        for iid in InstanceIds:
+            node = self.nodes.get(iid)
+            if node is None:
+                raise error('InvalidInstanceID.NotFound', 'DescribeInstances')
+            instances.append({'InstanceId': iid, 'Placement': {'AvailabilityZone': node.az},
+                'PrivateDnsName': node.dns, 'State': {'Name': 'running'}})
+        return {'Reservations': [{'Instances': instances}]}
+
+    def _snapshot_matches(self, snapshot, flt):
+        name, values = flt['Name'], flt['Values']
+        if name.startswith('tag:'):
+            value = dict((t['Key'], t['Value']) for t in snapshot['Tags']).get(name[4:])
+        else:
+            value = {'snapshot-id': snapshot['SnapshotId'], 'status': snapshot['State']}.get(name)
+        return value is not None and any(fnmatch.fnmatchcase(value, v) for v in values)
+
+    def ec2_DescribeSnapshots(self, Filters=None, SnapshotIds=None, NextToken=None, MaxResults=None, OwnerIds=None):
+        matches = []
+        for snapshot in self.snapshots:
+            if SnapshotIds and snapshot['SnapshotId'] not in SnapshotIds:
+                continue
+            if all(self._snapshot_matches(snapshot, f) for f in (Filters or [])):
+                matches.append(snapshot)
+        if SnapshotIds and len(matches) < len(SnapshotIds):
+            raise error('InvalidSnapshot.NotFound', 'DescribeSnapshots')
+        if MaxResults is None:
+            return {'Snapshots': matches}
+        start = int(NextToken or 0)
+        response = {'Snapshots': matches[start:start + MaxResults]}
+        if start + MaxResults < len(matches):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def ec2_CreateVolume(self, AvailabilityZone, SnapshotId=None, **kwargs):
+        volume_id = self.new_id('vol')
+        self.volumes[volume_id] = dict(kwargs, AvailabilityZone=AvailabilityZone, SnapshotId=SnapshotId)
+        return {'VolumeId': volume_id, 'State': 'creating'}
+
+    def ec2_CreateSnapshot(self, VolumeId, Description='', TagSpecifications=None, **kwargs):
+        tags = []
+        for spec in TagSpecifications or []:
+            tags.extend(spec['Tags'])
+        snapshot = {'SnapshotId': self.new_id('snap'), 'StartTime': utc(self.sim.time()), 'VolumeSize': 100,
+            'VolumeId': VolumeId, 'State': 'pending', 'Tags': tags}
+        self.snapshots.append(snapshot)
+        self.sim.spawn(lambda: snapshot.update(State='completed'), delay=self.settings['snapshot_secs'])
+        return dict(snapshot)
+
+    def ec2_DescribeFastSnapshotRestores(self, Filters):
+        values = dict((f['Name'], f['Values'][0]) for f in Filters)
+        key = (values.get('snapshot-id'), values.get('availability-zone'))
+        if key in self.fast_restore:
+            return {'FastSnapshotRestores': [{'SnapshotId': key[0], 'AvailabilityZone': key[1], 'State': 'enabled'}]}
+        return {'FastSnapshotRestores': []}
+
+    # Auto Scaling
+
+    def autoscaling_CompleteLifecycleAction(self, LifecycleHookName, AutoScalingGroupName, LifecycleActionToken, LifecycleActionResult, **kwargs):
+        with self.lock:
+            if LifecycleActionToken in self.lifecycle_results:
+                raise error('ValidationError', 'CompleteLifecycleAction', 'No active Lifecycle Action found')
+            self.lifecycle_results[LifecycleActionToken] = (LifecycleActionResult, self.sim.now)
+        return {}
+
+    # Step Functions and SQS are provided by the scenario
+
+    def stepfunctions_StartExecution(self, stateMachineArn, name, input):
+        return self.on_start_execution(stateMachineArn, name, input)
+
+    def stepfunctions_ListExecutions(self, stateMachineArn, statusFilter=None, nextToken=None, maxResults=100):
+        executions = self.on_list_executions(stateMachineArn, statusFilter)
+        start = int(nextToken or 0)
+        response = {'executions': executions[start:start + maxResults]}
+        if start + maxResults < len(executions):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def sqs_SendMessage(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0):
+        return self.on_send_message(QueueUrl, MessageBody, MessageAttributes or {}, DelaySeconds)
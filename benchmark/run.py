@@ -0,0 +1,108 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scenario
+
+# Constants
+DEFAULT_NODES = '3,10,50'
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json')
+
+"""
+Offline scale-out benchmark for the lifecycle workflow.
+
+    python benchmark/run.py [--nodes 3,10,50] [--existing 3] [--terminate 1] [--restore] [--warm]
+                            [--set automation_secs=180] [--var workflow_batch_window=5]
+                            [--output benchmark/results.json]
+
+Runs one simulated scale-out per node count and writes the makespan, API
+call and throttle counts, Lambda invocations and Lambda-seconds for each
+to a JSON file.  --terminate also scales in that many existing members
+(the primary first) through the termination hook; with --nodes 0 it runs
+a scale-in on its own.  --warm launches the new instances from ASG warm
+pools.  The committed results.json is the baseline: rerun
+the benchmark after changing polling, batching or retry behaviour and
+review the diff.
+"""
+
+def parse_assignments(values):
+    """Parse NAME=VALUE pairs, decoding VALUE as JSON where possible."""
+    result = {}
+    for item in values or []:
+        name, value = item.split('=', 1)
+        try:
+            result[name] = json.loads(value)
+        except ValueError:
+            result[name] = value
+    return result
+
+def summary_line(result):
+    return "{0:<16} nodes={1:<3} completed={2!s:<5} makespan={3:>7.1f}s api_calls={4:<6} throttled={5:<5} lambda={6:>8.1f}s executions={7}".format(
+        result['scenario'], result['nodes'], result['completed'], result['makespan_secs'],
+        result['api_calls']['total'], result['throttled']['total'], result['lambda']['seconds'],
+        result['sfn']['executions'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated scale-out benchmark for the lifecycle workflow')
+    parser.add_argument('--nodes', default=DEFAULT_NODES, help='comma-separated node counts (default %(default)s)')
+    parser.add_argument('--existing', type=int, default=0, help='replica set members already running')
+    parser.add_argument('--terminate', type=int, default=0, help='existing members to scale in at the same time')
+    parser.add_argument('--restore', action='store_true', help='restore new data volumes from snapshots')
+    parser.add_argument('--fast-restore', action='store_true', help='fast snapshot restore enabled for the latest snapshot')
+    parser.add_argument('--warm', action='store_true', help='launch new instances from ASG warm pools')
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE', help='simulation setting, see scenario.DEFAULT_SETTINGS')
+    parser.add_argument('--var', action='append', metavar='NAME=VALUE', help='Terraform variable override')
+    parser.add_argument('--latency', action='append', metavar='API=SECONDS', help='service latency, e.g. ssm:SendCommand=0.3')
+    parser.add_argument('--limit', action='append', metavar='API=[RATE,BURST]', help='service rate limit, e.g. ssm:Get=[10,10]')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--verbose', action='store_true', help='show handler logs')
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    else:
+        logging.disable(logging.CRITICAL)
+
+    # Terraform variables are strings, so keep the raw text
+    variables = dict(item.split('=', 1) for item in args.var or [])
+    limits = dict((k, tuple(v)) for k, v in parse_assignments(args.limit).items())
+    results = []
+    for count in [int(n) for n in args.nodes.split(',')]:
+        name = "scale-out-{0}".format(count) if count else "scale-in-{0}".format(args.terminate)
+        run = scenario.Scenario(name, count, existing=args.existing, terminate=args.terminate,
+            restore=args.restore, fast_restore=args.fast_restore, warm=args.warm, variables=variables,
+            settings=parse_assignments(args.set), latency=parse_assignments(args.latency),
+            limits=limits, seed=args.seed)
+        result = run.run()
+        results.append(result)
+        print(summary_line(result))
+
+    document = OrderedDict([
+        ('settings', OrderedDict([
+            ('existing', args.existing),
+            ('terminate', args.terminate),
+            ('restore', args.restore),
+            ('fast_restore', args.fast_restore),
+            ('warm', args.warm),
+            ('seed', args.seed),
+            ('overrides', OrderedDict([('set', parse_assignments(args.set)), ('var', variables),
+                ('latency', parse_assignments(args.latency)), ('limit', parse_assignments(args.limit))]))
+        ])),
+        ('scenarios', results)
+    ])
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.write('\n')
+    print("Results written to {0}".format(args.output))
+    return 0 if all(r['completed'] and not r['errors'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,519 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import importlib
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_aws
+import sfn_local
+import terraform
+from sim import Simulation, SimEvent, SimExecutor, EPOCH
+
+# Constants
+PROJECT = 'MongoDB'
+ENVIRONMENT = 'Bench'
+ROLE = 'rsmember'
+REGION = 'us-west-2'
+ACCOUNT = '111111111111'
+AZS = ['us-west-2a', 'us-west-2b', 'us-west-2c']
+QUEUE_URL = "https://sqs.{0}.amazonaws.com/{1}/lifecycle-queue".format(REGION, ACCOUNT)
+SFN_ARN = "arn:aws:states:{0}:{1}:stateMachine:sfn_workflow_rs".format(REGION, ACCOUNT)
+DOCNAME = 'init_rs_server'
+WARM_DOCNAME = 'warm_rs_server'
+RESUME_DOCNAME = 'resume_rs_server'
+DOCUMENT_TEMPLATES = OrderedDict([(DOCNAME, 'ssm_doc_init.tpl'), (WARM_DOCNAME, 'ssm_doc_warm.tpl'),
+    (RESUME_DOCNAME, 'ssm_doc_resume.tpl')])
+WARM_POOL = 'WarmPool'
+BUCKET = 'mongodb-bench-templates'
+# Relative duration of the node bootstrap automation steps
+STEP_WEIGHTS = {
+    'attachResources': 5,
+    'hydrateDataVolume': 1,
+    'updateSSMAgent': 10,
+    'installAgents': 25,
+    'runPlaybook': 55,
+    'notifySqs': 2
+}
+DEFAULT_SETTINGS = {
+    'automation_secs': 240, # node bootstrap automation, launch to ready message
+    'warm_automation_secs': 200, # bootstrap on entering the warm pool, no resources to attach
+    'resume_automation_secs': 40, # instance start, attach and mongod start on leaving the warm pool
+    'automation_jitter': 0.15,
+    'hydration_secs': 900, # full read of a restored data volume
+    'initial_sync_secs': 120, # new member in STARTUP2 before SECONDARY
+    'election_secs': 12, # new primary elected after a step down
+    'snapshot_secs': 300, # EBS snapshot pending before completed
+    'invocation_register_secs': 0.3, # Run Command invocation visible to Get/List
+    'command_secs': {'shell': 1.0, 'mongo': 1.5},
+    'launch_interval': 0.5, # ASG launches one instance every this many seconds
+    'sns_delay': 0.3,
+    'eventbridge_delay': 0.5,
+    'lambda_overhead': 0.02, # warm invoke
+    'sfn_transition': 0.05,
+    'snapshot_history': 100,
+    'max_sim_secs': 7200
+}
+
+"""
+One benchmark run: N instances launched into an Auto Scaling group at
+once, driven end to end through the real handlers in workflow/ on the
+simulated clock and backend.
+
+Launch -> SNS -> lifecycle_fn -> node automation -> SQS ready message and
+EventBridge status event -> complete_lifecycle_fn, and SQS -> workflow_fn
+(batched, reserved concurrency of one) -> local state machine ->
+check/init/add functions -> Run Command on the simulated nodes.
+
+With warm set, new instances come out of ASG warm pools and run the
+resume document instead, and each pool is refilled through the warm
+document.  The run ends when every new instance's lifecycle action is
+complete and every node is a healthy replica set member; that time is the
+makespan.
+Each function runs in a single simulated warm container, so concurrent
+invocations share the module-level caches and client rate budgets.
+"""
+
+class LambdaContext(object):
+
+    def __init__(self, sim, function_name, timeout):
+        self.sim = sim
+        self.function_name = function_name
+        self.aws_request_id = "{0}-{1}".format(function_name, sim.now)
+        self.deadline = sim.now + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - self.sim.now) * 1000)
+
+def utc(sim_now):
+    return datetime.datetime.fromtimestamp(EPOCH + sim_now, tz=datetime.timezone.utc)
+
+class Scenario(object):
+
+    def __init__(self, name, nodes, existing=0, restore=False, fast_restore=False,
+                 variables=None, settings=None, latency=None, limits=None, seed=1, terminate=0, warm=False):
+        self.name = name
+        self.node_count = nodes
+        self.existing = existing
+        self.terminate_count = min(terminate, existing)
+        self.restore = restore
+        self.fast_restore = fast_restore
+        self.warm = warm
+        self.variable_overrides = variables or {}
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.latency = latency
+        self.limits = limits
+        self.seed = seed
+
+        self.lambda_stats = OrderedDict()
+        self.executions = OrderedDict()
+        self.outcomes = Counter()
+        self.transitions = 0
+        self.queue = []
+        self.sqs = Counter()
+        self.metrics = OrderedDict()
+        self.done_at = None
+
+    # Setup
+
+    def prefix(self):
+        return "/{0}/{1}/{2}".format(PROJECT, ENVIRONMENT, ROLE)
+
+    def dns(self, idx):
+        return "ip-10-0-{0}-{1}.{2}.compute.internal".format(idx // 250, idx % 250 + 4, REGION)
+
+    def configure(self):
+        variables = terraform.variable_defaults()
+        variables.update({'ProjectTag': PROJECT, 'Environment': ENVIRONMENT})
+        variables.update(self.variable_overrides)
+        refs = {
+            'aws_ssm_document.init_rs_server.name': DOCNAME,
+            'aws_ssm_document.warm_rs_server.name': WARM_DOCNAME,
+            'aws_ssm_document.resume_rs_server.name': RESUME_DOCNAME,
+            'aws_sqs_queue.workflow_queue.id': QUEUE_URL,
+            'aws_sqs_queue.workflow_queue.arn': "arn:aws:sqs:{0}:{1}:lifecycle-queue".format(REGION, ACCOUNT),
+            'aws_sfn_state_machine.sfn_workflow_rs.id': SFN_ARN,
+            'aws_s3_bucket.templatebucket.id': BUCKET
+        }
+        for name in terraform.resource_names('aws_lambda_function'):
+            refs["aws_lambda_function.{0}.arn".format(name)] = "arn:aws:lambda:{0}:{1}:function:{2}".format(REGION, ACCOUNT, name)
+        self.functions = terraform.lambda_functions(variables, refs)
+        self.definition = terraform.state_machine('sfn_workflow_rs', variables, refs)
+        self.queue_settings = terraform.queue_settings(variables, refs)
+        durations = {DOCNAME: 'automation_secs', WARM_DOCNAME: 'warm_automation_secs',
+            RESUME_DOCNAME: 'resume_automation_secs'}
+        self.settings['automations'] = {}
+        for document, template in DOCUMENT_TEMPLATES.items():
+            steps = terraform.automation_steps(template)
+            self.settings['automations'][document] = {
+                'secs': self.settings[durations[document]],
+                'steps': OrderedDict((s, STEP_WEIGHTS.get(s, 2)) for s in steps),
+                # Only documents that report the node ready leave mongod running
+                'ready': 'notifySqs' in steps
+            }
+        self.variables = variables
+
+    def load_handlers(self):
+        """Import a fresh copy of every handler module against the fake boto3."""
+        for name in list(sys.modules):
+            module = sys.modules[name]
+            if getattr(module, '__file__', None) and os.path.dirname(os.path.abspath(module.__file__)) == terraform.WORKFLOW_DIR:
+                del sys.modules[name]
+        if terraform.WORKFLOW_DIR not in sys.path:
+            sys.path.insert(0, terraform.WORKFLOW_DIR)
+        for function in self.functions.values():
+            os.environ.update(function['environment'])
+        self.handlers = {}
+        for name, function in self.functions.items():
+            module_name, handler_name = function['handler'].rsplit('.', 1)
+            module = importlib.import_module(module_name)
+            for attr, value in list(vars(module).items()):
+                if isinstance(value, ThreadPoolExecutor):
+                    value.shutdown(wait=False)
+                    setattr(module, attr, SimExecutor(self.sim))
+            self.handlers[name] = (getattr(module, handler_name), function['timeout'])
+            # Collect the embedded metric records instead of printing them
+            sys.modules['metrics'].emit = self.collect_metrics
+            self.lambda_stats[name] = {'invocations': 0, 'seconds': 0.0, 'max_secs': 0.0, 'timeouts': 0}
+
+    def collect_metrics(self, document):
+        if 'Api' in document:
+            return
+        for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            value = document[metric['Name']]
+            self.metrics.setdefault(metric['Name'], []).extend(value if isinstance(value, list) else [value])
+
+    def put(self, name, value):
+        self.backend.params[name] = {'Value': value, 'Type': 'String', 'Version': 1}
+
+    def seed_world(self):
+        backend = self.backend
+        total = self.existing + self.node_count
+        for idx in range(total):
+            self.put("{0}/dns/{1}".format(self.prefix(), idx), self.dns(idx))
+            self.put("{0}/eipeni/{1}".format(self.prefix(), idx), "eni-{0:017x}".format(idx + 1))
+            self.put("{0}/logsvol/{1}".format(self.prefix(), idx), "vol-1{0:016x}".format(idx + 1))
+            if idx < self.existing or not self.restore:
+                self.put("{0}/datavol/{1}".format(self.prefix(), idx), "vol-2{0:016x}".format(idx + 1))
+
+        # Hourly snapshots of the existing members' data volumes
+        history = self.settings['snapshot_history']
+        for n in range(history):
+            backend.snapshots.append({
+                'SnapshotId': "snap-{0:017x}".format(n + 1),
+                'StartTime': utc(-3600.0 * (history - n)),
+                'VolumeSize': 100,
+                'State': 'completed',
+                'Tags': [
+                    {'Key': 'Name', 'Value': "datavol-{0}-{1}".format(ROLE, n % 3)},
+                    {'Key': 'Project', 'Value': PROJECT},
+                    {'Key': 'Environment', 'Value': ENVIRONMENT}
+                ]
+            })
+        latest = backend.snapshots[-1]
+        self.put("{0}/latestsnapshot".format(self.prefix()), json.dumps({
+            'SnapshotId': latest['SnapshotId'],
+            'StartTime': EPOCH - 3600.0,
+            'VolumeSize': latest['VolumeSize']}))
+        if self.fast_restore:
+            for az in AZS:
+                backend.fast_restore.add((latest['SnapshotId'], az))
+
+        hosts = []
+        for idx in range(self.existing):
+            node = fake_aws.Node("i-0{0:016x}".format(idx + 1), idx, self.dns(idx), AZS[idx % 3], -3600.0)
+            node.ready_at = -3000.0
+            backend.nodes[node.instance_id] = node
+            self.put("{0}/instanceid/{1}".format(self.prefix(), idx), node.instance_id)
+            votes = 1 if idx < fake_aws.MAX_VOTERS else 0
+            hosts.append(("{0}:{1}".format(node.dns, fake_aws.MONGO_PORT), votes, votes))
+        if hosts:
+            backend.replica_set.initiate(hosts, -3000.0)
+
+        # Scale in from the first member, which is the primary
+        self.terminated = []
+        for idx in range(self.terminate_count):
+            node = backend.nodes["i-0{0:016x}".format(idx + 1)]
+            self.terminated.append(node)
+            self.sim.spawn(self.terminate, node, delay=idx * self.settings['launch_interval'])
+
+        self.new_nodes = []
+        for n in range(self.node_count):
+            idx = self.existing + n
+            node = fake_aws.Node("i-0{0:016x}".format(idx + 1), idx, self.dns(idx), AZS[idx % 3], n * self.settings['launch_interval'])
+            self.new_nodes.append(node)
+            if self.warm:
+                self.sim.spawn(self.launch, node, WARM_POOL, 'AutoScalingGroup', delay=node.launched_at)
+                # The ASG replaces the instance in the member's warm pool
+                spare = fake_aws.Node("i-1{0:016x}".format(idx + 1), idx, self.dns(idx), AZS[idx % 3], node.launched_at)
+                self.sim.spawn(self.launch, spare, 'EC2', WARM_POOL, delay=spare.launched_at + self.settings['launch_interval'])
+            else:
+                self.sim.spawn(self.launch, node, delay=node.launched_at)
+
+    # Simulated services
+
+    def invoke(self, function, event):
+        handler, timeout = self.handlers[function]
+        self.sim.sleep(self.settings['lambda_overhead'])
+        start = self.sim.now
+        try:
+            return handler(event, LambdaContext(self.sim, function, timeout))
+        finally:
+            seconds = self.sim.now - start
+            stats = self.lambda_stats[function]
+            stats['invocations'] += 1
+            stats['seconds'] += seconds
+            stats['max_secs'] = max(stats['max_secs'], seconds)
+            if seconds > timeout:
+                stats['timeouts'] += 1
+
+    def launch(self, node, origin='EC2', destination='AutoScalingGroup'):
+        self.backend.nodes[node.instance_id] = node
+        self.sim.sleep(self.settings['sns_delay'])
+        message = {
+            'LifecycleHookName': 'lifecycle-hook',
+            'AutoScalingGroupName': "{0}-{1}-{2}".format(PROJECT, ENVIRONMENT, ROLE),
+            'LifecycleActionToken': "token-{0}".format(node.instance_id),
+            'EC2InstanceId': node.instance_id,
+            'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING',
+            'Origin': origin,
+            'Destination': destination,
+            'NotificationMetadata': json.dumps({'project': PROJECT, 'environment': ENVIRONMENT,
+                'role': ROLE, 'id': str(node.index)})
+        }
+        self.invoke('lifecycle_fn', {'Records': [{'Sns': {'Message': json.dumps(message)}}]})
+
+    def terminate(self, node):
+        self.sim.sleep(self.settings['sns_delay'])
+        message = {
+            'LifecycleHookName': 'termination-hook',
+            'AutoScalingGroupName': "{0}-{1}-{2}".format(PROJECT, ENVIRONMENT, ROLE),
+            'LifecycleActionToken': "token-{0}".format(node.instance_id),
+            'EC2InstanceId': node.instance_id,
+            'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING',
+            'Origin': 'AutoScalingGroup',
+            'Destination': 'EC2',
+            'NotificationMetadata': json.dumps({'project': PROJECT, 'environment': ENVIRONMENT,
+                'role': ROLE, 'id': str(node.index)})
+        }
+        self.invoke('terminate_node_fn', {'Records': [{'Sns': {'Message': json.dumps(message)}}]})
+
+    def automation_done(self, execution, node):
+        parameters = execution['parameters']
+        if execution['status'] == 'Success' and self.settings['automations'][execution['document']]['ready']:
+            self.sqs['ready_messages'] += 1
+            attributes = OrderedDict()
+            for name in ['Project', 'Environment', 'Role', 'ID']:
+                attributes[name] = {'DataType': 'String', 'StringValue': parameters[name][0]}
+            self.enqueue('Ready', attributes, 0)
+        event = {
+            'version': '0',
+            'detail-type': 'EC2 Automation Execution Status-change Notification',
+            'source': 'aws.ssm',
+            'detail': {'ExecutionId': execution['id'], 'Definition': execution['document'],
+                'Status': execution['status']}
+        }
+        self.sim.spawn(self.invoke, 'complete_lifecycle_fn', event, delay=self.settings['eventbridge_delay'])
+
+    def enqueue(self, body, attributes, delay):
+        self.sqs['sent'] += 1
+        message = {'id': "msg-{0}".format(self.sqs['sent']), 'seq': self.sqs['sent'], 'body': body,
+            'attributes': attributes, 'visible_at': self.sim.now + delay, 'receives': 0}
+        self.queue.append(message)
+        self.queue_signal.set()
+        return message['id']
+
+    def send_message(self, queue_url, body, attributes, delay):
+        self.sqs['requeued'] += 1
+        return {'MessageId': self.enqueue(body, attributes, delay)}
+
+    def record(self, message):
+        attributes = dict((name, {'stringValue': a['StringValue'], 'stringListValues': [],
+            'binaryListValues': [], 'dataType': a['DataType']}) for name, a in message['attributes'].items())
+        return {'messageId': message['id'], 'receiptHandle': message['id'], 'body': message['body'],
+            'attributes': {'ApproximateReceiveCount': str(message['receives'])},
+            'messageAttributes': attributes, 'eventSource': 'aws:sqs'}
+
+    def poll_queue(self):
+        """Lambda's SQS event source mapping, feeding a function with a concurrency of one."""
+        batch_size = self.queue_settings['batch_size']
+        window = self.queue_settings['batch_window']
+        while True:
+            self.queue_signal.clear()
+            now = self.sim.now
+            visible = [m for m in self.queue if m['visible_at'] <= now]
+            if not visible:
+                upcoming = [m['visible_at'] for m in self.queue]
+                self.queue_signal.wait(min(upcoming) - now if upcoming else None)
+                continue
+            opened = min(m['visible_at'] for m in visible)
+            if len(visible) < batch_size and now < opened + window:
+                self.queue_signal.wait(opened + window - now)
+                continue
+            batch = sorted(visible, key=lambda m: m['seq'])[:batch_size]
+            for m in batch:
+                m['visible_at'] = now + self.queue_settings['visibility_timeout']
+                m['receives'] += 1
+            self.sqs['batches'] += 1
+            self.sqs['deliveries'] += len(batch)
+            failed = set(m['id'] for m in batch)
+            try:
+                response = self.invoke('workflow_fn', {'Records': [self.record(m) for m in batch]})
+                failed = set(item['itemIdentifier'] for item in (response or {}).get('batchItemFailures', []))
+            except Exception:
+                pass
+            self.sqs['batch_item_failures'] += len(failed)
+            for m in batch:
+                if m['id'] not in failed:
+                    self.queue.remove(m)
+
+    def start_execution(self, arn, name, sfn_input):
+        if name in self.executions:
+            raise fake_aws.error('ExecutionAlreadyExists', 'StartExecution')
+        execution = {'executionArn': "{0}:{1}".format(arn.replace(':stateMachine:', ':execution:'), name),
+            'name': name, 'status': 'RUNNING', 'start': self.sim.now}
+        self.executions[name] = execution
+        self.sim.spawn(self.run_execution, execution, json.loads(sfn_input))
+        return {'executionArn': execution['executionArn'], 'startDate': utc(self.sim.now)}
+
+    def list_executions(self, arn, status_filter):
+        return [{'executionArn': e['executionArn'], 'stateMachineArn': arn, 'name': e['name'],
+            'status': e['status'], 'startDate': utc(e['start'])}
+            for e in self.executions.values() if status_filter is None or e['status'] == status_filter]
+
+    def transition(self, execution, state):
+        self.transitions += 1
+        execution['state'] = state
+        self.sim.sleep(self.settings['sfn_transition'])
+
+    def run_execution(self, execution, data):
+        machine = sfn_local.StateMachine(self.definition, self.invoke, self.sim.sleep, self.transition)
+        try:
+            status, state, output = machine.run(execution, data)
+        except Exception:
+            status, state = 'FAILED', execution.get('state', '') + ' (error)'
+        execution['status'] = status
+        self.outcomes[state] += 1
+
+    # Run
+
+    def done(self):
+        if self.done_at is not None:
+            return True
+        now = self.sim.now
+        for node in self.new_nodes + self.terminated:
+            if "token-{0}".format(node.instance_id) not in self.backend.lifecycle_results:
+                return False
+        rs = self.backend.replica_set
+        for idx in range(self.existing + self.node_count):
+            host = "{0}:{1}".format(self.dns(idx), fake_aws.MONGO_PORT)
+            if idx < self.terminate_count:
+                if host in rs.members:
+                    return False
+            elif not rs.healthy(host, now):
+                return False
+        # Caught-up members get votes until the voting member limit
+        if self.node_count and rs.voters() < min(fake_aws.MAX_VOTERS, self.existing + self.node_count - self.terminate_count):
+            return False
+        self.done_at = now
+        return True
+
+    def run(self):
+        self.configure()
+        self.sim = Simulation()
+        rng = random.Random(self.seed)
+        random.seed(self.seed)
+        self.backend = fake_aws.FakeAWS(self.sim, rng, self.settings, self.latency, self.limits)
+        self.backend.on_automation_done = self.automation_done
+        self.backend.on_start_execution = self.start_execution
+        self.backend.on_list_executions = self.list_executions
+        self.backend.on_send_message = self.send_message
+        self.queue_signal = SimEvent(self.sim)
+
+        holder = {'backend': self.backend}
+        saved_modules = dict((name, sys.modules.get(name)) for name in ['boto3', 'botocore', 'botocore.config'])
+        saved_time = (time.time, time.sleep)
+        saved_env = dict(os.environ)
+        sys.modules.update(fake_aws.boto3_modules(holder))
+        time.time = self.sim.time
+        time.sleep = self.sim.sleep
+        try:
+            self.load_handlers()
+            self.seed_world()
+            self.sim.spawn(self.poll_queue)
+            self.sim.run(self.settings['max_sim_secs'], self.done)
+            return self.results()
+        finally:
+            time.time, time.sleep = saved_time
+            for name, module in saved_modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+    def results(self):
+        rs = self.backend.replica_set
+        lifecycle = Counter(result for result, when in self.backend.lifecycle_results.values())
+        completed = [when for result, when in self.backend.lifecycle_results.values()]
+        ready = [n.ready_at for n in self.new_nodes if n.ready_at is not None]
+        synced = [m['synced'] for m in rs.members.values()]
+        promoted = [m['promoted'] for m in rs.members.values() if m['promoted'] is not None]
+        calls = self.backend.calls
+        throttled = self.backend.throttled
+        lambda_seconds = sum(s['seconds'] for s in self.lambda_stats.values())
+        return OrderedDict([
+            ('scenario', self.name),
+            ('nodes', self.node_count),
+            ('existing', self.existing),
+            ('terminated', self.terminate_count),
+            ('restore', self.restore),
+            ('fast_restore', self.fast_restore),
+            ('warm', self.warm),
+            ('completed', self.done_at is not None),
+            ('makespan_secs', round(self.done_at if self.done_at is not None else self.sim.now, 1)),
+            ('milestones_secs', OrderedDict([
+                ('last_node_bootstrapped', round(max(ready), 1) if ready else None),
+                ('last_lifecycle_completed', round(max(completed), 1) if completed else None),
+                ('last_member_synced', round(max(synced), 1) if synced else None),
+                ('last_member_promoted', round(max(promoted), 1) if promoted else None),
+                ('last_member_removed', round(max(rs.removed.values()), 1) if rs.removed else None)
+            ])),
+            ('voting_members', rs.voters()),
+            ('api_calls', OrderedDict([
+                ('total', sum(calls.values())),
+                ('by_operation', OrderedDict(sorted(calls.items())))
+            ])),
+            ('throttled', OrderedDict([
+                ('total', sum(throttled.values())),
+                ('by_operation', OrderedDict(sorted(throttled.items())))
+            ])),
+            ('lambda', OrderedDict([
+                ('invocations', sum(s['invocations'] for s in self.lambda_stats.values())),
+                ('seconds', round(lambda_seconds, 1)),
+                ('by_function', OrderedDict((name, OrderedDict([
+                    ('invocations', s['invocations']),
+                    ('seconds', round(s['seconds'], 1)),
+                    ('max_secs', round(s['max_secs'], 1)),
+                    ('timeouts', s['timeouts'])])) for name, s in self.lambda_stats.items()))
+            ])),
+            ('sfn', OrderedDict([
+                ('executions', len(self.executions)),
+                ('transitions', self.transitions),
+                ('outcomes', OrderedDict(sorted(self.outcomes.items())))
+            ])),
+            ('metrics', OrderedDict((name, OrderedDict([
+                ('count', len(values)),
+                ('mean', round(sum(values) / float(len(values)), 2)),
+                ('max', round(max(values), 2))])) for name, values in sorted(self.metrics.items()))),
+            ('sqs', OrderedDict(sorted(self.sqs.items()))),
+            ('lifecycle_actions', OrderedDict(sorted(lifecycle.items()))),
+            ('errors', self.sim.errors)
+        ])
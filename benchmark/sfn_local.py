@@ -0,0 +1,168 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import copy
+import datetime
+import time
+
+# Constants
+NUMERIC_COMPARATORS = {
+    'NumericEquals': lambda a, b: a == b,
+    'NumericLessThan': lambda a, b: a < b,
+    'NumericGreaterThan': lambda a, b: a > b,
+    'NumericLessThanEquals': lambda a, b: a <= b,
+    'NumericGreaterThanEquals': lambda a, b: a >= b,
+    'StringEquals': lambda a, b: a == b,
+    'BooleanEquals': lambda a, b: a == b
+}
+
+"""
+Local interpreter for the Amazon States Language subset the workflow
+state machine uses: Task states invoking Lambda functions (with
+InputPath, Parameters including $$ context object paths, ResultPath,
+OutputPath and Retry), Choice states with the comparators above and
+And/Or/Not, Wait, Pass, Succeed and Fail.  Catch is not interpreted; a
+Task whose function still raises after its retries fails the execution.
+"""
+
+class ExecutionFailed(Exception): pass
+
+def select(data, path):
+    if path is None:
+        return {}
+    if path == '$':
+        return data
+    value = data
+    for key in path[2:].split('.'):
+        value = value[key]
+    return value
+
+def assign(data, path, result):
+    if path is None:
+        return data
+    if path == '$':
+        return result
+    data = copy.deepcopy(data)
+    target = data
+    keys = path[2:].split('.')
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = result
+    return data
+
+def parameters(template, data, context):
+    """Resolve a Parameters template: keys ending in .$ are paths into the input or, with $$, the context object."""
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                result[key[:-2]] = select(context, value[1:]) if value.startswith('$$') else select(data, value)
+            else:
+                result[key] = parameters(value, data, context)
+        return result
+    if isinstance(template, list):
+        return [parameters(value, data, context) for value in template]
+    return template
+
+def retry_delay(retriers, error, attempts):
+    """Seconds to wait before retrying error, or None when no retrier applies or retries are used up."""
+    for retrier in retriers:
+        names = retrier['ErrorEquals']
+        if error in names or 'States.ALL' in names or 'States.TaskFailed' in names:
+            key = tuple(names)
+            attempts[key] = attempts.get(key, 0) + 1
+            if attempts[key] > retrier.get('MaxAttempts', 3):
+                return None
+            return retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** (attempts[key] - 1)
+    return None
+
+def matches(rule, data):
+    if 'And' in rule:
+        return all(matches(r, data) for r in rule['And'])
+    if 'Or' in rule:
+        return any(matches(r, data) for r in rule['Or'])
+    if 'Not' in rule:
+        return not matches(rule['Not'], data)
+    try:
+        value = select(data, rule['Variable'])
+    except (KeyError, TypeError):
+        return False
+    for name, compare in NUMERIC_COMPARATORS.items():
+        if name in rule:
+            return compare(value, rule[name])
+    raise NotImplementedError("Unsupported choice rule: {0}".format(rule))
+
+class StateMachine(object):
+    """
+    Runs executions of one definition.  invoke(function name, input) runs a
+    Lambda function and returns its result; sleep(seconds) waits on the
+    simulated clock.  on_transition(execution, state name) is called as
+    each state is entered.
+    """
+
+    def __init__(self, definition, invoke, sleep, on_transition=None):
+        self.definition = definition
+        self.invoke = invoke
+        self.sleep = sleep
+        self.on_transition = on_transition
+
+    def invoke_task(self, execution, name, state, data):
+        entered = datetime.datetime.utcfromtimestamp(time.time()).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        task_input = select(data, state.get('InputPath', '$'))
+        attempts = {}
+        while True:
+            context = {'Execution': {'Id': execution['executionArn']},
+                'State': {'Name': name, 'EnteredTime': entered, 'RetryCount': sum(attempts.values())}}
+            if 'Parameters' in state:
+                event = parameters(state['Parameters'], task_input, context)
+            else:
+                event = task_input
+            try:
+                return self.invoke(state['Resource'].split(':')[-1], event)
+            except Exception as e:
+                delay = retry_delay(state.get('Retry', []), type(e).__name__, attempts)
+                if delay is None:
+                    raise
+                self.sleep(delay)
+
+    def run(self, execution, data):
+        """
+        Run to completion and return (status, final state name, output).
+        execution is a dict with the executionArn.
+        """
+        states = self.definition['States']
+        name = self.definition['StartAt']
+        while True:
+            state = states[name]
+            if self.on_transition is not None:
+                self.on_transition(execution, name)
+            kind = state['Type']
+            if kind == 'Task':
+                result = self.invoke_task(execution, name, state, data)
+                data = assign(data, state.get('ResultPath', '$'), result)
+                data = select(data, state.get('OutputPath', '$'))
+            elif kind == 'Pass':
+                if 'Result' in state:
+                    data = assign(data, state.get('ResultPath', '$'), state['Result'])
+            elif kind == 'Wait':
+                seconds = state['Seconds'] if 'Seconds' in state else select(data, state['SecondsPath'])
+                self.sleep(seconds)
+            elif kind == 'Choice':
+                following = state.get('Default')
+                for rule in state['Choices']:
+                    if matches(rule, data):
+                        following = rule['Next']
+                        break
+                if following is None:
+                    return 'FAILED', name, data
+                name = following
+                continue
+            elif kind == 'Succeed':
+                return 'SUCCEEDED', name, data
+            elif kind == 'Fail':
+                return 'FAILED', name, data
+            else:
+                raise NotImplementedError("Unsupported state type: {0}".format(kind))
+            if state.get('End'):
+                return 'SUCCEEDED', name, data
+            name = state['Next']
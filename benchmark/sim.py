@@ -0,0 +1,188 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import heapq
+import itertools
+import logging
+import threading
+import traceback
+
+# Constants
+LOGGER = logging.getLogger()
+EPOCH = 1546300800.0 # 2019-01-01T00:00:00Z, simulated wall clock at t=0
+
+"""
+Discrete-event simulation kernel for the benchmark.
+
+Every simulated activity (a Lambda invocation, an automation, the SQS
+poller) runs the real code in its own thread, but time only moves when
+every simulated thread is blocked: sleeping via Simulation.sleep, waiting
+on a SimEvent or a SimFuture.  The scheduler then jumps straight to the
+next wake-up.  With time.time and time.sleep routed to the simulation, the
+handlers' polling loops, backoffs and timeouts run at full speed and give
+the same answer regardless of how fast the host is.
+"""
+
+class SimulationStopped(BaseException):
+    """Raised in simulated threads that are still blocked when the run ends.
+    A BaseException so the handlers' broad except clauses let it through."""
+    pass
+
+class _Waiter(object):
+    __slots__ = ['woken']
+
+    def __init__(self):
+        self.woken = False
+
+class Simulation(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.stopped = False
+        self.errors = []
+        self._cond = threading.Condition()
+        self._running = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._threads = []
+
+    def time(self):
+        return EPOCH + self.now
+
+    def spawn(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in a new simulated thread, delay seconds from now."""
+        delay = kwargs.pop('delay', 0)
+        with self._cond:
+            heapq.heappush(self._queue, (self.now + max(0, delay), next(self._seq), 'spawn', (fn, args, kwargs)))
+
+    def _block(self, waiter, timeout=None):
+        # Caller holds the condition
+        if timeout is not None:
+            heapq.heappush(self._queue, (self.now + max(0, timeout), next(self._seq), 'wake', waiter))
+        self._running -= 1
+        self._cond.notify_all()
+        while not waiter.woken:
+            self._cond.wait()
+            if self.stopped:
+                raise SimulationStopped()
+
+    def _wake(self, waiter):
+        # Caller holds the condition
+        if not waiter.woken:
+            waiter.woken = True
+            self._running += 1
+            self._cond.notify_all()
+
+    def sleep(self, seconds):
+        with self._cond:
+            if self.stopped:
+                raise SimulationStopped()
+            if seconds <= 0:
+                return
+            self._block(_Waiter(), seconds)
+
+    def _thread_main(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except SimulationStopped:
+            pass
+        except Exception as e:
+            LOGGER.error("Simulated thread failed: {0}\n\n{1}".format(str(e), traceback.format_exc()))
+            self.errors.append(str(e))
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def run(self, until, done=None):
+        """
+        Process events until done() is true, nothing is left to do, or the
+        clock passes until.  done is evaluated whenever time is about to
+        move, i.e. when every simulated thread is blocked.
+        """
+        with self._cond:
+            while True:
+                while self._running > 0:
+                    self._cond.wait()
+                if done is not None and done():
+                    break
+                if not self._queue or self._queue[0][0] > until:
+                    break
+                when, _, kind, payload = heapq.heappop(self._queue)
+                if kind == 'wake' and payload.woken:
+                    continue # timeout of a wait that already ended
+                self.now = max(self.now, when)
+                if kind == 'wake':
+                    self._wake(payload)
+                else:
+                    fn, args, kwargs = payload
+                    self._running += 1
+                    thread = threading.Thread(target=self._thread_main, args=(fn, args, kwargs))
+                    thread.daemon = True
+                    self._threads.append(thread)
+                    thread.start()
+            self.stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(5)
+
+class SimEvent(object):
+    """An event simulated threads can wait on, with an optional timeout."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.is_set = False
+        self._waiters = []
+
+    def set(self):
+        with self.sim._cond:
+            self.is_set = True
+            for waiter in self._waiters:
+                self.sim._wake(waiter)
+            self._waiters = []
+
+    def clear(self):
+        with self.sim._cond:
+            self.is_set = False
+
+    def wait(self, timeout=None):
+        with self.sim._cond:
+            if self.sim.stopped:
+                raise SimulationStopped()
+            if not self.is_set:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+                self.sim._block(waiter, timeout)
+            return self.is_set
+
+class SimFuture(object):
+
+    def __init__(self, sim):
+        self._done = SimEvent(sim)
+        self._result = None
+        self._exception = None
+
+    def result(self):
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class SimExecutor(object):
+    """Stands in for a handler module's ThreadPoolExecutor."""
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def submit(self, fn, *args, **kwargs):
+        future = SimFuture(self.sim)
+
+        def run():
+            try:
+                future._result = fn(*args, **kwargs)
+            except Exception as e:
+                future._exception = e
+            future._done.set()
+
+        self.sim.spawn(run)
+        return future
@@ -0,0 +1,97 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import re
+
+# Constants
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKFLOW_DIR = os.path.join(ROOT, 'workflow')
+
+"""
+Reads the deployed configuration out of the workflow module's Terraform
+files, so the benchmark exercises the same state machine, Lambda
+handlers, timeouts, environment and SQS batching settings as a real
+deployment.  Only the handful of constructs those files use are
+understood; ${...} references are resolved from variable defaults (with
+overrides) and from the local names given in refs.
+"""
+
+def read(name):
+    with open(os.path.join(WORKFLOW_DIR, name)) as f:
+        return f.read()
+
+def blocks(text, kind, type_name=None):
+    """Yield (name, body) for every top-level `kind "type" "name" {` block."""
+    if type_name is None:
+        pattern = r'^{0} "([^"]+)" \{{\n(.*?)^\}}'.format(kind)
+    else:
+        pattern = r'^{0} "{1}" "([^"]+)" \{{\n(.*?)^\}}'.format(kind, type_name)
+    for match in re.finditer(pattern, text, re.M | re.S):
+        yield match.group(1), match.group(2)
+
+def variable_defaults():
+    defaults = {}
+    for name, body in blocks(read('vars.tf'), 'variable'):
+        match = re.search(r'^\s*default\s*=\s*"(.*)"\s*$', body, re.M)
+        if match:
+            defaults[name] = match.group(1)
+    return defaults
+
+def interpolate(text, variables, refs):
+    def resolve(match):
+        expr = match.group(1)
+        if expr.startswith('var.'):
+            return variables[expr[4:]]
+        if expr in refs:
+            return refs[expr]
+        raise ValueError("Cannot resolve ${{{0}}} in the benchmark".format(expr))
+    return re.sub(r'\$\{([^}]+)\}', resolve, text)
+
+def attribute(body, name):
+    match = re.search(r'^\s*{0}\s*=\s*"?([^"\n]*)"?\s*$'.format(name), body, re.M)
+    return match.group(1) if match else None
+
+def lambda_functions(variables, refs):
+    """Return {function resource name: {'handler', 'timeout', 'environment'}}."""
+    functions = {}
+    for name, body in blocks(read('main.tf'), 'resource', 'aws_lambda_function'):
+        environment = {}
+        env = re.search(r'variables = \{\n(.*?)\n\s*\}', body, re.S)
+        if env:
+            for key, value in re.findall(r'^\s*(\w+)\s*=\s*"(.*)",?\s*$', env.group(1), re.M):
+                environment[key] = interpolate(value, variables, refs)
+        functions[name] = {
+            'handler': attribute(body, 'handler'),
+            'timeout': int(attribute(body, 'timeout')),
+            'environment': environment
+        }
+    return functions
+
+def state_machine(name, variables, refs):
+    # The definition is a heredoc with braces in column one, so search from
+    # the resource header instead of splitting blocks
+    match = re.search(r'^resource "aws_sfn_state_machine" "{0}" \{{\n.*?definition = <<EOF\n(.*?)\nEOF'.format(name),
+        read('main.tf'), re.M | re.S)
+    if match is None:
+        raise ValueError("State machine {0} not found".format(name))
+    return json.loads(interpolate(match.group(1), variables, refs))
+
+def queue_settings(variables, refs):
+    main = read('main.tf')
+    queue = next(body for name, body in blocks(main, 'resource', 'aws_sqs_queue') if name == 'workflow_queue')
+    mapping = next(body for name, body in blocks(main, 'resource', 'aws_lambda_event_source_mapping'))
+    return {
+        'visibility_timeout': int(attribute(queue, 'visibility_timeout_seconds') or 30),
+        'batch_size': int(interpolate(attribute(mapping, 'batch_size') or '10', variables, refs)),
+        'batch_window': int(interpolate(attribute(mapping, 'maximum_batching_window_in_seconds') or '0', variables, refs))
+    }
+
+def automation_steps(template='ssm_doc_init.tpl'):
+    """Step names of a node bootstrap automation document, in order."""
+    text = read(template)
+    return re.findall(r'^- name: (\w+)', text, re.M)
+
+def resource_names(type_name):
+    return [name for name, body in blocks(read('main.tf'), 'resource', type_name)]
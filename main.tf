@@ -20,6 +20,7 @@ module "security" {
   vpc =  "${module.network.VpcId}"
   ingress_prefix =  "${var.ingress_prefix}"
   Region = "${var.region}"
+  BucketName =  "${var.BucketName}"
 }
  module "nodes" {
     source = "./nodes"
@@ -34,6 +35,7 @@ module "security" {
     LambdaFnName = "${module.workflow.LambdaFnName}"
     LambdaFnArn = "${module.workflow.LambdaFnArn}"
     LifecycleTopicArn = "${module.workflow.LifecycleTopicArn}"
+    TerminationTopicArn = "${module.workflow.TerminationTopicArn}"
     LifecycleRoleArn = "${module.security.ASGRoleArn}"
     dlm_lifecycle_role_arn = "${module.security.DlmRoleArn}"
     mw_role_arn = "${module.security.MwRoleArn}"
@@ -42,6 +44,9 @@ module "security" {
     subnets = ["${module.network.SubnetIdPrivateA}","${module.network.SubnetIdPrivateB}","${module.network.SubnetIdPrivateC}"]
     data_vol_iops = "${var.data_vol_iops}"
     num_rs_members = "${var.num_rs_members}"
+    warm_pool_size = "${var.warm_pool_size}"
+    tuning_profile = "${var.tuning_profile}"
+    data_vol_policy = "${var.data_vol_policy}"
 
  }
 module "workflow" {
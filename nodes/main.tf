@@ -97,6 +97,56 @@ resource "aws_ssm_parameter" "rs_logs-ssm" {
   }
 }
 
+resource "aws_ssm_parameter" "storagepolicy-ssm" {
+  name  = "/${var.ProjectTag}/${var.Environment}/rsmember/storagepolicy"
+  type  = "String"
+  value = "${jsonencode(merge(map("type", "io1", "iops", var.data_vol_iops), var.data_vol_policy))}"
+  overwrite = "true"
+  tags {
+    Name = "ssm-storagepolicy-rsmember"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+}
+
+resource "aws_ssm_parameter" "tuning-ssm" {
+  name  = "/${var.ProjectTag}/${var.Environment}/rsmember/tuning"
+  type  = "String"
+  value = "${jsonencode(var.tuning_profile)}"
+  overwrite = "true"
+  tags {
+    Name = "ssm-tuning-rsmember"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+}
+
+resource "aws_ssm_document" "tuning_drift" {
+  name          = "mongo_tuning_drift"
+  document_type = "Command"
+  tags {
+    Name = "mongo_tuning_drift_ssm_doc"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+
+  content = <<DOC
+{
+  "schemaVersion": "2.2",
+  "description": "Report drift of a MongoDB node from its storage and OS tuning profile.",
+  "mainSteps": [
+    {
+      "action": "aws:runShellScript",
+      "name": "checkTuningDrift",
+      "inputs": {
+        "runCommand": [ "/usr/local/bin/mongo-tuning-drift" ]
+      }
+    }
+  ]
+}
+DOC
+}
+
 resource "aws_launch_configuration" "rs_lc" {
   name_prefix   = "rs"
   image_id      = "${var.ami}"
@@ -160,6 +210,22 @@ resource "aws_autoscaling_group" "rs_asg" {
 EOF
   }
 
+  initial_lifecycle_hook = {
+    name                   = "rs_instance_terminate"
+    heartbeat_timeout      = 300
+    lifecycle_transition   = "autoscaling:EC2_INSTANCE_TERMINATING"
+    notification_target_arn = "${var.TerminationTopicArn}"
+    role_arn                = "${var.LifecycleRoleArn}"
+    notification_metadata = <<EOF
+{
+  "role": "rsmember",
+  "id": "${count.index}",
+  "project": "${var.ProjectTag}",
+  "environment": "${var.Environment}"
+}
+EOF
+  }
+
 
   tag {
     key                 = "Project"
@@ -179,6 +245,31 @@ EOF
   }
 }
 
+# The AWS provider has no warm pool argument for this Terraform version, so
+# the pools are managed with the CLI.  Instances are bootstrapped by the
+# launch hook when they enter the pool (warm_rs_server) and only attach the
+# member's ENI and volumes and start mongod when they leave it
+# (resume_rs_server), which makes replacing a member much faster.
+data "aws_region" "current" {}
+
+resource "null_resource" "rs_warm_pool" {
+  count = "${var.warm_pool_size > 0 ? var.num_rs_members : 0}"
+
+  triggers {
+    asg = "${element(aws_autoscaling_group.rs_asg.*.name, count.index)}"
+    size = "${var.warm_pool_size}"
+  }
+
+  provisioner "local-exec" {
+    command = "aws autoscaling put-warm-pool --region ${data.aws_region.current.name} --auto-scaling-group-name ${element(aws_autoscaling_group.rs_asg.*.name, count.index)} --pool-state Stopped --min-size ${var.warm_pool_size}"
+  }
+
+  provisioner "local-exec" {
+    when = "destroy"
+    command = "aws autoscaling delete-warm-pool --region ${data.aws_region.current.name} --auto-scaling-group-name ${element(aws_autoscaling_group.rs_asg.*.name, count.index)} --force-delete"
+  }
+}
+
 resource "aws_dlm_lifecycle_policy" "mongo_snapshots" {
   description        = "DLM lifecycle policy for MongoDB"
   execution_role_arn = "${var.dlm_lifecycle_role_arn}"
@@ -7,6 +7,10 @@ variable "num_rs_members" {
 variable "init_rs_members" {
   default = "3"
 }
+variable "warm_pool_size" {
+  description = "Stopped, bootstrapped instances kept in each member's ASG warm pool (0 for no warm pool)"
+  default = "0"
+}
 variable "ProjectTag" { }
 variable "Environment" { }
 variable "root_vol_iops" {
@@ -40,6 +44,7 @@ variable "zone" {}
 variable "LambdaFnName" {}
 variable "LambdaFnArn" {}
 variable "LifecycleTopicArn" {}
+variable "TerminationTopicArn" {}
 variable "LifecycleRoleArn" {}
 variable "dlm_lifecycle_role_arn" {}
 variable "mw_role_arn" {}
@@ -47,3 +52,20 @@ variable "BucketName" {}
 variable "instance_type" {
   default = "r4.2xlarge"
 }
+variable "tuning_profile" {
+  type = "map"
+  default = {
+    fs_type = "xfs"
+    mount_opts = "defaults,noatime"
+    readahead_sectors = "32"
+    disable_thp = "true"
+    swappiness = "1"
+    wt_cache_ratio = "0.5"
+    journal_on_logs = "false"
+  }
+}
+variable "data_vol_policy" {
+  description = "Storage policy for data volumes restored from snapshots (type, iops or iops_per_gb, min_iops, max_iops, throughput or throughput_per_gb, min_size_gb)"
+  type = "map"
+  default = {}
+}
@@ -2,10 +2,14 @@
 # SPDX-License-Identifier: Apache-2.0
 
 cd workflow
-zip lifecycle_fn.zip index.py
-zip workflow_fn.zip index-workflow.py
-zip check_node_status_fn.zip check_node_status_fn.py
-zip check_rs_status_fn.zip check_rs_status_fn.py
-zip init_rs_fn.zip init_rs_fn.py
-zip add_node_rs_fn.zip add_node_rs_fn.py
+zip lifecycle_fn.zip index.py automation_timing.py snapshot_index.py param_cache.py aws_clients.py metrics.py
+zip complete_lifecycle_fn.zip complete_lifecycle_fn.py automation_timing.py aws_clients.py metrics.py
+zip terminate_node_fn.zip terminate_node_fn.py snapshot_index.py ssm_command.py param_cache.py aws_clients.py metrics.py
+zip snapshot_index_fn.zip snapshot_index_fn.py snapshot_index.py aws_clients.py metrics.py
+zip workflow_fn.zip index-workflow.py param_cache.py aws_clients.py metrics.py
+zip check_node_status_fn.zip check_node_status_fn.py ssm_command.py command_journal.py aws_clients.py metrics.py
+zip check_rs_status_fn.zip check_rs_status_fn.py ssm_command.py command_journal.py aws_clients.py metrics.py
+zip init_rs_fn.zip init_rs_fn.py ssm_command.py command_journal.py aws_clients.py metrics.py
+zip add_node_rs_fn.zip add_node_rs_fn.py ssm_command.py command_journal.py aws_clients.py metrics.py
+zip promote_members_fn.zip promote_members_fn.py ssm_command.py command_journal.py aws_clients.py metrics.py
 cd ..
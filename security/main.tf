@@ -180,6 +180,13 @@ resource "aws_iam_role_policy" "mongo_ec2_access" {
       ],
       "Effect": "Allow",
       "Resource": "*"
+    },
+    {
+      "Action": [
+        "s3:PutObject"
+      ],
+      "Effect": "Allow",
+      "Resource": "arn:aws:s3:::${var.BucketName}/*"
     }
   ]
 }
@@ -246,12 +253,33 @@ resource "aws_iam_role_policy" "lambda_ssm_access" {
       "Effect": "Allow",
       "Resource": "*"
     },
+    {
+      "Action": [
+        "ssm:ListCommandInvocations"
+      ],
+      "Effect": "Allow",
+      "Resource": "*"
+    },
     {
       "Action": [
         "ssm:PutParameter"
       ],
       "Effect": "Allow",
       "Resource": "*"
+    },
+    {
+      "Action": [
+        "ssm:DeleteParameter"
+      ],
+      "Effect": "Allow",
+      "Resource": "*"
+    },
+    {
+      "Action": [
+        "s3:GetObject"
+      ],
+      "Effect": "Allow",
+      "Resource": "arn:aws:s3:::${var.BucketName}/*"
     }
   ]
 }
@@ -286,6 +314,13 @@ resource "aws_iam_role_policy" "lambda_sqs_access" {
       ],
       "Effect": "Allow",
       "Resource": "*"
+    },
+    {
+      "Action": [
+        "sqs:SendMessage"
+      ],
+      "Effect": "Allow",
+      "Resource": "*"
     }
   ]
 }
@@ -341,6 +376,13 @@ resource "aws_iam_role_policy" "lambda_asg_access" {
       "Effect": "Allow",
       "Resource": "*"
     },
+    {
+      "Action": [
+        "ec2:CreateSnapshot"
+      ],
+      "Effect": "Allow",
+      "Resource": "*"
+    },
     {
       "Action": [
         "ec2:CreateTags"
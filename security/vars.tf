@@ -6,3 +6,4 @@ variable "Environment" { }
 variable "vpc" { }
 variable "Region" {}
 variable "ingress_prefix" { }
+variable "BucketName" { }
@@ -1,23 +1,23 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
+import command_journal
 import json
 import logging
 import traceback
+import metrics
 import os
+import ssm_command
 import time
 
 # Create AWS clients
-ssm = boto3.client('ssm')
+ssm = aws_clients.client('ssm')
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-# Env variables
-docname = 'AWS-RunShellScript'
-
 """
 Event should be a JSON document:
 
@@ -48,60 +48,95 @@ Event should be a JSON document:
 
 }
 
+
+Output reports the outcome for every member we tried to add, and when the
+rs.add command started on the primary (epoch milliseconds), so
+promote_members_fn can time their initial sync:
+
+{
+    "code": 1,
+    "members": {
+        m1: { "ok": 1, "errmsg": "" },
+        m2: { "ok": 0, "errmsg": "..." }
+    },
+    "added_at": 1546475202000
+}
 """
+
+RESULT_MARKER = 'RSADD '
+
+def build_add_script(missing_nodes):
+    """
+    Build one mongo shell script that adds every missing member, so that
+    adding N nodes costs one SSM round trip and one shell startup.
+    Each rs.add result is printed on its own line after RESULT_MARKER.
+    """
+    hosts = json.dumps([m + ':27017' for m in missing_nodes])
+    return ('var hosts = ' + hosts + '; '
+        'hosts.forEach(function(h) { '
+        'var r = rs.add( { host: h, priority: 0, votes: 0 } ); '
+        'print("' + RESULT_MARKER + '" + JSON.stringify({ host: h, ok: r.ok, errmsg: r.errmsg || "" })); '
+        '});')
+
+def parse_add_output(lines, missing_nodes):
+    members = dict((m, {'ok': 0, 'errmsg': 'no result reported'}) for m in missing_nodes)
+    for outcome in ssm_command.json_lines(lines, RESULT_MARKER):
+        host = outcome['host'].rsplit(':', 1)[0]
+        members[host] = {'ok': 1 if outcome['ok'] == 1 else 0, 'errmsg': outcome['errmsg']}
+    return members
+
 def handler(event, context):
 
     try:
-        LOGGER.info("SFN metadata: {0} (type = {1})".format(json.dumps(event), type(event)))
+        metrics.begin(context)
+        metrics.log_event("SFN metadata", event)
+        event, journal_key = command_journal.unwrap(event)
+        journal = command_journal.open_journal(ssm, journal_key)
+        metrics.set_dimensions(event['project'], event['environment'], event['role'])
         instanceids = event['nodes']['id']
+        dnsnames = event['nodes']['dns']
         missing_nodes = event['rsstatus']['missing_nodes']
+        primary = event['rsstatus'].get('primary', '')
+
+        # rs.add has to run on the primary; fall back to the first node if
+        # the status check did not find one.
         iid = instanceids[0]
+        if primary in dnsnames:
+            iid = instanceids[dnsnames.index(primary)]
 
         LOGGER.info("missing-nodes: %s" % missing_nodes)
 
-        # rs.add( { host: "mongodb3.example.net:27017", priority: 0, votes: 0 } )
+        add_rs_cmd = build_add_script(missing_nodes)
+        LOGGER.info("add RS command: %s" % add_rs_cmd)
+
+        LOGGER.info("Starting doc execution") 
+        result = ssm_command.run_command(ssm, iid, ["mongo --quiet --eval '{0}'".format(add_rs_cmd)], context, journal=journal)
+        if not result.ok:
+            LOGGER.warn("RS {0} add error: {1}".format(iid, result.status_details))
+            return {'code': 0, 'members': {}}
+        # A retry resumes the command, so time the add from when it ran
+        added_at = ssm_command.epoch_millis(result.started) or int(time.time() * 1000)
+
+        members = parse_add_output(result.lines(), missing_nodes)
+        overall_status = 1
         for m in missing_nodes:
-            LOGGER.info("Adding node {0} to RS".format(m))
-            add_rs_cmd = 'rs.add( { host: "' + m + ':27017", priority: 0, votes: 0 } )'
-            LOGGER.info("add RS command: %s" % add_rs_cmd)
-
-            LOGGER.info("Starting doc execution") 
-            response = ssm.send_command(
-                InstanceIds = [iid],
-                DocumentName = docname,
-                TimeoutSeconds = 30,
-                Parameters = {
-                    'commands': ["mongo --eval '{0}'".format(add_rs_cmd)]
-                },
-            )
-            command_id = response['Command']['CommandId']
-            LOGGER.info("Doc command id: {0}".format(command_id))
-
-            # We need to wait a minute to let the command invocation show up
-            time.sleep(5)
-
-            while True:
-                LOGGER.info("Checking command status for node {0}".format(iid))
-                response = ssm.get_command_invocation( CommandId=command_id, InstanceId = iid)
-                status = response['Status']
-                if status == 'Failed':
-                    LOGGER.warn("RS {0} add error: {1}".format(iid, response['StatusDetails']))
-                    break
-                if status == 'TimedOut':
-                    LOGGER.warn("RS {0} add error: {1}".format(iid, response['StatusDetails']))
-                    break
-                if status == 'Success':
-                    stdout_content = response['StandardOutputContent']
-                    if '"ok" : 1' in stdout_content:
-                        LOGGER.info("RS add ok: {0}".format(iid))
-                    else:
-                        LOGGER.warn("RS failed add : {0} - {1}".format(iid, stdout_content))
-                    break
-                time.sleep(5)
-
-        return 1 
+            if members[m]['ok'] == 1:
+                LOGGER.info("RS add ok: {0}".format(m))
+            else:
+                LOGGER.warn("RS failed add : {0} - {1}".format(m, members[m]['errmsg']))
+                overall_status = 0
+        added = len([m for m in missing_nodes if members[m]['ok'] == 1])
+        metrics.put('MembersAdded', added, 'Count')
+        metrics.put('MembersFailed', len(missing_nodes) - added, 'Count')
+        return {'code': overall_status, 'members': members, 'added_at': added_at}
+    except ssm_command.CommandTimeoutException as e:
+        # Fail the task so the state machine retries it; the retry resumes the command
+        LOGGER.warn("Command still running: {0}".format(str(e)))
+        raise e
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed adding node to RS {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
-        return 0
-
+        return {'code': 0, 'members': {}}
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
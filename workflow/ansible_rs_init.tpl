@@ -1,27 +1,130 @@
 - hosts: all
   become: true
+  vars:
+    # Point MongoRepoUrl at a local mirror or S3-hosted package cache to
+    # avoid pulling packages from the internet on every launch.
+    mongo_repo_url: "{{ MongoRepoUrl | default('https://repo.mongodb.org/yum/amazon/2013.03/mongodb-org/4.0/x86_64/', true) }}"
+    # full bootstraps a node in one go.  With an ASG warm pool, warm runs
+    # when an instance enters the pool, before its member's volumes and ENI
+    # are attached, and resume when it leaves the pool for service.
+    stage: "{{ Stage | default('full', true) }}"
+    # The volumes are attached side by side, so nvme1n1/nvme2n1 can be
+    # either one; EBS exposes the volume ID as the NVMe serial number.
+    data_serial: "{{ VolumeIdData | default('') | replace('-', '') }}"
+    logs_serial: "{{ VolumeIdLogs | default('') | replace('-', '') }}"
+    data_dev: "/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_{{ data_serial }}"
+    logs_dev: "/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_{{ logs_serial }}"
+    # Used when /Project/Environment/Role/tuning is not set.  Values may
+    # arrive as strings from the SSM parameter, hence the filters below.
+    default_tuning:
+      fs_type: xfs
+      mount_opts: defaults,noatime
+      readahead_sectors: 32
+      disable_thp: true
+      swappiness: 1
+      wt_cache_ratio: 0.5
+      journal_on_logs: false
+
+  handlers:
+  - name: restart mongod
+    service:
+      name: mongod
+      state: restarted
 
   tasks:
+  # Instances built from a pre-baked AMI already have mongod installed, so
+  # only the per-node settings below (mounts, bind IP, replSetName) apply.
+  - name: Check for installed mongo
+    command: rpm -q mongodb-org
+    args:
+      warn: False
+    register: mongo_rpm
+    changed_when: False
+    failed_when: False
+
   - name: configure mongo yum repo
     yum_repository:
       description: MongoDB Repository
       name: mongodb-org-4.0
-      baseurl: https://repo.mongodb.org/yum/amazon/2013.03/mongodb-org/4.0/x86_64/
+      baseurl: "{{ mongo_repo_url }}"
       gpgcheck: 1
       gpgkey: https://www.mongodb.org/static/pgp/server-4.0.asc
+    when: mongo_rpm.rc != 0
 
   - name: install mongo
     yum: name=mongodb-org state=present
+    when: mongo_rpm.rc != 0
+
+  - name: Query region 
+    shell: /usr/bin/curl -s http://169.254.169.254/latest/dynamic/instance-identity/document|grep region|awk -F\" '{print $4}'
+    args:
+      warn: False
+    register: region_out
+  - name: Look up region
+    set_fact:
+      Region: "{{ region_out.stdout }}"
+  - name: Create root AWS config folder
+    file:
+      path: /root/.aws
+      state: directory
+  - name: Set default region
+    lineinfile:
+      path: /root/.aws/config
+      line: '[default]'
+      create: yes
+  - name: Set default region header
+    lineinfile:
+      path: /root/.aws/config
+      line: 'region = {{ Region }}'
+
+  - name: Look up tuning profile
+    shell: aws ssm get-parameter --name /{{ Project }}/{{ Environment }}/{{ Role }}/tuning --query Parameter.Value --output text || echo '{}'
+    register: tuning_out
+    changed_when: False
+  - name: Set tuning profile
+    set_fact:
+      tuning: "{{ default_tuning | combine(tuning_out.stdout | from_json) }}"
+  - debug: var=tuning
+
+  # udev creates the by-id links a moment after the volumes attach
+  - name: Wait for data and logs devices
+    wait_for:
+      path: "{{ item }}"
+      timeout: 60
+    with_items:
+      - "{{ data_dev }}"
+      - "{{ logs_dev }}"
+    when: stage != 'warm'
+
+  # filesystem refuses to touch a device that already holds a different
+  # filesystem, so only blank volumes are formatted: existing and restored
+  # volumes keep what they have (ext4 before tuning profiles existed) and a
+  # changed fs_type only applies to new volumes.  blkid exits 2 on a blank
+  # device.
+  - name: Read data FS type
+    command: blkid -o value -s TYPE {{ data_dev }}
+    register: data_fs
+    changed_when: False
+    failed_when: data_fs.rc not in [0, 2]
+    when: stage != 'warm'
+  - name: Read logs FS type
+    command: blkid -o value -s TYPE {{ logs_dev }}
+    register: logs_fs
+    changed_when: False
+    failed_when: logs_fs.rc not in [0, 2]
+    when: stage != 'warm'
 
   - name: Create data FS
     filesystem:
-      fstype: ext4
-      dev: /dev/nvme1n1
+      fstype: "{{ tuning.fs_type }}"
+      dev: "{{ data_dev }}"
+    when: stage != 'warm' and data_fs.stdout == ''
 
   - name: Create logs FS
     filesystem:
-      fstype: ext4
-      dev: /dev/nvme2n1
+      fstype: "{{ tuning.fs_type }}"
+      dev: "{{ logs_dev }}"
+    when: stage != 'warm' and logs_fs.stdout == ''
 
   - name: Create data directory
     file:
@@ -40,16 +143,55 @@
   - name: Mount data volume
     mount:
       path: /opt/data
-      src: /dev/nvme1n1
-      fstype: ext4
+      src: "{{ data_dev }}"
+      fstype: "{{ data_fs.stdout or tuning.fs_type }}"
+      opts: "{{ tuning.mount_opts }}"
       state: mounted
+    when: stage != 'warm'
 
   - name: Mount logs volume
     mount:
       path: /opt/logs
-      src: /dev/nvme2n1
-      fstype: ext4
+      src: "{{ logs_dev }}"
+      fstype: "{{ logs_fs.stdout or tuning.fs_type }}"
+      opts: "{{ tuning.mount_opts }}"
       state: mounted
+    when: stage != 'warm'
+
+  - name: Fix mount point ownership
+    file:
+      path: "{{ item }}"
+      state: directory
+      owner: mongod
+      group: mongod
+    with_items:
+      - /opt/data
+      - /opt/logs
+    when: stage != 'warm'
+
+  # Keeping the journal on the logs volume means data volume snapshots are
+  # no longer crash consistent on their own, so this is off by default.  It
+  # is only applied to a data volume that has never held a journal.
+  - name: Check for existing journal
+    stat:
+      path: /opt/data/journal
+    register: journal_dir
+    when: stage != 'warm'
+  - name: Create journal directory on logs volume
+    file:
+      path: /opt/logs/journal
+      state: directory
+      owner: mongod
+      group: mongod
+    when: stage != 'warm' and tuning.journal_on_logs | bool and not journal_dir.stat.exists
+  - name: Link journal to logs volume
+    file:
+      src: /opt/logs/journal
+      dest: /opt/data/journal
+      state: link
+      owner: mongod
+      group: mongod
+    when: stage != 'warm' and tuning.journal_on_logs | bool and not journal_dir.stat.exists
 
   - name: configure system settings, file descriptors and number of threads
     pam_limits:
@@ -64,73 +206,134 @@
       - { limit_type: '-', limit_item: 'nproc', value: 64000 }
       - { limit_type: '-', limit_item: 'memlock', value: unlimited }
       - { limit_type: '-', limit_item: 'as', value: unlimited }
+
+  - name: Set swappiness
+    sysctl:
+      name: vm.swappiness
+      value: "{{ tuning.swappiness }}"
+      state: present
   - name: reload settings from all system configuration files
     shell: sysctl --system
 
-  - name: Edit MongoDB config file for logs
-    lineinfile:
-      path: /etc/mongod.conf
-      regexp: 'mongod\.log'
-      line: '  path: /opt/logs/mongod.log'
-      backup: true
-  - name: Edit MongoDB config file for data
-    lineinfile:
-      path: /etc/mongod.conf
-      regexp: 'dbPath'
-      line: '  dbPath: /opt/data'
-      backup: true
-  - name: Edit MongoDB config file for replication
+  - name: Set readahead on data and logs volumes
+    command: blockdev --setra {{ tuning.readahead_sectors }} {{ item }}
+    with_items:
+      - "{{ data_dev }}"
+      - "{{ logs_dev }}"
+    when: stage != 'warm'
+  - name: Persist readahead across reboots
+    copy:
+      dest: /etc/udev/rules.d/85-mongo-readahead.rules
+      content: |
+        ACTION=="add|change", SUBSYSTEM=="block", ENV{DEVTYPE}=="disk", ENV{ID_SERIAL_SHORT}=="{{ data_serial }}", ATTR{bdi/read_ahead_kb}="{{ (tuning.readahead_sectors | int) // 2 }}"
+        ACTION=="add|change", SUBSYSTEM=="block", ENV{DEVTYPE}=="disk", ENV{ID_SERIAL_SHORT}=="{{ logs_serial }}", ATTR{bdi/read_ahead_kb}="{{ (tuning.readahead_sectors | int) // 2 }}"
+    when: stage != 'warm'
+
+  - name: Disable transparent huge pages
+    shell: echo never > /sys/kernel/mm/transparent_hugepage/{{ item }}
+    with_items:
+      - enabled
+      - defrag
+    when: tuning.disable_thp | bool
+  - name: Keep transparent huge pages disabled across reboots
     lineinfile:
-      path: /etc/mongod.conf
-      regexp: 'replication:'
-      line: 'replication:'
-      backup: true
-  - name: Query region 
-    shell: /usr/bin/curl -s http://169.254.169.254/latest/dynamic/instance-identity/document|grep region|awk -F\" '{print $4}'
-    args:
-      warn: False
-    register: region_out
-  - name: Look up region
+      path: /etc/rc.d/rc.local
+      line: echo never > /sys/kernel/mm/transparent_hugepage/{{ item }}
+      insertbefore: EOF
+    with_items:
+      - enabled
+      - defrag
+    when: tuning.disable_thp | bool
+
+  # WiredTiger's own default is 50% of (RAM - 1GB); the ratio lets a profile
+  # leave more or less room for the filesystem cache.
+  - name: Size WiredTiger cache
     set_fact:
-      Region: "{{ region_out.stdout }}"
-  - name: Create root AWS config folder
-    file:
-      path: /root/.aws
-      state: directory
-  - name: Set default region
-    lineinfile:
-      path: /root/.aws/config
-      line: '[default]'
-      create: yes
-  - name: Set default region header
-    lineinfile:
-      path: /root/.aws/config
-      line: 'region = {{ Region }}'
+      CacheSizeGB: "{{ [((ansible_memtotal_mb / 1024.0 - 1) * (tuning.wt_cache_ratio | float)) | round(1), 0.25] | max }}"
+    when: stage != 'warm'
+
   - name: Look up bind IP
     set_fact:
       BindIP: "{{ lookup('aws_ssm', '/{{ Project }}/{{ Environment }}/{{ Role }}/eip/{{ ID }}') }}"
+    when: stage != 'warm'
   - name: Set repl set name
     set_fact:
       ReplSetName: "{{ Project }}_{{ Environment }}_{{ Role }}"
   - debug: msg="{{ ReplSetName }}"
   - debug: msg="{{ BindIP }}"
+    when: stage != 'warm'
   - debug: msg="{{ Region }}"
-  - name: Edit MongoDB config file for replica set name
-    lineinfile:
-      path: /etc/mongod.conf
-      line: '  replSetName: {{ ReplSetName }}'
-      insertafter: '^replication:'
-      backup: true
-  - name: Edit MongoDB config file for bind IP
-    lineinfile:
-      path: /etc/mongod.conf
-      regexp: '^  bindIp:'
-      line: '  bindIp: localhost,{{ BindIP }}'
+  - debug: msg="{{ CacheSizeGB }}"
+    when: stage != 'warm'
+  # Render the whole file rather than editing it line by line: copy compares
+  # checksums, so an unchanged config is left alone and mongod is only
+  # restarted when a setting actually changes.
+  - name: Write MongoDB config file
+    copy:
+      dest: /etc/mongod.conf
       backup: true
+      content: |
+        systemLog:
+          destination: file
+          logAppend: true
+          path: /opt/logs/mongod.log
+        storage:
+          dbPath: /opt/data
+          journal:
+            enabled: true
+          wiredTiger:
+            engineConfig:
+              cacheSizeGB: {{ CacheSizeGB }}
+        processManagement:
+          fork: true
+          pidFilePath: /var/run/mongodb/mongod.pid
+          timeZoneInfo: /usr/share/zoneinfo
+        net:
+          port: 27017
+          bindIp: localhost,{{ BindIP }}
+        replication:
+          replSetName: {{ ReplSetName }}
+    notify: restart mongod
+    when: stage != 'warm'
 
-  - name: Pause for mongo to stabilize
-    pause:
-      seconds: 60
+  # Run by the mongo_tuning_drift SSM document to compare a running node
+  # with the profile it was built with.
+  - name: Install tuning drift check
+    copy:
+      dest: /usr/local/bin/mongo-tuning-drift
+      mode: 0755
+      content: |
+        #!/bin/bash
+        drift=0
+        check() {
+          if [ "$2" != "$3" ]; then
+            echo "DRIFT $1 expected=$2 actual=$3"
+            drift=1
+          else
+            echo "OK $1 $3"
+          fi
+        }
+        for mnt in /opt/data /opt/logs; do
+          check "$mnt.fstype" "{{ tuning.fs_type }}" "$(findmnt -no FSTYPE $mnt)"
+          for opt in $(echo "{{ tuning.mount_opts }}" | tr ',' ' '); do
+            [ "$opt" = "defaults" ] && continue
+            findmnt -no OPTIONS $mnt | tr ',' '\n' | grep -qx "$opt" && has=$opt || has=missing
+            check "$mnt.opt.$opt" "$opt" "$has"
+          done
+        done
+        check data.readahead "{{ tuning.readahead_sectors }}" "$(blockdev --getra {{ data_dev }})"
+        check logs.readahead "{{ tuning.readahead_sectors }}" "$(blockdev --getra {{ logs_dev }})"
+        {% if tuning.disable_thp | bool %}
+        check thp.enabled "[never]" "$(grep -o '\[[a-z]*\]' /sys/kernel/mm/transparent_hugepage/enabled)"
+        check thp.defrag "[never]" "$(grep -o '\[[a-z]*\]' /sys/kernel/mm/transparent_hugepage/defrag)"
+        {% endif %}
+        check vm.swappiness "{{ tuning.swappiness }}" "$(cat /proc/sys/vm/swappiness)"
+        check wiredTiger.cacheSizeGB "{{ CacheSizeGB }}" "$(awk '/cacheSizeGB:/ {print $2}' /etc/mongod.conf)"
+        exit $drift
+    when: stage != 'warm'
+
+  - name: Apply config changes before checking mongod
+    meta: flush_handlers
 
   - name: Start service mongod, if not started
     service:
@@ -139,10 +342,27 @@
       enabled: yes
     register: mongo_result
     retries: 3
-    delay: 30
+    delay: 10
     until: mongo_result is success
+    when: stage != 'warm'
+
+  - name: Wait for mongod to accept connections
+    wait_for:
+      host: localhost
+      port: 27017
+      timeout: 120
+    when: stage != 'warm'
+
+  # Until it leaves the warm pool the instance has no volumes to run on,
+  # so mongod must not come up by itself when the instance is started.
+  - name: Keep mongod stopped in the warm pool
+    service:
+      name: mongod
+      state: stopped
+      enabled: no
+    when: stage == 'warm'
 
   - name: Show mongod output
     debug: var=mongo_result.stdout
   - name: Show mongod error 
-    debug: var=mongo_result.stderr
+    debug: var=mongo_result.stderr
\ No newline at end of file
@@ -0,0 +1,41 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+import boto3
+
+"""
+attachResources step of the init_rs_server and resume_rs_server automation
+documents, which embed this file as their aws:executeScript script.
+
+Describe the ENI and both volumes once, attach whatever is available in
+one go, then wait on a single gate until all three are attached to this
+instance.  The replaced instance may still hold them for a while, so an
+attachment only counts once it belongs to InstanceId.  The kernel names
+NVMe devices in attach order, so the playbook finds the volumes by ID.
+"""
+
+def attach_resources(events, context):
+    ec2 = boto3.client('ec2')
+    iid = events['InstanceId']
+    eniid = events['EniId']
+    devices = {events['VolumeIdData']: '/dev/xvdg', events['VolumeIdLogs']: '/dev/xvdh'}
+    start = time.time()
+    while True:
+        eni = ec2.describe_network_interfaces(NetworkInterfaceIds=[eniid])['NetworkInterfaces'][0]
+        vols = ec2.describe_volumes(VolumeIds=list(devices.keys()))['Volumes']
+        pending = 0
+        if eni['Status'] == 'available':
+            ec2.attach_network_interface(InstanceId=iid, NetworkInterfaceId=eniid, DeviceIndex=1)
+        attachment = eni.get('Attachment', {})
+        if attachment.get('InstanceId') != iid or attachment.get('Status') != 'attached':
+            pending += 1
+        for vol in vols:
+            if vol['State'] == 'available':
+                ec2.attach_volume(InstanceId=iid, VolumeId=vol['VolumeId'], Device=devices[vol['VolumeId']])
+            attached = [a for a in vol['Attachments'] if a['InstanceId'] == iid and a['State'] == 'attached']
+            if not attached:
+                pending += 1
+        if pending == 0:
+            return {'AttachSeconds': int(round(time.time() - start))}
+        time.sleep(2)
@@ -0,0 +1,43 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import metrics
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+"""
+Per-step timing for the node bootstrap automation, shared by the lifecycle
+Lambda (sync mode) and the lifecycle completion handler (async mode).
+Step durations are recorded as Automation.<step> metrics and the whole
+run as AutomationRuntime.
+"""
+
+def step_timings(execution):
+    """
+    Return an ordered list of (step name, status, seconds) from a
+    get_automation_execution response's AutomationExecution.
+    """
+    timings = []
+    for step in execution.get('StepExecutions', []):
+        start = step.get('ExecutionStartTime')
+        end = step.get('ExecutionEndTime')
+        seconds = round((end - start).total_seconds(), 1) if start and end else None
+        timings.append((step['StepName'], step.get('StepStatus', ''), seconds))
+    return timings
+
+def log_step_timings(execution):
+    timings = step_timings(execution)
+    for name, status, seconds in timings:
+        LOGGER.info("Automation step {0}: {1} in {2}s".format(name, status, seconds))
+        metrics.put("Automation.{0}".format(name), seconds)
+    start = execution.get('ExecutionStartTime')
+    end = execution.get('ExecutionEndTime')
+    if start and end:
+        LOGGER.info("Automation time-to-ready: {0}s".format(round((end - start).total_seconds(), 1)))
+        metrics.put('AutomationRuntime', (end - start).total_seconds())
+    LOGGER.info("Automation step timings: {0}".format(json.dumps(timings)))
+    return timings
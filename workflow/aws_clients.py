@@ -0,0 +1,169 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import boto3
+import json
+import logging
+import os
+import re
+import threading
+import time
+from botocore.config import Config
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottledException', 'ProvisionedThroughputExceededException']
+# Calls per second per API family, per container.  SSM's shared read
+# limits are the tightest ones we hit during a scale-out.
+DEFAULT_RATE_LIMITS = {
+    'ssm:Get': 10,
+    'ssm:List': 5,
+    'ssm:Describe': 5,
+    'ssm:Send': 3,
+    'ssm:Start': 3,
+    'ssm:Put': 3,
+    'ec2:Describe': 10,
+    'default': 20
+}
+
+# Env variables
+max_attempts = int(os.environ.get('CLIENT_MAX_ATTEMPTS', '10'))
+pool_size = int(os.environ.get('CLIENT_POOL_SIZE', '10'))
+connect_timeout = int(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))
+read_timeout = int(os.environ.get('CLIENT_READ_TIMEOUT', '30'))
+rate_limits = dict(DEFAULT_RATE_LIMITS, **json.loads(os.environ.get('CLIENT_RATE_LIMITS', '{}')))
+
+"""
+Shared boto3 client factory for the Lambda functions.
+
+Clients use adaptive retry mode, so throttled calls back off and retry
+instead of failing the lifecycle action, and every call first takes a
+token from a client-side bucket for its API family (service plus leading
+verb, e.g. ssm:Get), which spreads bursts out before they reach the
+service.  Budgets come from CLIENT_RATE_LIMITS, a JSON map of
+"service:Operation", "service:Verb", "service" or "default" to calls per
+second, and apply per container.
+
+Call, throttle, retry and failure counts and the time spent in calls are
+kept per API family; handlers log them with log_stats, and metrics.py
+reports each invocation's share.
+"""
+
+class TokenBucket(object):
+    """Refills at rate tokens per second, holding at most one second's worth."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available.  Returns the wait in seconds."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+_lock = threading.Lock()
+_buckets = {}
+stats = {}
+
+def api_family(service, operation):
+    verb = re.match(r'[A-Z][a-z]*', operation)
+    return "{0}:{1}".format(service, verb.group(0) if verb else operation)
+
+def family_rate(service, operation):
+    for key in ["{0}:{1}".format(service, operation), api_family(service, operation), service, 'default']:
+        if key in rate_limits:
+            return rate_limits[key]
+
+def _count(family, counter, amount=1):
+    with _lock:
+        counters = stats.setdefault(family, {'calls': 0, 'throttled': 0, 'retries': 0, 'failures': 0, 'wait': 0.0, 'latency': 0.0})
+        counters[counter] += amount
+
+def _bucket(service, operation):
+    key = "{0}:{1}".format(service, operation)
+    with _lock:
+        if key not in _buckets:
+            family = api_family(service, operation)
+            # Operations without their own budget share the family bucket
+            if key not in rate_limits:
+                key = family
+            if key not in _buckets:
+                _buckets[key] = TokenBucket(family_rate(service, operation))
+        return _buckets[key]
+
+def client(service, endpoint_url=None):
+    config = Config(
+        retries={'max_attempts': max_attempts, 'mode': 'adaptive'},
+        max_pool_connections=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout
+    )
+    c = boto3.client(service, config=config, endpoint_url=endpoint_url)
+
+    def before_call(model, context=None, **kwargs):
+        family = api_family(service, model.name)
+        _count(family, 'calls')
+        waited = _bucket(service, model.name).acquire()
+        if waited > 0:
+            _count(family, 'wait', waited)
+        if context is not None:
+            # Latency covers the call and its retries, not the rate limiter wait
+            context.setdefault('aws_clients_start', time.time())
+
+    def add_latency(family, context):
+        if context is not None and 'aws_clients_start' in context:
+            _count(family, 'latency', time.time() - context['aws_clients_start'])
+
+    def needs_retry(response=None, operation=None, **kwargs):
+        if response is not None and operation is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLE_CODES:
+                _count(api_family(service, operation.name), 'throttled')
+                LOGGER.warn("Throttled on {0}:{1} ({2})".format(service, operation.name, code))
+
+    def after_call(model, parsed, context=None, **kwargs):
+        family = api_family(service, model.name)
+        add_latency(family, context)
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            _count(family, 'retries', retries)
+
+    def after_call_error(exception, event_name, context=None, **kwargs):
+        # Calls that still failed after all retries
+        family = api_family(service, event_name.split('.')[-1])
+        add_latency(family, context)
+        _count(family, 'failures')
+
+    c.meta.events.register('before-call', before_call)
+    c.meta.events.register('needs-retry', needs_retry)
+    c.meta.events.register('after-call', after_call)
+    c.meta.events.register('after-call-error', after_call_error)
+    return c
+
+def snapshot():
+    """Copy of the per-family counters."""
+    with _lock:
+        return dict((family, dict(counters)) for family, counters in stats.items())
+
+def log_stats():
+    totals = snapshot()
+    for family in sorted(totals):
+        counters = totals[family]
+        counters['wait'] = round(counters['wait'], 2)
+        counters['latency'] = round(counters['latency'], 2)
+        LOGGER.info("AWS calls {0}: {1}".format(family, json.dumps(counters, sort_keys=True)))
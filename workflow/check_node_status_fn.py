@@ -1,91 +1,153 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
+import command_journal
 import json
 import logging
 import traceback
+import metrics
 import os
+import ssm_command
 import time
 
 # Create AWS clients
-ssm = boto3.client('ssm')
+ssm = aws_clients.client('ssm')
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
+HYDRATION_MARKER = 'HYDRATION '
+# Progress of the data volume prewarm started by the node bootstrap
+# automation, as percent and chunks read; nodes that never started one
+# report 100.
+HYDRATION_CMD = ('T=$(cat /var/lib/mongo-hydration/total 2>/dev/null || echo 0); '
+    'D=$(cat /var/lib/mongo-hydration/done 2>/dev/null | wc -l); '
+    'if [ "$T" -gt 0 ]; then echo "' + HYDRATION_MARKER + '$((D * 100 / T)) $D"; else echo "' + HYDRATION_MARKER + '100 0"; fi')
 
 # Env variables
-docname = 'AWS-RunShellScript'
+hydration_threshold = int(os.environ.get('HYDRATION_THRESHOLD', '90'))
+hydration_timeout_secs = int(os.environ.get('HYDRATION_TIMEOUT_SECS', '7200'))
 
 """
 Event should be a JSON document:
 
 { 
-    nodes: {
-        id: [
-            instance id,
-            instance id
-        ]
-    }
+    id: [
+        instance id,
+        instance id
+    ],
+    status: previous output of this function, when looping
 }
 
-We'll only receive the instance ID list.
+We'll receive the nodes part of the workflow state.
+
+Output is the overall status plus per-node readiness and data volume
+hydration percentage.  Status codes: 1 = all nodes ready, 0 = some node
+is not running mongod, 3 = mongod is running everywhere but some data
+volume is still below HYDRATION_THRESHOLD percent prewarmed.
+
+A prewarm that read no new chunks since the previous check is stalled
+(its background reads died, e.g. on a reboot), and is no longer waited
+for.  Neither is any prewarm once HYDRATION_TIMEOUT_SECS have passed
+since the first check; the member is then added with its data volume
+partly cold.
+
+{
+    "code": 1,
+    "ready": {
+        instance id: 1,
+        instance id: 0
+    },
+    "hydration": {
+        instance id: 100,
+        instance id: 42
+    },
+    "chunks": {
+        instance id: 0,
+        instance id: 42
+    },
+    "stalled": [],
+    "started_at": 1546475202000
+}
 """
+
+def parse_hydration(stdout_content):
+    """Return (percent, chunks read) from the HYDRATION_CMD output."""
+    for line in stdout_content.splitlines():
+        if line.startswith(HYDRATION_MARKER):
+            fields = line[len(HYDRATION_MARKER):].split()
+            return int(fields[0]), int(fields[1]) if len(fields) > 1 else 0
+    return 0, 0
+
 def handler(event, context):
 
     try:
-        LOGGER.info("SFN metadata: {0} (type = {1})".format(json.dumps(event), type(event)))
-        instanceids = event
+        metrics.begin(context)
+        metrics.log_event("SFN metadata", event)
+        event, journal_key = command_journal.unwrap(event)
+        journal = command_journal.open_journal(ssm, journal_key)
+        if journal_key is not None:
+            metrics.set_dimensions(journal_key['project'], journal_key['environment'], journal_key['role'])
+        instanceids = event['id']
+        previous = event.get('status') or {}
+        now = int(time.time() * 1000)
+        started_at = previous.get('started_at', now)
 
         LOGGER.info("instance-id: %s" % instanceids)
 
         LOGGER.info("Starting doc execution") 
-        response = ssm.send_command(
-            InstanceIds = instanceids,
-            DocumentName = docname,
-            TimeoutSeconds = 30,
-            Parameters = {
-                'commands': ['ps -q `cat /var/run/mongodb/mongod.pid`']
-            },
-        )
-        command_id = response['Command']['CommandId']
-        LOGGER.info("Doc command id: {0}".format(command_id))
-
-        # We need to wait a minute to let the command invocation show up
-        time.sleep(5)
+        command_id, resumed = ssm_command.send_or_resume(ssm, instanceids,
+            ['ps -q `cat /var/run/mongodb/mongod.pid`', HYDRATION_CMD], journal=journal)
+
+        results = ssm_command.wait_for_command_all(ssm, command_id, instanceids, context, resumed)
 
         overall_status = 1 # success
+        ready = {}
+        hydration = {}
+        chunks = {}
         for iid in instanceids:
-            while True:
-                LOGGER.info("Checking command status for node {0}".format(iid))
-                response = ssm.get_command_invocation( CommandId=command_id, InstanceId = iid)
-                status = response['Status']
-                if status == 'Failed':
-                    LOGGER.info("Node {0} not ready: {1}".format(iid, response['StatusDetails']))
-                    overall_status = 0
-                    break
-                if status == 'TimedOut':
-                    LOGGER.info("Node {0} not ready: {1}".format(iid, response['StatusDetails']))
-                    overall_status = 0
-                    break
-                if status == 'Success':
-                    stdout_content = response['StandardOutputContent']
-                    if "mongod" in stdout_content:
-                        LOGGER.info("Node ready (mongod running): {0}".format(iid))
-                    else:
-                        LOGGER.info("Node not ready (mongod not running): {0} - {1}".format(iid, stdout_content))
-                        overall_status = 0
-                    break
-                time.sleep(5)
-
-        if overall_status == 1:
+            result = results[iid]
+            hydration[iid], chunks[iid] = parse_hydration(result.stdout)
+            if not result.ok:
+                LOGGER.info("Node {0} not ready: {1} {2}".format(iid, result.status, result.status_details))
+                ready[iid] = 0
+            elif "mongod" in result.stdout:
+                LOGGER.info("Node ready (mongod running): {0}, data volume {1}% hydrated".format(iid, hydration[iid]))
+                ready[iid] = 1
+            else:
+                LOGGER.info("Node not ready (mongod not running): {0} - {1}".format(iid, result.stdout))
+                ready[iid] = 0
+            if ready[iid] == 0:
+                overall_status = 0
+
+        hydrating = [iid for iid in instanceids if hydration[iid] < hydration_threshold]
+        before = previous.get('chunks', {})
+        stalled = [iid for iid in hydrating if iid in before and chunks[iid] <= before[iid]]
+        metrics.put('Nodes', len(instanceids), 'Count')
+        metrics.put('NodesReady', len([iid for iid in instanceids if ready[iid] == 1]), 'Count')
+        metrics.put('NodesHydrating', len(hydrating), 'Count')
+        metrics.put('NodesHydrationStalled', len(stalled), 'Count')
+        if instanceids:
+            metrics.put('MinHydration', min(hydration.values()), 'Percent')
+        if stalled:
+            LOGGER.warn("Hydration stalled, not waiting for it: {0}".format(stalled))
+        waiting = [iid for iid in hydrating if iid not in stalled]
+        if overall_status == 1 and waiting and (now - started_at) / 1000.0 > hydration_timeout_secs:
+            LOGGER.warn("Nodes still hydrating after {0}s, not waiting for them: {1}".format(hydration_timeout_secs, waiting))
+        elif overall_status == 1 and waiting:
+            LOGGER.info("Nodes still hydrating: {0}".format(waiting))
+            overall_status = 3
+        elif overall_status == 1:
             LOGGER.info("All nodes ready")
         else:
-            LOGGER.info("All nodes not ready")
-        return overall_status
+            LOGGER.info("Nodes not ready: {0}".format([iid for iid in instanceids if ready[iid] == 0]))
+        return {'code': overall_status, 'ready': ready, 'hydration': hydration, 'chunks': chunks,
+            'stalled': stalled, 'started_at': started_at}
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed checking node status {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
-        return 0
-
+        return {'code': 0, 'ready': {}, 'hydration': {}, 'chunks': {}, 'stalled': [], 'started_at': 0}
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
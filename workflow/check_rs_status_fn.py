@@ -1,22 +1,29 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
+import command_journal
 import json
 import logging
 import traceback
+import metrics
 import os
-import time
+import ssm_command
 
 # Create AWS clients
-ssm = boto3.client('ssm')
+ssm = aws_clients.client('ssm')
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
+MONGO_PORT = '27017'
+HEALTHY_STATES = ['PRIMARY', 'SECONDARY', 'ARBITER']
+STATUS_MARKER = 'RSSTATUS '
+MEMBER_MARKER = 'RSMEMBER '
+MAX_NODES_TRIED = 3
 
 # Env variables
-docname = 'AWS-RunShellScript'
+max_lag_secs = int(os.environ.get('MAX_LAG_SECS', '30'))
 
 """
 Event should be a JSON document:
@@ -38,73 +45,163 @@ Event should be a JSON document:
     "role": role
 }
 
+
+The status is read from the first node, in inventory order, that is a
+member of the replica set.  A node that replaced a removed member reports
+NotYetInitialized or REMOVED and cannot see the others, so up to
+MAX_NODES_TRIED nodes are asked.  The replica set is only initialized
+when every node asked reports NotYetInitialized.
+
+Output summarizes the replica set as seen by that node:
+
+{
+    "code": 2,
+    "missing_nodes": [ dns name ],
+    "unhealthy": [ dns name ],
+    "lagging": [ dns name ],
+    "primary": dns name,
+    "members": {
+        "dns name:27017": {
+            "state": "SECONDARY",
+            "health": 1,
+            "optime": 1546475202000,
+            "syncSource": "dns name:27017"
+        }
+    }
+}
 """
+
+# Print a header with the member count, then one compact JSON line per
+# member rather than the shell's extended JSON, so large replica sets can be
+# parsed line by line and a cut-off listing is detected instead of being
+# read as missing members.
+STATUS_SCRIPT = ('var s = rs.status(); var members = s.members || []; '
+    'print("' + STATUS_MARKER + '" + JSON.stringify({ ok: s.ok, codeName: s.codeName || "", count: members.length })); '
+    'members.forEach(function(m) { print("' + MEMBER_MARKER + '" + JSON.stringify({ '
+    'host: m.name, state: m.stateStr, health: m.health, '
+    'optime: m.optimeDate ? m.optimeDate.getTime() : null, '
+    'syncSource: m.syncingTo || m.syncSourceHost || "" })); });')
+
+def parse_status(lines):
+    """Assemble the status printed by STATUS_SCRIPT from its output lines."""
+    status, members = ssm_command.read_listing(lines, STATUS_MARKER, MEMBER_MARKER)
+    status['members'] = members
+    return status
+
+def index_members(status):
+    """Index rs.status() members by host:port."""
+    members = {}
+    for m in status['members']:
+        members[m['host']] = {
+            'state': m['state'],
+            'health': m['health'],
+            'optime': m['optime'],
+            'syncSource': m['syncSource']
+        }
+    return members
+
+def summarize(members, dnsnames):
+    """Classify the expected nodes against the member index."""
+    missing_nodes = []
+    unhealthy = []
+    lagging = []
+    primary = ''
+    primary_optime = None
+    for host, m in members.items():
+        if m['state'] == 'PRIMARY':
+            primary = host.rsplit(':', 1)[0]
+            primary_optime = m['optime']
+    for dnsname in dnsnames:
+        m = members.get(dnsname + ':' + MONGO_PORT)
+        if m is None:
+            missing_nodes.append(dnsname)
+            continue
+        if m['health'] != 1 or m['state'] not in HEALTHY_STATES:
+            unhealthy.append(dnsname)
+        elif primary_optime is not None and m['optime'] is not None and \
+                (primary_optime - m['optime']) / 1000.0 > max_lag_secs:
+            lagging.append(dnsname)
+    return {'missing_nodes': missing_nodes, 'unhealthy': unhealthy, 'lagging': lagging, 'primary': primary}
+
+def read_status(instanceids, context, journal):
+    """
+    Return (instance id, status) from the first node that sees the replica
+    set, (None, status) when every node asked is not initialized, and
+    (None, None) otherwise.
+    """
+    tried = instanceids[:MAX_NODES_TRIED]
+    status = None
+    not_initialized = 0
+    for iid in tried:
+        result = ssm_command.run_command(ssm, iid, ["mongo --quiet --eval '{0}'".format(STATUS_SCRIPT)], context, journal=journal)
+        if not result.ok:
+            LOGGER.info("RS {0} check error: {1}".format(iid, result.status_details))
+            continue
+        status = parse_status(result.lines())
+        if status['ok'] == 1:
+            return iid, status
+        if status['codeName'] == 'NotYetInitialized':
+            not_initialized += 1
+        else:
+            # REMOVED, InvalidReplicaSetConfig and the like say nothing
+            # about the other members, so don't read them as missing
+            LOGGER.warn("RS {0} status error: {1}".format(iid, status['codeName']))
+    if tried and not_initialized == len(tried):
+        return None, status
+    return None, None
+
 def handler(event, context):
 
     try:
-        LOGGER.info("SFN metadata: {0} (type = {1})".format(json.dumps(event), type(event)))
+        metrics.begin(context)
+        metrics.log_event("SFN metadata", event)
+        event, journal_key = command_journal.unwrap(event)
+        journal = command_journal.open_journal(ssm, journal_key)
+        metrics.set_dimensions(event['project'], event['environment'], event['role'])
         instanceids = event['nodes']['id']
         dnsnames = event['nodes']['dns']
-        iid = instanceids[0]
 
         LOGGER.info("instance-id: %s" % instanceids)
 
         LOGGER.info("Starting doc execution") 
-        response = ssm.send_command(
-            InstanceIds = [iid],
-            DocumentName = docname,
-            TimeoutSeconds = 30,
-            Parameters = {
-                'commands': ['mongo --eval "rs.status()"']
-            },
-        )
-        command_id = response['Command']['CommandId']
-        LOGGER.info("Doc command id: {0}".format(command_id))
-
-        # We need to wait a minute to let the command invocation show up
-        time.sleep(5)
+        iid, status = read_status(instanceids, context, journal)
 
         # Status codes: 1 = not initialized, 2 = need to add nodes, 0 = other/nothing to do
-        overall_status = 1 # not initialized
-        missing_nodes = []
-        while True:
-            LOGGER.info("Checking command status for node {0}".format(iid))
-            response = ssm.get_command_invocation( CommandId=command_id, InstanceId = iid)
-            status = response['Status']
-            if status == 'Failed':
-                LOGGER.info("RS {0} check error: {1}".format(iid, response['StatusDetails']))
-                overall_status = 0
-                break
-            if status == 'TimedOut':
-                LOGGER.info("RS {0} check error: {1}".format(iid, response['StatusDetails']))
-                overall_status = 0
-                break
-            if status == 'Success':
-                stdout_content = response['StandardOutputContent']
-                for dnsname in dnsnames:
-                    if dnsname not in stdout_content:
-                        missing_nodes.append(dnsname)
-                if "NotYetInitialized" in stdout_content:
-                    LOGGER.info("RS ready for init: {0}".format(iid))
-                    overall_status = 1
-                elif len(missing_nodes) > 0:
-                    LOGGER.info("RS needs new nodes: {0} - {1}".format(iid, missing_nodes))
-                    overall_status = 2
-                else:
-                    LOGGER.info("RS not ready for init: {0} - {1}".format(iid, stdout_content))
-                    overall_status = 0
-                break
-            time.sleep(5)
-
-        if overall_status == 1:
-            LOGGER.info("RS ready for init")
-        elif overall_status == 2:
-            LOGGER.info("RS missing nodes")
+        rsstatus = {'code': 0, 'missing_nodes': [], 'unhealthy': [], 'lagging': [], 'primary': '', 'members': {}}
+        if iid is None and status is not None:
+            LOGGER.info("RS ready for init: {0}".format(instanceids[:MAX_NODES_TRIED]))
+            rsstatus['code'] = 1
+            return rsstatus
+        if iid is None:
+            LOGGER.warn("No node could report the RS status: {0}".format(instanceids[:MAX_NODES_TRIED]))
+            return rsstatus
+
+        rsstatus['members'] = index_members(status)
+        rsstatus.update(summarize(rsstatus['members'], dnsnames))
+        metrics.put('Nodes', len(dnsnames), 'Count')
+        metrics.put('Members', len(rsstatus['members']), 'Count')
+        metrics.put('MissingMembers', len(rsstatus['missing_nodes']), 'Count')
+        metrics.put('UnhealthyMembers', len(rsstatus['unhealthy']), 'Count')
+        metrics.put('LaggingMembers', len(rsstatus['lagging']), 'Count')
+        LOGGER.info("RS primary: {0}, unhealthy: {1}, lagging: {2}".format(
+            rsstatus['primary'], rsstatus['unhealthy'], rsstatus['lagging']))
+        if len(rsstatus['missing_nodes']) > 0 and not rsstatus['primary']:
+            # rs.add needs a primary, and there is none during an election
+            LOGGER.warn("RS has no primary, not adding nodes: {0}".format(rsstatus['missing_nodes']))
+        elif len(rsstatus['missing_nodes']) > 0:
+            LOGGER.info("RS needs new nodes: {0} - {1}".format(iid, rsstatus['missing_nodes']))
+            rsstatus['code'] = 2
         else:
-            LOGGER.info("RS not ready for init")
-        return {'code': overall_status, 'missing_nodes': missing_nodes }
+            LOGGER.info("RS has all nodes: {0}".format(iid))
+        return rsstatus
+    except ssm_command.CommandTimeoutException as e:
+        # Fail the task so the state machine retries it; the retry resumes the command
+        LOGGER.warn("Command still running: {0}".format(str(e)))
+        raise e
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed checking RS status {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
-        return {'code': 0, 'missing_nodes': []}
-
+        return {'code': 0, 'missing_nodes': [], 'unhealthy': [], 'lagging': [], 'primary': '', 'members': {}}
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
@@ -0,0 +1,111 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import logging
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+"""
+Journal of the Run Commands sent by the state machine's Lambda functions,
+so that a retried task resumes the command its first attempt sent instead
+of sending it again (a second rs.initiate or rs.add while the first is
+still running on the primary).
+
+The state machine passes each task its execution, state name and state
+entry time alongside the input:
+
+{
+    "input": the task input,
+    "journal": {
+        "execution": execution ARN,
+        "state": "AddNodeToRs",
+        "entered": "2019-01-07T15:04:10.123Z",
+        "project": project,
+        "environment": environment,
+        "role": role
+    }
+}
+
+Retries of a task share its entry time, while a state entered again by a
+loop gets a new one.  Commands are identified by their target and a hash
+of their text, and the journal lives in the uncached SSM parameter
+/Project/Environment/Role/commandjournal.  Executions for a replica set
+never overlap, so the parameter only holds the current execution's
+latest entry of each state:
+
+{
+    "execution": execution ARN,
+    "states": {
+        "AddNodeToRs": {
+            "entered": "2019-01-07T15:04:10.123Z",
+            "commands": { "i-0123456789abcdef0/3f2a9c1b7d4e": command ID }
+        }
+    }
+}
+
+Journal failures are logged and otherwise ignored: without the journal a
+retry simply sends the command again.
+"""
+
+def unwrap(event):
+    """Split a task event into (input, journal key); plain events have no key."""
+    if isinstance(event, dict) and 'input' in event and 'journal' in event:
+        return event['input'], event['journal']
+    return event, None
+
+def journal_name(key):
+    return "/{0}/{1}/{2}/commandjournal".format(key['project'], key['environment'], key['role'])
+
+def command_key(instance_ids, commands):
+    # A fleet-wide command is the only one of its kind in a state entry
+    target = instance_ids[0] if len(instance_ids) == 1 else 'all'
+    digest = hashlib.sha1('\n'.join(commands).encode('utf-8')).hexdigest()[:12]
+    return "{0}/{1}".format(target, digest)
+
+class Journal(object):
+
+    def __init__(self, ssm, key):
+        self.ssm = ssm
+        self.key = key
+        self.document = None
+
+    def load(self):
+        if self.document is None:
+            self.document = {}
+            try:
+                response = self.ssm.get_parameter(Name=journal_name(self.key))
+                self.document = json.loads(response['Parameter']['Value'])
+            except self.ssm.exceptions.ParameterNotFound:
+                pass
+            except Exception as e:
+                LOGGER.warn("Could not read command journal: {0}".format(str(e)))
+        if self.document.get('execution') != self.key['execution']:
+            self.document = {'execution': self.key['execution'], 'states': {}}
+        state = self.document['states'].get(self.key['state'])
+        if state is None or state['entered'] != self.key['entered']:
+            state = {'entered': self.key['entered'], 'commands': {}}
+            self.document['states'][self.key['state']] = state
+        return state
+
+    def lookup(self, instance_ids, commands):
+        """Return the command ID an earlier attempt sent, or None."""
+        return self.load()['commands'].get(command_key(instance_ids, commands))
+
+    def record(self, instance_ids, commands, command_id):
+        self.load()['commands'][command_key(instance_ids, commands)] = command_id
+        try:
+            self.ssm.put_parameter(
+                Name=journal_name(self.key),
+                Value=json.dumps(self.document),
+                Type='String',
+                Overwrite=True
+            )
+        except Exception as e:
+            LOGGER.warn("Could not record command {0} in journal: {1}".format(command_id, str(e)))
+
+def open_journal(ssm, key):
+    return Journal(ssm, key) if key else None
@@ -0,0 +1,101 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import json
+import logging
+import traceback
+import os
+import automation_timing
+import metrics
+
+# Create AWS clients
+asg = aws_clients.client('autoscaling')
+ssm = aws_clients.client('ssm')
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+TEST = 'test'
+CONTINUE_STATUSES = ['Success']
+ABANDON_STATUSES = ['Failed', 'TimedOut', 'Cancelled']
+
+"""
+Completes the ASG lifecycle action once the node bootstrap automation
+started by the lifecycle Lambda (index.py, async mode) reaches a terminal
+status.  The same goes for the warm pool documents (warm_rs_server and
+resume_rs_server).  The lifecycle hook details travel as automation
+parameters.
+
+Example input (EventBridge automation status-change event):
+{
+  "version": "0",
+  "id": "3b9d6d3a-8b65-4b8b-9a3e-4b0c1d2e3f40",
+  "detail-type": "EC2 Automation Execution Status-change Notification",
+  "source": "aws.ssm",
+  "account": "111111111111",
+  "time": "2019-01-07T15:04:10Z",
+  "region": "us-west-2",
+  "resources": [],
+  "detail": {
+    "ExecutionId": "4f1a7c2e-0c8d-4a57-9d7a-0e1f2a3b4c5d",
+    "Definition": "init_rs_server",
+    "DefinitionVersion": 1.0,
+    "Status": "Success",
+    "StartTime": "2019-01-07T15:00:12Z",
+    "EndTime": "2019-01-07T15:04:09Z",
+    "Time": 237000.0,
+    "ExecutedBy": "arn:aws:sts::111111111111:assumed-role/lambda_role/lifecycle_fn"
+  }
+}
+"""
+
+def param(parameters, name):
+    values = parameters.get(name) or ['']
+    return values[0]
+
+def handler(event, context):
+
+    try:
+        metrics.begin(context)
+        metrics.log_event("Automation event", event)
+        execution_id = event['detail']['ExecutionId']
+        status = event['detail']['Status']
+
+        response = ssm.get_automation_execution(AutomationExecutionId=execution_id)
+        parameters = response['AutomationExecution']['Parameters']
+        hookname = param(parameters, 'LifecycleHookName')
+        asgname = param(parameters, 'AutoScalingGroupName')
+        token = param(parameters, 'LifecycleActionToken')
+        instanceid = param(parameters, 'InstanceId')
+        if param(parameters, 'Project'):
+            metrics.set_dimensions(param(parameters, 'Project'), param(parameters, 'Environment'), param(parameters, 'Role'))
+
+        if status in CONTINUE_STATUSES:
+            result = 'CONTINUE'
+        elif status in ABANDON_STATUSES:
+            result = 'ABANDON'
+        else:
+            LOGGER.info("Execution {0} not finished: {1}".format(execution_id, status))
+            return
+        LOGGER.info("Execution {0} for {1} ended with {2}".format(execution_id, instanceid, status))
+        automation_timing.log_step_timings(response['AutomationExecution'])
+
+        if token == '' or token.lower() == TEST:
+            LOGGER.info("No lifecycle action to complete for {0}".format(instanceid))
+            return
+
+        LOGGER.info("Sending lifecycle {0} hook".format(result))
+        asg.complete_lifecycle_action(
+            LifecycleHookName=hookname,
+            AutoScalingGroupName=asgname,
+            LifecycleActionToken=token,
+            LifecycleActionResult=result
+        )
+    except Exception as e:
+        trc = traceback.format_exc()
+        LOGGER.error("Failed completing lifecycle action {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
+        raise e
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
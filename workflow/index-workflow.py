@@ -1,29 +1,53 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
 import json
 import logging
 import traceback
+import metrics
+import param_cache
 import os
+import re
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Create AWS clients
-sfn = boto3.client('stepfunctions')
-ssm = boto3.client('ssm')
+sfn = aws_clients.client('stepfunctions')
+ssm = aws_clients.client('ssm')
+sqs = aws_clients.client('sqs')
+
+# Used to page through the inventory paths side by side
+pool = ThreadPoolExecutor(max_workers=2)
 
 # Environment variables
 sfn_arn = os.environ['SFN_ARN']
+queueurl = os.environ['QUEUEURL']
+expected_run_secs = int(os.environ.get('EXPECTED_RUN_SECS', '60'))
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
-TIME_BUFFER_MS = 1000 # leave this much time to call SFN
+MIN_DELAY_SECS = 5
+MAX_DELAY_SECS = 900 # SQS DelaySeconds limit
+REQUEUES = 'Requeues' # message attribute counting the requeues so far
 
 """
-This function needs to check if the step function is already executing.
-If so, requeue the message.
-Otherwise, invoke the workflow.
+This function needs to check if the step function is already executing
+for a replica set.  If so, requeue that replica set's messages.
+Otherwise, invoke the workflow once per replica set in the batch.
+
+Executions are named after their replica set, so only executions for the
+same project/environment/role are serialized; unrelated replica sets can
+reconfigure in parallel.  The function's reserved concurrency of one keeps
+the check-then-start sequence atomic.
+
+Rather than waiting for a running execution, we send one message for the
+replica set back to the queue and return.  The delay covers the rest of
+EXPECTED_RUN_SECS and doubles with every requeue, up to the SQS maximum,
+so a replica set waiting for hydration or initial sync is not polled every
+few seconds for hours.
 
 Example input:
 {
@@ -73,7 +97,7 @@ Example input:
   ]
 }
 
-Example output:
+Example output (state machine input, one per replica set):
 {
     "nodes": {
         "id": [
@@ -83,6 +107,10 @@ Example output:
         "dns": [
             dns name,
             dns name
+        ],
+        "index": [
+            member index,
+            member index
         ]
       },
       "project": project,
@@ -91,79 +119,184 @@ Example output:
 }
 """
 
-class WorkflowAlreadyRunningException(Exception): pass
+def get_indexed_parameters(path):
+    """
+    Return {member index: value} for every parameter under path, following
+    NextToken.  The member index is the last segment of the parameter name.
+    """
+    values = {}
+    kwargs = {'Path': path, 'Recursive': True}
+    while True:
+        response = ssm.get_parameters_by_path(**kwargs)
+        for param in response['Parameters']:
+            values[param['Name'].rsplit('/', 1)[1]] = param['Value']
+        if not response.get('NextToken'):
+            return values
+        kwargs['NextToken'] = response['NextToken']
+
+def cached_indexed_parameters(path):
+    return param_cache.cached("path:" + path, lambda: get_indexed_parameters(path))
+
+def member_order(idx):
+    return (0, int(idx), idx) if idx.isdigit() else (1, 0, idx)
+
+def load_inventory(project, environment, role):
+    """
+    Load the instance IDs and DNS names for a replica set concurrently and
+    join them by member index, so position N in both lists is the same node.
+    Both listings are cached between warm invocations.
+    """
+    prefix = "/{0}/{1}/{2}".format(project, environment, role)
+    # The lifecycle function bumps the version whenever it records a new
+    # instance ID, so a replaced node is never served from the cache.
+    param_cache.check_version(ssm, prefix)
+    ids = pool.submit(cached_indexed_parameters, prefix + "/instanceid/")
+    dns = pool.submit(cached_indexed_parameters, prefix + "/dns/")
+    ids = ids.result()
+    dns = dns.result()
+
+    nodes = {'id': [], 'dns': [], 'index': []}
+    for idx in sorted(set(ids) | set(dns), key=member_order):
+        if idx not in ids or idx not in dns:
+            LOGGER.warn("Skipping member {0}: instance ID {1}, DNS {2}".format(idx, ids.get(idx), dns.get(idx)))
+            continue
+        nodes['id'].append(ids[idx])
+        nodes['dns'].append(dns[idx])
+        nodes['index'].append(idx)
+    return nodes
+
+def group_records(records):
+    """Group node ready messages by (project, environment, role), keeping arrival order."""
+    groups = OrderedDict()
+    for record in records:
+        attributes = record['messageAttributes']
+        key = (attributes['Project']['stringValue'], attributes['Environment']['stringValue'], attributes['Role']['stringValue'])
+        groups.setdefault(key, []).append(record)
+    return groups
+
+def batch_failures(records):
+    return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records]}
+
+def execution_prefix(project, environment, role):
+    name = "{0}_{1}_{2}_".format(project, environment, role)
+    return re.sub(r'[^A-Za-z0-9_-]', '-', name)
+
+def execution_name(project, environment, role):
+    # Execution names must be unique and at most 80 characters
+    suffix = str(int(time.time() * 1000))
+    return execution_prefix(project, environment, role)[:80 - len(suffix)] + suffix
+
+def running_executions():
+    """Return {name: start time} for all running executions of the state machine."""
+    executions = {}
+    kwargs = {'stateMachineArn': sfn_arn, 'statusFilter': 'RUNNING'}
+    while True:
+        response = sfn.list_executions(**kwargs)
+        for e in response['executions']:
+            executions[e['name']] = e['startDate']
+        if not response.get('nextToken'):
+            return executions
+        kwargs['nextToken'] = response['nextToken']
+
+def running_since(executions, project, environment, role):
+    """Return the start time of the replica set's running execution, or None."""
+    prefix = execution_prefix(project, environment, role)
+    # Require a bare timestamp after the prefix so role "a" does not match "a_b"
+    for name, start in executions.items():
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            return start
+    return None
+
+def requeue_count(records):
+    counts = [int(r['messageAttributes'][REQUEUES]['stringValue']) for r in records if REQUEUES in r['messageAttributes']]
+    return max(counts) if counts else 0
+
+def requeue_delay(started, requeues):
+    """
+    Delay the retry until the running execution is expected to be done,
+    backing off exponentially once it has run longer than that.
+    """
+    age = time.time() - started.timestamp()
+    backoff = MIN_DELAY_SECS * 2 ** min(requeues, 10)
+    return int(max(MIN_DELAY_SECS, min(MAX_DELAY_SECS, max(expected_run_secs - age, backoff))))
+
+def requeue(record, delay, requeues):
+    attributes = {}
+    for name, value in record['messageAttributes'].items():
+        attributes[name] = {'DataType': value['dataType'], 'StringValue': value['stringValue']}
+    attributes[REQUEUES] = {'DataType': 'Number', 'StringValue': str(requeues)}
+    sqs.send_message(
+        QueueUrl=queueurl,
+        MessageBody=record['body'],
+        MessageAttributes=attributes,
+        DelaySeconds=delay
+    )
+
+def start_workflow(project, environment, role):
+    LOGGER.info("Looking up instance IDs and DNS names")
+    with metrics.timer('InventoryLookup'):
+        nodes = load_inventory(project, environment, role)
+    LOGGER.info("Got inventory from SSM: {0}".format(json.dumps(nodes)))
+    metrics.put('Nodes', len(nodes['id']), 'Count')
+
+    sfn_input = {}
+    sfn_input['nodes'] = nodes
+    sfn_input['project'] = project
+    sfn_input['environment'] = environment
+    sfn_input['role'] = role
+
+    LOGGER.info("SFN input: {0}".format(json.dumps(sfn_input)))
+
+    response = sfn.start_execution(
+        stateMachineArn=sfn_arn,
+        name=execution_name(project, environment, role),
+        input=json.dumps(sfn_input)
+    )
+    LOGGER.info("Launched SFN execution {0}".format(response['executionArn']))
+    return response['executionArn']
 
 def handler(event, context):
 
     try:
-        LOGGER.info("SQS metadata: {0}".format(json.dumps(event)))
-        attributes = event['Records'][0]['messageAttributes']
-        role = attributes['Role']['stringValue']
-        project = attributes['Project']['stringValue']
-        environment = attributes['Environment']['stringValue']
-        iid = attributes['ID']['stringValue']
-        LOGGER.info("Got node ready message: {0}/{1}/{2}/{3}".format(project,environment,role, iid))
-
-        # In this loop, we first check if the function is close to timing out.
-        # If so, we raise an exception and quit.
-        # Otherwise, we check if any SFN executions are in progress.
-        # If so, we go through the loop again; otherwise we proceed.
-        while True:
-            LOGGER.info("Checking if SFN is running...")
-            response = sfn.list_executions(
-                stateMachineArn=sfn_arn,
-                statusFilter='RUNNING',
-                maxResults=1
-            )
-            numExecutions = len(response['executions'])
-            if numExecutions < 1:
-                break
-            timeRemaining = context.get_remaining_time_in_millis()
-            if timeRemaining < TIME_BUFFER_MS:
-                LOGGER.info("SFN is running, requeueing message")
-                raise WorkflowAlreadyRunningException("SFN workflow already running")
-            time.sleep(5)
-
-            
-        LOGGER.info("SFN is not running, invoking")
-
-        instance_list = []
-        LOGGER.info("Looking up instance IDs")
-        response = ssm.get_parameters_by_path(
-            Path="/{0}/{1}/{2}/instanceid/".format(project, environment, role),
-            Recursive=True
-        )
-        for param in response['Parameters']:
-            instance_list.append(param['Value'])
-
-        LOGGER.info("Getting DNS names from SSM")
-        dnsnames = []
-        response = ssm.get_parameters_by_path(
-            Path="/{0}/{1}/{2}/dns/".format(project, environment, role),
-            Recursive=True
-        )
-        for param in response['Parameters']:
-            dnsnames.append(param['Value'])
-        LOGGER.info("Got DNS from SSM: {0}".format(str(dnsnames)))
-
-        sfn_input = {}
-        sfn_input['nodes'] = {}
-        sfn_input['nodes']['id'] = instance_list
-        sfn_input['nodes']['dns'] = dnsnames
-        sfn_input['project'] = project
-        sfn_input['environment'] = environment
-        sfn_input['role'] = role
-
-        LOGGER.info("SFN input: {0}".format(json.dumps(sfn_input)))
-
-        response = sfn.start_execution(
-            stateMachineArn=sfn_arn,
-            input=json.dumps(sfn_input)
-        )
-        LOGGER.info("Launched SFN execution {0}".format(response['executionArn']))
-    except WorkflowAlreadyRunningException as wfe:
-        raise wfe
+        metrics.begin(context)
+        metrics.log_event("SQS metadata", event)
+        groups = group_records(event['Records'])
+        metrics.put('Messages', len(event['Records']), 'Count')
+        # Replica set dimensions only apply when the batch holds one replica set
+        if len(groups) == 1:
+            metrics.set_dimensions(*next(iter(groups)))
+        for (project, environment, role), records in groups.items():
+            ids = [record['messageAttributes']['ID']['stringValue'] for record in records]
+            LOGGER.info("Got node ready messages: {0}/{1}/{2}/{3}".format(project, environment, role, ids))
+
+        # One execution covers every node of a replica set in the batch, since
+        # the workflow reads the whole inventory anyway.  For the same reason
+        # a busy replica set only needs one of its messages requeued.
+        failed = []
+        LOGGER.info("Checking if SFN is running...")
+        executions = running_executions()
+        for (project, environment, role), records in groups.items():
+            try:
+                started = running_since(executions, project, environment, role)
+                if started is None:
+                    start_workflow(project, environment, role)
+                    metrics.put('ExecutionsStarted', 1, 'Count')
+                else:
+                    requeues = requeue_count(records)
+                    delay = requeue_delay(started, requeues)
+                    LOGGER.info("SFN is running for {0}/{1}/{2}, requeueing with {3}s delay".format(project, environment, role, delay))
+                    requeue(records[-1], delay, requeues + 1)
+                    metrics.put('RequeueDelay', delay)
+            except Exception as e:
+                trc = traceback.format_exc()
+                LOGGER.error("Failed handling messages for {0}/{1}/{2}: {3}\n\n{4}".format(project, environment, role, str(e), trc))
+                failed.extend(records)
+        return batch_failures(failed)
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed processing SQS event {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
         raise e
+    finally:
+        param_cache.log_stats()
+        aws_clients.log_stats()
+        metrics.flush()
@@ -1,36 +1,107 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
 import json
 import logging
 import traceback
 import os
 import time
+import automation_timing
+import metrics
+import param_cache
+import snapshot_index
+from concurrent.futures import ThreadPoolExecutor
 
 # Create AWS clients
-asg = boto3.client('autoscaling')
-ssm = boto3.client('ssm')
-ec2 = boto3.client('ec2')
+asg = aws_clients.client('autoscaling')
+ssm = aws_clients.client('ssm')
+ec2 = aws_clients.client('ec2')
+
+# Shared across warm invocations for the independent AWS calls below
+pool = ThreadPoolExecutor(max_workers=4)
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 TEST = 'test'
+WARM_POOL = 'WarmPool'
+# Per-type EBS limits: IOPS range, maximum IOPS per GiB, throughput range (MiB/s)
+VOLUME_LIMITS = {
+    'io1': {'min_iops': 100, 'max_iops': 64000, 'max_iops_per_gb': 50},
+    'io2': {'min_iops': 100, 'max_iops': 64000, 'max_iops_per_gb': 500},
+    'gp3': {'min_iops': 3000, 'max_iops': 16000, 'max_iops_per_gb': 500,
+            'min_throughput': 125, 'max_throughput': 1000}
+}
 
 # Env variables
 docname = os.environ['DOCNAME']
+warm_docname = os.environ['WARM_DOCNAME'] # instances entering an ASG warm pool
+resume_docname = os.environ['RESUME_DOCNAME'] # instances leaving it for service
 queueurl = os.environ['QUEUEURL']
 desired_iops = os.environ['PIOPS']
+wait_mode = os.environ.get('WAIT_MODE', 'async') # 'async' or 'sync'
+hydrate = os.environ.get('HYDRATE', 'true') # prewarm snapshot-restored data volumes
+
+def complete_lifecycle(hookname, asgname, token, result):
+    if token == TEST:
+        return
+    LOGGER.info("Sending lifecycle {0} hook".format(result))
+    asg.complete_lifecycle_action(
+        LifecycleHookName=hookname,
+        AutoScalingGroupName=asgname,
+        LifecycleActionToken=token,
+        LifecycleActionResult=result
+    )
+
+def volume_settings(policy, snapshot_size):
+    """
+    Choose volume type, size, IOPS and throughput from a storage policy:
+
+    {
+        "type": "gp3" | "io1" | "io2",
+        "min_size_gb": 100,
+        "iops": 3000,            fixed IOPS, or
+        "iops_per_gb": 30,       IOPS scaled with the volume size
+        "min_iops": 3000,
+        "max_iops": 12000,
+        "throughput": 250,       gp3 only, MiB/s
+        "throughput_per_gb": 1   gp3 only
+    }
+
+    The volume is at least as large as the source snapshot, and IOPS and
+    throughput are clamped to the policy bounds and the EBS limits.
+    """
+    vtype = policy.get('type', 'io1')
+    limits = VOLUME_LIMITS[vtype]
+    size = max(int(snapshot_size), int(policy.get('min_size_gb', 0)))
+
+    if 'iops_per_gb' in policy:
+        iops = size * float(policy['iops_per_gb'])
+    else:
+        iops = float(policy.get('iops', desired_iops))
+    low = max(limits['min_iops'], int(policy.get('min_iops', 0)))
+    high = min(limits['max_iops'], int(policy.get('max_iops', limits['max_iops'])), size * limits['max_iops_per_gb'])
+    settings = {'VolumeType': vtype, 'Size': size, 'Iops': int(max(low, min(high, iops)))}
 
-def create_and_register_volume(snapshot_id, project, environment, role, idx, az):
+    if vtype == 'gp3':
+        if 'throughput_per_gb' in policy:
+            throughput = size * float(policy['throughput_per_gb'])
+        else:
+            throughput = float(policy.get('throughput', limits['min_throughput']))
+        # gp3 allows at most 0.25 MiB/s per provisioned IOPS
+        high = min(limits['max_throughput'], settings['Iops'] // 4)
+        settings['Throughput'] = int(max(limits['min_throughput'], min(high, throughput)))
+    return settings
 
+def create_and_register_volume(snapshot, policy, project, environment, role, idx, az):
+
+    settings = volume_settings(policy, snapshot['VolumeSize'])
+    LOGGER.info("Data volume settings: {0}".format(json.dumps(settings)))
     response = ec2.create_volume(
         Encrypted=True,
-        Iops=int(desired_iops),
-        VolumeType='io1',
         DryRun=False,
-        SnapshotId=snapshot_id,
+        SnapshotId=snapshot['SnapshotId'],
         AvailabilityZone=az,
         TagSpecifications=[
             {
@@ -50,44 +121,142 @@ def create_and_register_volume(snapshot_id, project, environment, role, idx, az)
                     }
                 ]
             },
-        ]
+        ],
+        **settings
     )
-    ssm.put_parameter(
+    param_cache.put_parameter(ssm,
         Name="/{0}/{1}/{2}/datavol/{3}".format(project, environment, role, idx),
         Value=response['VolumeId'],
         Type='String',
         Overwrite=True
     )
+    param_cache.put_parameter(ssm,
+        Name="/{0}/{1}/{2}/datavolspec/{3}".format(project, environment, role, idx),
+        Value=json.dumps(settings),
+        Type='String',
+        Overwrite=True
+    )
     return response['VolumeId']
 
-def get_latest_snapshot_id(project, environment, role):
-    response = ec2.describe_snapshots(
+def get_latest_snapshot(project, environment, role):
+    """
+    Return the latest snapshot entry from the snapshot index, falling back
+    to a scan (which also repairs the index) when it is missing or stale.
+    The index changes with every snapshot, so it is never cached.
+    """
+    entry = snapshot_index.read_index(ssm, project, environment, role)
+    if entry is not None and snapshot_index.is_available(ec2, entry):
+        LOGGER.info("Using indexed snapshot {0}".format(entry['SnapshotId']))
+        return entry
+    LOGGER.info("Snapshot index missing or stale, scanning snapshots")
+    entry = snapshot_index.scan_latest(ec2, project, environment, role)
+    snapshot_index.write_index(ssm, project, environment, role, entry)
+    return entry
+
+def get_az(instanceid):
+    response = ec2.describe_instances(
+        InstanceIds=[ instanceid ],
+        DryRun=False,
+    )
+    return response['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone']
+
+def param_name(metadata, kind):
+    return "/{0}/{1}/{2}/{3}/{4}".format(metadata['project'], metadata['environment'], metadata['role'], kind, metadata['id'])
+
+def role_prefix(metadata):
+    return "/{0}/{1}/{2}".format(metadata['project'], metadata['environment'], metadata['role'])
+
+def get_node_parameters(metadata):
+    """
+    Look up the per-node eipeni, datavol and logsvol parameters, plus the
+    role and environment storage policies, through the warm-container
+    cache.  Returns a dict keyed by kind; kinds with no parameter are left out.
+    """
+    names = dict((param_name(metadata, kind), kind) for kind in ['eipeni', 'datavol', 'logsvol'])
+    names[role_prefix(metadata) + "/storagepolicy"] = 'rolepolicy'
+    names["/{0}/{1}/storagepolicy".format(metadata['project'], metadata['environment'])] = 'envpolicy'
+    # A missing data volume is created by whichever container handles the
+    # launch, so never trust a cached "not found" for it.
+    found = param_cache.get_parameters(ssm, list(names.keys()),
+        recheck_missing=[param_name(metadata, 'datavol')])
+    values = {}
+    for name, value in found.items():
+        values[names[name]] = value
+    return values
+
+def register_instance(metadata, instanceid):
+    """
+    Record the node's instance ID, then bump the role's inventory version
+    so warm workflow containers drop their cached inventory.
+    """
+    param_cache.put_parameter(ssm,
+        Name=param_name(metadata, 'instanceid'),
+        Value=instanceid,
+        Type='String',
+        Overwrite=True
+    )
+    param_cache.bump_version(ssm, role_prefix(metadata), "{0}:{1}".format(instanceid, int(time.time() * 1000)))
+
+def storage_policy(values):
+    """The role policy overrides the environment policy, which overrides PIOPS."""
+    policy = {'type': 'io1', 'iops': desired_iops}
+    for kind in ['envpolicy', 'rolepolicy']:
+        if kind in values:
+            policy.update(json.loads(values[kind]))
+    return policy
+
+def fast_restore_enabled(snapshot_id, az):
+    response = ec2.describe_fast_snapshot_restores(
         Filters=[
             {
-                'Name': 'tag:Name',
-                'Values': [ "datavol-{0}-0".format(role) ]
+                'Name': 'snapshot-id',
+                'Values': [ snapshot_id ]
             },
             {
-                'Name': 'tag:Project',
-                'Values': [ project ]
+                'Name': 'availability-zone',
+                'Values': [ az ]
             },
             {
-                'Name': 'tag:Environment',
-                'Values': [ environment ]
+                'Name': 'state',
+                'Values': [ 'enabled' ]
             }
-        ],
-        DryRun=False
+        ]
     )
-    snaps = response['Snapshots']
-    latest_snap = sorted(snaps, key=lambda k: k['StartTime'], reverse=True)[0]
-    return latest_snap['SnapshotId']
+    return len(response['FastSnapshotRestores']) > 0
 
-def get_az(instanceid):
-    response = ec2.describe_instances(
-        InstanceIds=[ instanceid ],
-        DryRun=False,
-    )
-    return response['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone']
+def restore_data_volume(metadata, instanceid, policy):
+    """
+    Create the data volume from the latest snapshot.  Returns the volume ID
+    and whether the volume needs prewarming: volumes restored with fast
+    snapshot restore are fully initialized already.
+    """
+    # The AZ and snapshot lookups are independent, so run them side by side
+    az = pool.submit(get_az, instanceid)
+    snapshot = pool.submit(get_latest_snapshot, metadata['project'], metadata['environment'], metadata['role'])
+    snapshot = snapshot.result()
+    az = az.result()
+    fast_restore = pool.submit(fast_restore_enabled, snapshot['SnapshotId'], az)
+    volumeid = create_and_register_volume(snapshot, policy, \
+        metadata['project'], metadata['environment'], metadata['role'], metadata['id'], az)
+    fast_restore = fast_restore.result()
+    LOGGER.info("Fast snapshot restore enabled: {0}".format(fast_restore))
+    return volumeid, hydrate == 'true' and not fast_restore
+
+def choose_document(message):
+    """
+    Launches into an ASG warm pool get the full bootstrap without the
+    member's ENI and volumes, which its current instance may still hold.
+    Instances coming out of the pool are bootstrapped already, so they
+    only attach the resources, configure and start mongod.
+    """
+    if message.get('Destination') == WARM_POOL:
+        return warm_docname
+    if message.get('Origin') == WARM_POOL:
+        return resume_docname
+    return docname
+
+def elapsed(start):
+    return round(time.time() - start, 3)
 
 def handler(event, context):
 
@@ -95,7 +264,8 @@ def handler(event, context):
     hookname = ''
     asgname = ''
     try:
-        LOGGER.info("SNS metadata: {0}".format(json.dumps(event)))
+        metrics.begin(context)
+        metrics.log_event("SNS metadata", event)
         message = json.loads(event['Records'][0]['Sns']['Message'])
         instanceid = message['EC2InstanceId']
         metadata = json.loads(message['NotificationMetadata'])
@@ -105,62 +275,81 @@ def handler(event, context):
 
         LOGGER.info("instance-id: %s" % instanceid)
         LOGGER.info("metadata: %s" % json.dumps(metadata))
+        metrics.set_dimensions(metadata['project'], metadata['environment'], metadata['role'])
 
-        LOGGER.info("Getting ENI id from SSM")
-        response = ssm.get_parameter(
-            Name="/{0}/{1}/{2}/eipeni/{3}".format(metadata['project'], metadata['environment'], metadata['role'], metadata['id'])
-        )
-        eniid = response['Parameter']['Value']
-        LOGGER.info("Got ENI id from SSM: {0}".format(eniid))
-
-        LOGGER.info("Getting data volume id from SSM")
-        datavolid = ''
-        try:
-            response = ssm.get_parameter(
-                Name="/{0}/{1}/{2}/datavol/{3}".format(metadata['project'], metadata['environment'], metadata['role'], metadata['id'])
-            )
-            datavolid = response['Parameter']['Value']
-            LOGGER.info("Got data volume id from SSM: {0}".format(datavolid))
-        except ssm.exceptions.ParameterNotFound:
-            LOGGER.info("Data volume ID not found from SSM, creating a new volume from latest snapshot")
-            datavolid = create_and_register_volume(get_latest_snapshot_id(metadata['project'], metadata['environment'], metadata['role']), \
-                metadata['project'], metadata['environment'], metadata['role'], metadata['id'], \
-                get_az(instanceid))
-            LOGGER.info("Created data volume id: {0}".format(datavolid))
-
-        LOGGER.info("Getting logs volume id from SSM")
-        response = ssm.get_parameter(
-            Name="/{0}/{1}/{2}/logsvol/{3}".format(metadata['project'], metadata['environment'], metadata['role'], metadata['id'])
-        )
-        logsvolid = response['Parameter']['Value']
-        LOGGER.info("Got logs volume id from SSM: {0}".format(logsvolid))
-
-        LOGGER.info("Recording instance ID in SSM")
-        ssm.put_parameter(
-            Name="/{0}/{1}/{2}/instanceid/{3}".format(metadata['project'], metadata['environment'], metadata['role'], metadata['id']),
-            Value=instanceid,
-            Type='String',
-            Overwrite=True
-        )
+        document = choose_document(message)
+        parameters = {
+            'Project': [metadata['project']],
+            'Role': [metadata['role']],
+            'Environment': [metadata['environment']],
+            'ID': [metadata['id']],
+            'InstanceId': [instanceid]
+        }
+        # complete_lifecycle_fn completes the action when it finds the hook
+        # details in the automation; in sync mode this function does instead
+        if wait_mode == 'async':
+            parameters.update({
+                'LifecycleHookName': [hookname],
+                'AutoScalingGroupName': [asgname],
+                'LifecycleActionToken': [token]
+            })
+        registered = None
+        if document == warm_docname:
+            LOGGER.info("Instance is entering the warm pool, leaving the node's resources alone")
+            start = time.time()
+        else:
+            LOGGER.info("Getting ENI, data and logs volume ids from SSM")
+            with metrics.timer('ParameterLookup'):
+                values = get_node_parameters(metadata)
+            for kind in ['eipeni', 'logsvol']:
+                if kind not in values:
+                    raise Exception("Parameter not found: {0}".format(param_name(metadata, kind)))
+            eniid = values['eipeni']
+            logsvolid = values['logsvol']
+            LOGGER.info("Got ENI id from SSM: {0}".format(eniid))
+            LOGGER.info("Got logs volume id from SSM: {0}".format(logsvolid))
 
-        LOGGER.info("Starting doc execution with queue URL {0}".format(queueurl))
-        response = ssm.start_automation_execution(
-            DocumentName = docname,
-            Parameters = {
+            datavolid = values.get('datavol', '')
+            needs_hydration = False
+            if datavolid:
+                LOGGER.info("Got data volume id from SSM: {0}".format(datavolid))
+            else:
+                LOGGER.info("Data volume ID not found from SSM, creating a new volume from latest snapshot")
+                with metrics.timer('VolumeCreation'):
+                    datavolid, needs_hydration = restore_data_volume(metadata, instanceid, storage_policy(values))
+                LOGGER.info("Created data volume id: {0}".format(datavolid))
+
+            # Nothing reads the instance ID until the node reports ready, so
+            # record it while the automation is being started.
+            start = time.time()
+            LOGGER.info("Recording instance ID in SSM")
+            registered = pool.submit(register_instance, metadata, instanceid)
+            parameters.update({
                 'EniId': [eniid],
-                'Project': [metadata['project']],
-                'Role': [metadata['role']],
-                'Environment': [metadata['environment']],
-                'ID': [metadata['id']],
                 'VolumeIdLogs': [logsvolid],
                 'VolumeIdData': [datavolid],
-                'InstanceId': [instanceid],
+                'Hydrate': ['true' if needs_hydration else 'false'],
                 'QueueUrl': [queueurl]
-            },
+            })
+
+        LOGGER.info("Starting doc {0} execution with queue URL {1}".format(document, queueurl))
+        response = ssm.start_automation_execution(
+            DocumentName = document,
+            Parameters = parameters,
         )
         execution_id = response['AutomationExecutionId']
+        if registered is not None:
+            registered.result()
+        metrics.put('AutomationStart', elapsed(start))
         LOGGER.info("Doc execution id: {0}".format(execution_id))
 
+        # In async mode complete_lifecycle_fn finishes the lifecycle action
+        # when the automation status-change event arrives.
+        if wait_mode == 'async':
+            LOGGER.info("Leaving lifecycle action to the completion handler")
+            return
+
+        start = time.time()
         while True:
             response = ssm.get_automation_execution( AutomationExecutionId=execution_id)
             status = response['AutomationExecution']['AutomationExecutionStatus']
@@ -172,26 +361,17 @@ def handler(event, context):
                 raise Exception("Execution timed out")
             if status == 'Success':
                 LOGGER.info("Execution succeeded")
+                automation_timing.log_step_timings(response['AutomationExecution'])
                 break
             time.sleep(5)
+        LOGGER.info("Automation runtime (s): {0}".format(elapsed(start)))
 
-        if token != TEST:
-            LOGGER.info("Sending lifecycle completion hook")
-            response = asg.complete_lifecycle_action(
-                LifecycleHookName=hookname,
-                AutoScalingGroupName=asgname,
-                LifecycleActionToken=token,
-                LifecycleActionResult='CONTINUE'
-            )
+        complete_lifecycle(hookname, asgname, token, 'CONTINUE')
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed processing lifecycle hook {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
-        if token != TEST:
-            LOGGER.warn("Sending lifecycle abandon hook")
-            response = asg.complete_lifecycle_action(
-                LifecycleHookName=hookname,
-                AutoScalingGroupName=asgname,
-                LifecycleActionToken=token,
-                LifecycleActionResult='ABANDON'
-            )
-
+        complete_lifecycle(hookname, asgname, token, 'ABANDON')
+    finally:
+        param_cache.log_stats()
+        aws_clients.log_stats()
+        metrics.flush()
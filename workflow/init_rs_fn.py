@@ -1,22 +1,22 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import boto3
+import aws_clients
+import command_journal
 import json
 import logging
 import traceback
+import metrics
 import os
-import time
+import ssm_command
 
 # Create AWS clients
-ssm = boto3.client('ssm')
+ssm = aws_clients.client('ssm')
 
 # Constants
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
-
-# Env variables
-docname = 'AWS-RunShellScript'
+MAX_VOTERS = 7
 
 """
 Event should be a JSON document:
@@ -50,7 +50,11 @@ Event should be a JSON document:
 def handler(event, context):
 
     try:
-        LOGGER.info("SFN metadata: {0} (type = {1})".format(json.dumps(event), type(event)))
+        metrics.begin(context)
+        metrics.log_event("SFN metadata", event)
+        event, journal_key = command_journal.unwrap(event)
+        journal = command_journal.open_journal(ssm, journal_key)
+        metrics.set_dimensions(event['project'], event['environment'], event['role'])
         instanceids = event['nodes']['id']
         dnsnames = event['nodes']['dns']
         project = event['project']
@@ -59,60 +63,46 @@ def handler(event, context):
         iid = instanceids[0]
 
         LOGGER.info("instance-id: %s" % instanceids)
+        metrics.put('Nodes', len(instanceids), 'Count')
 
         replSetName = "{0}_{1}_{2}".format(project, environment, role)
         init_rs_cmd = 'rs.initiate( { _id: "' + replSetName + '", members: ['
         for idx in range(len(dnsnames)):
-            init_rs_cmd += ' { _id : ' + str(idx) + ', host : "' + dnsnames[idx] + ':27017" },'
+            init_rs_cmd += ' { _id : ' + str(idx) + ', host : "' + dnsnames[idx] + ':27017"'
+            # Only 7 members may vote; the rest start as non-voting secondaries
+            if idx >= MAX_VOTERS:
+                init_rs_cmd += ', priority : 0, votes : 0'
+            init_rs_cmd += ' },'
         init_rs_cmd = init_rs_cmd[:-1]
         init_rs_cmd += ' ] })'
         LOGGER.info("init RS command: %s" % init_rs_cmd)
 
         LOGGER.info("Starting doc execution") 
-        response = ssm.send_command(
-            InstanceIds = [iid],
-            DocumentName = docname,
-            TimeoutSeconds = 30,
-            Parameters = {
-                'commands': ["mongo --eval '{0}'".format(init_rs_cmd)]
-            },
-        )
-        command_id = response['Command']['CommandId']
-        LOGGER.info("Doc command id: {0}".format(command_id))
-
-        # We need to wait a minute to let the command invocation show up
-        time.sleep(5)
+        result = ssm_command.run_command(ssm, iid, ["mongo --eval '{0}'".format(init_rs_cmd)], context, journal=journal)
 
         overall_status = 1 # not initialized
-        while True:
-            LOGGER.info("Checking command status for node {0}".format(iid))
-            response = ssm.get_command_invocation( CommandId=command_id, InstanceId = iid)
-            status = response['Status']
-            if status == 'Failed':
-                LOGGER.info("RS {0} init error: {1}".format(iid, response['StatusDetails']))
-                overall_status = 0
-                break
-            if status == 'TimedOut':
-                LOGGER.info("RS {0} init error: {1}".format(iid, response['StatusDetails']))
-                overall_status = 0
-                break
-            if status == 'Success':
-                stdout_content = response['StandardOutputContent']
-                if '"ok" : 1' in stdout_content:
-                    LOGGER.info("RS init ok: {0}".format(iid))
-                else:
-                    LOGGER.info("RS failed init: {0} - {1}".format(iid, stdout_content))
-                    overall_status = 0
-                break
-            time.sleep(5)
+        if not result.ok:
+            LOGGER.info("RS {0} init error: {1}".format(iid, result.status_details))
+            overall_status = 0
+        elif '"ok" : 1' in result.stdout:
+            LOGGER.info("RS init ok: {0}".format(iid))
+        else:
+            LOGGER.info("RS failed init: {0} - {1}".format(iid, result.stdout))
+            overall_status = 0
 
         if overall_status == 1:
             LOGGER.info("RS init ok")
         else:
             LOGGER.info("RS failed init")
         return overall_status
+    except ssm_command.CommandTimeoutException as e:
+        # Fail the task so the state machine retries it; the retry resumes the command
+        LOGGER.warn("Command still running: {0}".format(str(e)))
+        raise e
     except Exception as e:
         trc = traceback.format_exc()
         LOGGER.error("Failed checking RS status {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
         return 0
-
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
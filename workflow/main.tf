@@ -20,8 +20,16 @@ resource "aws_lambda_function" "lifecycle_fn" {
   environment {
     variables = {
       DOCNAME = "${aws_ssm_document.init_rs_server.name}",
+      WARM_DOCNAME = "${aws_ssm_document.warm_rs_server.name}",
+      RESUME_DOCNAME = "${aws_ssm_document.resume_rs_server.name}",
       QUEUEURL = "${aws_sqs_queue.workflow_queue.id}",
-      PIOPS = "${var.data_vol_iops}"
+      PIOPS = "${var.data_vol_iops}",
+      WAIT_MODE = "${var.lifecycle_wait_mode}",
+      HYDRATE = "${var.hydrate_data_volumes}",
+      CACHE_TTL_SECS = "${var.cache_ttl_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
     }
   }
 }
@@ -44,12 +52,170 @@ resource "aws_sns_topic_subscription" "lambda" {
   endpoint  = "${aws_lambda_function.lifecycle_fn.arn}"
 }
 
+resource "aws_lambda_function" "terminate_node_fn" {
+  filename         = "workflow/terminate_node_fn.zip"
+  function_name    = "${var.ProjectTag}_${var.Environment}_terminate_node_fn"
+  role             = "${var.LambdaRoleArn}"
+  handler          = "terminate_node_fn.handler"
+  source_code_hash = "${base64sha256(file("workflow/terminate_node_fn.zip"))}"
+  runtime          = "python3.7"
+  memory_size = "1024"
+  timeout = "120"
+
+  environment {
+    variables = {
+      STEPDOWN_SECS = "${var.stepdown_secs}",
+      ELECTION_TIMEOUT_SECS = "${var.election_timeout_secs}",
+      CACHE_TTL_SECS = "${var.cache_ttl_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
+  tags {
+    Name = "terminate_node_fn"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+}
+
+resource "aws_sns_topic" "termination_topic" {
+  name_prefix = "termination-topic-"
+}
+
+resource "aws_lambda_permission" "allow_termination_sns" {
+  statement_id_prefix  = "AllowExecutionFromSNS"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.terminate_node_fn.function_name}"
+  principal     = "sns.amazonaws.com"
+  source_arn    = "${aws_sns_topic.termination_topic.arn}"
+}
+
+resource "aws_sns_topic_subscription" "termination_lambda" {
+  topic_arn = "${aws_sns_topic.termination_topic.arn}"
+  protocol  = "lambda"
+  endpoint  = "${aws_lambda_function.terminate_node_fn.arn}"
+}
+
+resource "aws_lambda_function" "complete_lifecycle_fn" {
+  filename         = "workflow/complete_lifecycle_fn.zip"
+  function_name    = "${var.ProjectTag}_${var.Environment}_complete_lifecycle_fn"
+  role             = "${var.LambdaRoleArn}"
+  handler          = "complete_lifecycle_fn.handler"
+  source_code_hash = "${base64sha256(file("workflow/complete_lifecycle_fn.zip"))}"
+  runtime          = "python3.7"
+  memory_size = "1024"
+  timeout = "30"
+
+  environment {
+    variables = {
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
+  tags {
+    Name = "complete_lifecycle_fn"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+}
+
+resource "aws_cloudwatch_event_rule" "automation_status" {
+  name_prefix = "automation-status-"
+  description = "Node bootstrap automation reached a terminal status"
+
+  event_pattern = <<EOF
+{
+  "source": [ "aws.ssm" ],
+  "detail-type": [ "EC2 Automation Execution Status-change Notification" ],
+  "detail": {
+    "Definition": [ "${aws_ssm_document.init_rs_server.name}", "${aws_ssm_document.warm_rs_server.name}", "${aws_ssm_document.resume_rs_server.name}" ],
+    "Status": [ "Success", "Failed", "TimedOut", "Cancelled" ]
+  }
+}
+EOF
+}
+
+resource "aws_cloudwatch_event_target" "automation_status" {
+  rule = "${aws_cloudwatch_event_rule.automation_status.name}"
+  arn  = "${aws_lambda_function.complete_lifecycle_fn.arn}"
+}
+
+resource "aws_lambda_permission" "allow_events" {
+  statement_id_prefix  = "AllowExecutionFromEvents"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.complete_lifecycle_fn.function_name}"
+  principal     = "events.amazonaws.com"
+  source_arn    = "${aws_cloudwatch_event_rule.automation_status.arn}"
+}
+
+resource "aws_lambda_function" "snapshot_index_fn" {
+  filename         = "workflow/snapshot_index_fn.zip"
+  function_name    = "${var.ProjectTag}_${var.Environment}_snapshot_index_fn"
+  role             = "${var.LambdaRoleArn}"
+  handler          = "snapshot_index_fn.handler"
+  source_code_hash = "${base64sha256(file("workflow/snapshot_index_fn.zip"))}"
+  runtime          = "python3.7"
+  memory_size = "1024"
+  timeout = "30"
+
+  environment {
+    variables = {
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
+  tags {
+    Name = "snapshot_index_fn"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+}
+
+resource "aws_cloudwatch_event_rule" "snapshot_complete" {
+  name_prefix = "snapshot-complete-"
+  description = "EBS snapshot finished, refresh the latest data volume snapshot index"
+
+  event_pattern = <<EOF
+{
+  "source": [ "aws.ec2" ],
+  "detail-type": [ "EBS Snapshot Notification" ],
+  "detail": {
+    "event": [ "createSnapshot" ],
+    "result": [ "succeeded" ]
+  }
+}
+EOF
+}
+
+resource "aws_cloudwatch_event_target" "snapshot_complete" {
+  rule = "${aws_cloudwatch_event_rule.snapshot_complete.name}"
+  arn  = "${aws_lambda_function.snapshot_index_fn.arn}"
+}
+
+resource "aws_lambda_permission" "allow_snapshot_events" {
+  statement_id_prefix  = "AllowExecutionFromEvents"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.snapshot_index_fn.function_name}"
+  principal     = "events.amazonaws.com"
+  source_arn    = "${aws_cloudwatch_event_rule.snapshot_complete.arn}"
+}
+
 data "template_file" "ssm_doc_init" {
   template = "${file("${path.module}/ssm_doc_init.tpl")}"
 
   vars {
     SSMRoleArn = "${var.SSMRoleArn}"
     PlaybookUrl = "s3://${var.BucketName}/init.yaml"
+    MongoRepoUrl = "${var.mongo_repo_url}"
+    AttachScript = "${jsonencode(file("${path.module}/attach_resources.py"))}"
   }
 }
 
@@ -70,6 +236,55 @@ resource "aws_ssm_document" "init_rs_server" {
   content = "${data.template_file.ssm_doc_init.rendered}"
 }
 
+# Run instead of init_rs_server when the ASGs have a warm pool: warm_rs_server
+# when an instance enters the pool, resume_rs_server when it leaves it
+data "template_file" "ssm_doc_warm" {
+  template = "${file("${path.module}/ssm_doc_warm.tpl")}"
+
+  vars {
+    SSMRoleArn = "${var.SSMRoleArn}"
+    PlaybookUrl = "s3://${var.BucketName}/init.yaml"
+    MongoRepoUrl = "${var.mongo_repo_url}"
+  }
+}
+
+resource "aws_ssm_document" "warm_rs_server" {
+  name          = "warm_rs_server"
+  document_type = "Automation"
+  document_format = "YAML"
+  tags {
+    Name = "warm_rs_server_ssm_doc"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+
+  content = "${data.template_file.ssm_doc_warm.rendered}"
+}
+
+data "template_file" "ssm_doc_resume" {
+  template = "${file("${path.module}/ssm_doc_resume.tpl")}"
+
+  vars {
+    SSMRoleArn = "${var.SSMRoleArn}"
+    PlaybookUrl = "s3://${var.BucketName}/init.yaml"
+    MongoRepoUrl = "${var.mongo_repo_url}"
+    AttachScript = "${jsonencode(file("${path.module}/attach_resources.py"))}"
+  }
+}
+
+resource "aws_ssm_document" "resume_rs_server" {
+  name          = "resume_rs_server"
+  document_type = "Automation"
+  document_format = "YAML"
+  tags {
+    Name = "resume_rs_server_ssm_doc"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+
+  content = "${data.template_file.ssm_doc_resume.rendered}"
+}
+
 resource "aws_s3_bucket" "templatebucket" {
   bucket = "${var.BucketName}"
   acl    = "private"
@@ -83,6 +298,17 @@ resource "aws_s3_bucket" "templatebucket" {
       }
     }
   }
+  lifecycle_rule {
+    id      = "command-output"
+    prefix  = "${var.command_output_prefix}/"
+    enabled = true
+    expiration {
+      days = "${var.command_output_retention_days}"
+    }
+    noncurrent_version_expiration {
+      days = 1
+    }
+  }
   tags = {
     Name = "mongo-template-bucket"
     Project = "${var.ProjectTag}"
@@ -120,7 +346,13 @@ resource "aws_lambda_function" "workflow_fn" {
 
   environment {
     variables = {
-      SFN_ARN = "${aws_sfn_state_machine.sfn_workflow_rs.id}"
+      SFN_ARN = "${aws_sfn_state_machine.sfn_workflow_rs.id}",
+      QUEUEURL = "${aws_sqs_queue.workflow_queue.id}",
+      EXPECTED_RUN_SECS = "${var.expected_workflow_secs}",
+      CACHE_TTL_SECS = "${var.cache_ttl_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
     }
   }
 
@@ -135,7 +367,27 @@ resource "aws_lambda_function" "workflow_fn" {
 resource "aws_lambda_event_source_mapping" "workflow-sqs" {
   event_source_arn = "${aws_sqs_queue.workflow_queue.arn}"
   function_name    = "${aws_lambda_function.workflow_fn.arn}"
-  batch_size = "1"
+  batch_size = "${var.workflow_batch_size}"
+  maximum_batching_window_in_seconds = "${var.workflow_batch_window}"
+}
+
+# workflow_fn reports the messages it could not process with
+# batchItemFailures, so SQS only redelivers those.  The Terraform AWS
+# provider used here cannot set function_response_types, so partial batch
+# responses are turned on with the AWS CLI from the machine running
+# Terraform.
+data "aws_region" "current" {}
+
+resource "null_resource" "workflow_sqs_batch_failures" {
+  triggers {
+    uuid = "${aws_lambda_event_source_mapping.workflow-sqs.uuid}"
+    batch_size = "${var.workflow_batch_size}"
+    batch_window = "${var.workflow_batch_window}"
+  }
+
+  provisioner "local-exec" {
+    command = "aws lambda update-event-source-mapping --region ${data.aws_region.current.name} --uuid ${aws_lambda_event_source_mapping.workflow-sqs.uuid} --function-response-types ReportBatchItemFailures"
+  }
 }
 
 resource "aws_sfn_state_machine" "sfn_workflow_rs" {
@@ -151,7 +403,25 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Task",
       "Resource": "${aws_lambda_function.check_node_status_fn.arn}",
       "Next": "EvaluateNodeStatus",
-      "InputPath": "$.nodes.id",
+      "Parameters": {
+        "input.$": "$.nodes",
+        "journal": {
+          "execution.$": "$$.Execution.Id",
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime",
+          "project.$": "$.project",
+          "environment.$": "$.environment",
+          "role.$": "$.role"
+        }
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.TaskFailed" ],
+          "IntervalSeconds": 5,
+          "MaxAttempts": ${var.task_retry_attempts},
+          "BackoffRate": 2
+        }
+      ],
       "OutputPath": "$",
       "ResultPath": "$.nodes.status"
     },
@@ -159,13 +429,23 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Choice",
       "Choices": [
         {
-          "Variable": "$.nodes.status",
+          "Variable": "$.nodes.status.code",
           "NumericEquals": 1,
           "Next": "CheckReplicaSetStatus"
+        },
+        {
+          "Variable": "$.nodes.status.code",
+          "NumericEquals": 3,
+          "Next": "WaitForHydration"
         }
       ],
       "Default": "StopNodesNotReady"
     },
+    "WaitForHydration": {
+      "Type": "Wait",
+      "Seconds": ${var.hydration_poll_secs},
+      "Next": "CheckNodeStatus"
+    },
     "StopNodesNotReady": {
       "Type": "Succeed"
     },
@@ -173,6 +453,25 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Task",
       "Resource": "${aws_lambda_function.check_rs_status_fn.arn}",
       "Next": "EvaluateRsStatus",
+      "Parameters": {
+        "input.$": "$",
+        "journal": {
+          "execution.$": "$$.Execution.Id",
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime",
+          "project.$": "$.project",
+          "environment.$": "$.environment",
+          "role.$": "$.role"
+        }
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.TaskFailed" ],
+          "IntervalSeconds": 5,
+          "MaxAttempts": ${var.task_retry_attempts},
+          "BackoffRate": 2
+        }
+      ],
       "OutputPath": "$",
       "ResultPath": "$.rsstatus"
     },
@@ -196,6 +495,25 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Task",
       "Resource": "${aws_lambda_function.init_rs_fn.arn}",
       "Next": "EvaluateRsInitStatus",
+      "Parameters": {
+        "input.$": "$",
+        "journal": {
+          "execution.$": "$$.Execution.Id",
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime",
+          "project.$": "$.project",
+          "environment.$": "$.environment",
+          "role.$": "$.role"
+        }
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.TaskFailed" ],
+          "IntervalSeconds": 5,
+          "MaxAttempts": ${var.task_retry_attempts},
+          "BackoffRate": 2
+        }
+      ],
       "ResultPath": "$.initstatus",
       "OutputPath": "$"
     },
@@ -214,6 +532,25 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Task",
       "Resource": "${aws_lambda_function.add_node_rs_fn.arn}",
       "Next": "EvaluateRsAddStatus",
+      "Parameters": {
+        "input.$": "$",
+        "journal": {
+          "execution.$": "$$.Execution.Id",
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime",
+          "project.$": "$.project",
+          "environment.$": "$.environment",
+          "role.$": "$.role"
+        }
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.TaskFailed" ],
+          "IntervalSeconds": 5,
+          "MaxAttempts": ${var.task_retry_attempts},
+          "BackoffRate": 2
+        }
+      ],
       "ResultPath": "$.addstatus",
       "OutputPath": "$"
     },
@@ -221,13 +558,60 @@ resource "aws_sfn_state_machine" "sfn_workflow_rs" {
       "Type": "Choice",
       "Choices": [
         {
-          "Variable": "$.addstatus",
+          "Variable": "$.addstatus.code",
+          "NumericEquals": 1,
+          "Next": "PromoteMembers"
+        }
+      ],
+      "Default": "StopFailed"
+    },
+    "PromoteMembers": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.promote_members_fn.arn}",
+      "Next": "EvaluatePromotion",
+      "Parameters": {
+        "input.$": "$",
+        "journal": {
+          "execution.$": "$$.Execution.Id",
+          "state.$": "$$.State.Name",
+          "entered.$": "$$.State.EnteredTime",
+          "project.$": "$.project",
+          "environment.$": "$.environment",
+          "role.$": "$.role"
+        }
+      },
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.TaskFailed" ],
+          "IntervalSeconds": 5,
+          "MaxAttempts": ${var.task_retry_attempts},
+          "BackoffRate": 2
+        }
+      ],
+      "ResultPath": "$.promotion",
+      "OutputPath": "$"
+    },
+    "EvaluatePromotion": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.promotion.code",
           "NumericEquals": 1,
           "Next": "AddOk"
+        },
+        {
+          "Variable": "$.promotion.code",
+          "NumericEquals": 2,
+          "Next": "WaitForSync"
         }
       ],
       "Default": "StopFailed"
     },
+    "WaitForSync": {
+      "Type": "Wait",
+      "Seconds": ${var.sync_poll_secs},
+      "Next": "PromoteMembers"
+    },
     "InitOk": {
       "Type": "Succeed"
     },
@@ -255,6 +639,18 @@ resource "aws_lambda_function" "check_node_status_fn" {
   memory_size = "1024"
   timeout = "60"
 
+  environment {
+    variables = {
+      HYDRATION_THRESHOLD = "${var.hydration_threshold}",
+      HYDRATION_TIMEOUT_SECS = "${var.hydration_timeout_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
   tags {
     Name = "check_node_status_fn"
     Project = "${var.ProjectTag}"
@@ -273,6 +669,17 @@ resource "aws_lambda_function" "check_rs_status_fn" {
   memory_size = "1024"
   timeout = "60"
 
+  environment {
+    variables = {
+      MAX_LAG_SECS = "${var.max_lag_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
   tags {
     Name = "check_rs_status_fn"
     Project = "${var.ProjectTag}"
@@ -291,6 +698,16 @@ resource "aws_lambda_function" "init_rs_fn" {
   memory_size = "1024"
   timeout = "60"
 
+  environment {
+    variables = {
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
   tags {
     Name = "init_rs_fn"
     Project = "${var.ProjectTag}"
@@ -309,6 +726,16 @@ resource "aws_lambda_function" "add_node_rs_fn" {
   memory_size = "1024"
   timeout = "60"
 
+  environment {
+    variables = {
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
   tags {
     Name = "add_node_rs_fn"
     Project = "${var.ProjectTag}"
@@ -317,4 +744,35 @@ resource "aws_lambda_function" "add_node_rs_fn" {
 
 }
 
+resource "aws_lambda_function" "promote_members_fn" {
+  filename         = "workflow/promote_members_fn.zip"
+  function_name    = "${var.ProjectTag}_${var.Environment}_promote_members_fn"
+  role             = "${var.LambdaRoleArn}"
+  handler          = "promote_members_fn.handler"
+  source_code_hash = "${base64sha256(file("workflow/promote_members_fn.zip"))}"
+  runtime          = "python3.7"
+  memory_size = "1024"
+  timeout = "60"
+
+  environment {
+    variables = {
+      PROMOTE_MAX_LAG_SECS = "${var.promote_max_lag_secs}",
+      MEMBER_PRIORITY = "${var.member_priority}",
+      SYNC_TIMEOUT_SECS = "${var.sync_timeout_secs}",
+      CLIENT_RATE_LIMITS = "${var.client_rate_limits}",
+      COMMAND_OUTPUT_BUCKET = "${aws_s3_bucket.templatebucket.id}",
+      COMMAND_OUTPUT_PREFIX = "${var.command_output_prefix}",
+      METRICS_NAMESPACE = "${var.metrics_namespace}",
+      EVENT_LOG_SAMPLE = "${var.event_log_sample}"
+    }
+  }
+
+  tags {
+    Name = "promote_members_fn"
+    Project = "${var.ProjectTag}"
+    Environment = "${var.Environment}"
+  }
+
+}
+
 
@@ -0,0 +1,160 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+MAX_VALUES = 100 # EMF accepts at most 100 values per metric in one record
+API_COUNTERS = [('calls', 'ApiCalls', 'Count'), ('throttled', 'ApiThrottles', 'Count'),
+    ('retries', 'ApiRetries', 'Count'), ('failures', 'ApiFailures', 'Count'),
+    ('wait', 'ApiThrottleWait', 'Seconds')]
+
+# Env variables
+namespace = os.environ.get('METRICS_NAMESPACE', 'MongoDBLifecycle')
+emit_metrics = os.environ.get('EMIT_METRICS', 'true')
+event_log_bytes = int(os.environ.get('EVENT_LOG_BYTES', '2048'))
+event_log_sample = float(os.environ.get('EVENT_LOG_SAMPLE', '0.01'))
+
+"""
+Per-invocation instrumentation shared by the Lambda functions.
+
+Handlers call begin at the start of an invocation, record phase durations
+and node counts with put or timer, and call flush when they finish.
+flush writes CloudWatch Embedded Metric Format records to stdout, and
+CloudWatch Logs turns them into metrics without any API calls:
+
+ - one record with the handler's metrics, under a Function dimension and,
+   once set_dimensions has been called, a Project/Environment/Role one
+ - one record per AWS API family (see aws_clients) with the calls,
+   throttles, retries, failures, rate limiter wait and average latency
+   made during the invocation, under Function/Api dimensions
+
+Set EMIT_METRICS to false to log a one-line summary instead.
+
+log_event replaces logging whole events at INFO: it logs at most
+EVENT_LOG_BYTES of the event, and the full event for an EVENT_LOG_SAMPLE
+fraction of invocations.
+"""
+
+_lock = threading.Lock()
+_state = {}
+
+def begin(context=None):
+    """Start collecting metrics for a new invocation."""
+    function = getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    with _lock:
+        _state.clear()
+        _state.update(function=function, dimensions=OrderedDict(), metrics=OrderedDict(),
+            api=aws_clients.snapshot())
+
+def set_dimensions(project, environment, role):
+    with _lock:
+        _state.setdefault('dimensions', OrderedDict()).update(
+            [('Project', project), ('Environment', environment), ('Role', role)])
+
+def put(name, value, unit='Seconds'):
+    """Record one value; metrics put several times keep every value."""
+    if value is None:
+        return
+    with _lock:
+        metric = _state.setdefault('metrics', OrderedDict()).setdefault(name, {'unit': unit, 'values': []})
+        metric['values'].append(round(value, 3) if isinstance(value, float) else value)
+
+@contextmanager
+def timer(name):
+    """Record how long the block took, in seconds, even if it raises."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        put(name, time.time() - start)
+
+def log_event(label, event):
+    text = json.dumps(event)
+    if len(text) > event_log_bytes and random.random() >= event_log_sample:
+        LOGGER.info("{0}: {1}... ({2} bytes)".format(label, text[:event_log_bytes], len(text)))
+    else:
+        LOGGER.info("{0}: {1}".format(label, text))
+
+def api_deltas(before, after):
+    """Per-family counters for the calls made between two aws_clients snapshots."""
+    deltas = OrderedDict()
+    for family in sorted(after):
+        previous = before.get(family, {})
+        delta = dict((k, v - previous.get(k, 0)) for k, v in after[family].items())
+        if delta.get('calls'):
+            deltas[family] = delta
+    return deltas
+
+def records():
+    """Build the EMF records for the current invocation."""
+    with _lock:
+        state = dict(_state)
+    if not state:
+        return []
+    function = state.get('function', 'local')
+    timestamp = int(time.time() * 1000)
+
+    def record(dimension_sets, properties, metrics):
+        document = OrderedDict([('_aws', OrderedDict([
+            ('Timestamp', timestamp),
+            ('CloudWatchMetrics', [OrderedDict([
+                ('Namespace', namespace),
+                ('Dimensions', dimension_sets),
+                ('Metrics', [{'Name': name, 'Unit': unit} for name, unit, value in metrics])
+            ])])
+        ]))])
+        document.update(properties)
+        for name, unit, value in metrics:
+            document[name] = value
+        return document
+
+    documents = []
+    dimensions = state.get('dimensions', {})
+    metrics = [(name, m['unit'], m['values'][0] if len(m['values']) == 1 else m['values'][:MAX_VALUES])
+        for name, m in state.get('metrics', {}).items()]
+    if metrics:
+        properties = OrderedDict([('Function', function)])
+        properties.update(dimensions)
+        dimension_sets = [['Function']]
+        if dimensions:
+            dimension_sets.append(list(dimensions.keys()))
+        documents.append(record(dimension_sets, properties, metrics))
+
+    for family, delta in api_deltas(state.get('api', {}), aws_clients.snapshot()).items():
+        api_metrics = [(metric, unit, round(delta.get(counter, 0), 3)) for counter, metric, unit in API_COUNTERS]
+        api_metrics.append(('ApiLatency', 'Milliseconds', round(delta.get('latency', 0) * 1000.0 / delta['calls'], 1)))
+        documents.append(record([['Function', 'Api']], OrderedDict([('Function', function), ('Api', family)]), api_metrics))
+    return documents
+
+def emit(document):
+    sys.stdout.write(json.dumps(document) + '\n')
+    sys.stdout.flush()
+
+def flush():
+    """Emit the invocation's metrics and reset."""
+    try:
+        if emit_metrics == 'true':
+            for document in records():
+                emit(document)
+        else:
+            with _lock:
+                summary = dict((name, m['values']) for name, m in _state.get('metrics', {}).items())
+            LOGGER.info("Metrics: {0}".format(json.dumps(summary, sort_keys=True)))
+    except Exception as e:
+        # Instrumentation must never fail an invocation
+        LOGGER.warn("Failed emitting metrics: {0}".format(str(e)))
+    finally:
+        with _lock:
+            _state.clear()
@@ -10,3 +10,6 @@ output "LambdaFnArn" {
 output "LifecycleTopicArn" {
   value = "${aws_sns_topic.lifecycle_topic.arn}"
 }
+output "TerminationTopicArn" {
+  value = "${aws_sns_topic.termination_topic.arn}"
+}
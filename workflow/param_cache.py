@@ -0,0 +1,134 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import os
+import threading
+import time
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+MAX_NAMES_PER_CALL = 10 # get_parameters limit
+MISSING = object() # cached "parameter does not exist"
+
+# Env variables
+default_ttl = int(os.environ.get('CACHE_TTL_SECS', '300'))
+
+"""
+Warm-container cache for SSM parameters, shared by the lifecycle and
+workflow Lambdas.  Entries live in module globals, so they survive between
+invocations of the same container and disappear with it.
+
+Entries expire after CACHE_TTL_SECS.  Writes made through put_parameter
+update the cache directly.  Values written by other functions (such as a
+replaced node's instance ID) are guarded by a version stamp: callers read
+the stamp with check_version, and when it changed every entry under the
+prefix is dropped before it can be served.
+"""
+
+_lock = threading.Lock()
+_entries = {} # key -> (value, expiry)
+_versions = {} # prefix -> last seen version stamp
+stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def version_name(prefix):
+    return prefix + "/inventoryversion"
+
+def _get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            stats['hits'] += 1
+            return entry[0]
+        stats['misses'] += 1
+        return None
+
+def _set(key, value, ttl=None):
+    with _lock:
+        _entries[key] = (value, time.time() + (default_ttl if ttl is None else ttl))
+
+def invalidate(key):
+    with _lock:
+        if _entries.pop(key, None) is not None:
+            stats['invalidations'] += 1
+
+def invalidate_prefix(prefix):
+    with _lock:
+        for key in [k for k in _entries if k.startswith(prefix)]:
+            del _entries[key]
+            stats['invalidations'] += 1
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _versions.clear()
+
+def cached(key, loader, ttl=None):
+    """Return the cached value for key, calling loader() to fill a miss."""
+    value = _get(key)
+    if value is None:
+        value = loader()
+        _set(key, value, ttl)
+    return value
+
+def get_parameters(ssm, names, ttl=None, recheck_missing=()):
+    """
+    Cached get_parameters: returns {name: value} for the names that exist.
+    Only the misses are fetched, ten names per call.  Names that do not
+    exist are cached too, unless listed in recheck_missing because some
+    other function may create them at any time.
+    """
+    values = {}
+    misses = []
+    for name in names:
+        value = _get(name)
+        if value is None:
+            misses.append(name)
+        elif value is not MISSING:
+            values[name] = value
+    for i in range(0, len(misses), MAX_NAMES_PER_CALL):
+        chunk = misses[i:i + MAX_NAMES_PER_CALL]
+        response = ssm.get_parameters(Names=chunk)
+        for param in response['Parameters']:
+            values[param['Name']] = param['Value']
+            _set(param['Name'], param['Value'], ttl)
+        for name in response.get('InvalidParameters', []):
+            if name not in recheck_missing:
+                _set(name, MISSING, ttl)
+    return values
+
+def put_parameter(ssm, **kwargs):
+    """put_parameter that also refreshes the cached value (write-through)."""
+    response = ssm.put_parameter(**kwargs)
+    name = kwargs['Name']
+    # Path listings that include this parameter are now out of date
+    invalidate_prefix("path:" + name.rsplit('/', 1)[0] + "/")
+    _set(name, kwargs['Value'])
+    return response
+
+def bump_version(ssm, prefix, stamp):
+    """Record a new version stamp after changing parameters under prefix."""
+    put_parameter(ssm, Name=version_name(prefix), Value=stamp, Type='String', Overwrite=True)
+
+def check_version(ssm, prefix):
+    """
+    Read the version stamp for prefix (always from SSM) and drop every
+    cached entry under prefix if it changed since the last check.
+    """
+    try:
+        stamp = ssm.get_parameter(Name=version_name(prefix))['Parameter']['Value']
+    except ssm.exceptions.ParameterNotFound:
+        stamp = ''
+    with _lock:
+        previous = _versions.get(prefix)
+        _versions[prefix] = stamp
+    if previous is not None and previous != stamp:
+        LOGGER.info("Version of {0} changed from {1} to {2}, invalidating cache".format(prefix, previous, stamp))
+        invalidate_prefix(prefix)
+        invalidate_prefix("path:" + prefix)
+    return stamp
+
+def log_stats():
+    LOGGER.info("Parameter cache: {0} hits, {1} misses, {2} invalidations, {3} entries".format(
+        stats['hits'], stats['misses'], stats['invalidations'], len(_entries)))
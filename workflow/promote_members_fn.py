@@ -0,0 +1,246 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import command_journal
+import json
+import logging
+import traceback
+import metrics
+import os
+import ssm_command
+import time
+
+# Create AWS clients
+ssm = aws_clients.client('ssm')
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+MONGO_PORT = '27017'
+MAX_VOTERS = 7 # MongoDB allows at most 7 voting members
+RESULT_MARKER = 'RSRECONFIG '
+STATUS_MARKER = 'RSSTATUS '
+MEMBER_MARKER = 'RSMEMBER '
+SYNC_STATES = ['STARTUP', 'STARTUP2', 'SECONDARY']
+
+# Env variables
+promote_max_lag_secs = int(os.environ.get('PROMOTE_MAX_LAG_SECS', '10'))
+member_priority = int(os.environ.get('MEMBER_PRIORITY', '1'))
+sync_timeout_secs = int(os.environ.get('SYNC_TIMEOUT_SECS', '3600'))
+
+"""
+Event is the workflow state after AddNodeToRs:
+
+{
+    "nodes": {
+        "id": [ instance id, instance id ],
+        "dns": [ dns name, dns name ]
+    },
+    "rsstatus": { "primary": dns name, ... },
+    "addstatus": { "code": 1, "members": { m1: { "ok": 1, "errmsg": "" } }, "added_at": 1546475202000 },
+    "promotion": previous output of this function, when looping,
+    "project": project,
+    "environment": environment,
+    "role": role
+}
+
+New members are added with priority 0 and no vote.  This function follows
+the members that AddNodeToRs added (and those it followed on the previous
+pass) through initial sync (STARTUP2) and replication lag (primary optime
+minus member optime, from rs.status()).  Other non-voting members of the
+inventory are left alone.  A member that is unreachable or in any state
+other than STARTUP, STARTUP2 or SECONDARY is reported as failed instead
+of being waited for.
+Members that are SECONDARY and within PROMOTE_MAX_LAG_SECS get one vote
+and MEMBER_PRIORITY, all in a single rs.reconfig, as long as the replica
+set stays within 7 voting members; the rest stay non-voting secondaries.
+(Changing several votes in one reconfig is allowed up to MongoDB 4.2;
+on 4.4 and later the script checks db.version() and runs one reconfig
+per member instead.)
+
+Output, with codes 1 = nothing left to wait for, 2 = members still
+syncing, 0 = error, failed members or SYNC_TIMEOUT_SECS exceeded:
+
+{
+    "code": 2,
+    "started_at": 1546475202000,
+    "members": {
+        m1: { "state": "SECONDARY", "lag_secs": 0.0, "since": 1546475202000,
+              "caught_up_secs": 131.2, "promoted": 1 },
+        m2: { "state": "STARTUP2", "lag_secs": null, "since": 1546475202000,
+              "caught_up_secs": null, "promoted": 0 }
+    },
+    "syncing": [ m2 ],
+    "failed": [],
+    "promoted": [ m1 ]
+}
+"""
+
+# Status and configuration of every member, one JSON line each after a
+# header with the member count (see ssm_command.read_listing)
+SYNC_SCRIPT = ('var s = rs.status(); var c = rs.conf(); var conf = {}; var members = s.members || []; '
+    'c.members.forEach(function(m) { conf[m.host] = m; }); '
+    'print("' + STATUS_MARKER + '" + JSON.stringify({ ok: s.ok, count: members.length })); '
+    'members.forEach(function(m) { var k = conf[m.name] || {}; print("' + MEMBER_MARKER + '" + JSON.stringify({ '
+    'host: m.name, state: m.stateStr, health: m.health, '
+    'optime: m.optimeDate ? m.optimeDate.getTime() : null, '
+    'votes: k.votes, priority: k.priority, hidden: k.hidden || false, arbiterOnly: k.arbiterOnly || false })); });')
+
+def build_reconfig_script(targets):
+    """
+    Apply {host: {votes, priority}} to the current configuration, in one
+    rs.reconfig up to MongoDB 4.2 and one per member from 4.4 on, which
+    rejects changing more than one vote at a time.  It refuses to go above
+    MAX_VOTERS in case the configuration changed since we read it, and
+    reports the hosts it changed.
+    """
+    return ('var targets = ' + json.dumps(targets) + '; var hosts = Object.keys(targets); '
+        'var v = db.version().split(".").map(Number); var single = v[0] > 4 || (v[0] == 4 && v[1] >= 4); '
+        'var batches = single ? hosts.map(function(h) { return [h]; }) : [hosts]; '
+        'var r = { ok: 1 }; var done = []; '
+        'for (var i = 0; i < batches.length && r.ok == 1; i++) { '
+        'var c = rs.conf(); var voters = 0; '
+        'c.members.forEach(function(m) { if (batches[i].indexOf(m.host) >= 0) { '
+        'm.votes = targets[m.host].votes; m.priority = targets[m.host].priority; } voters += m.votes; }); '
+        'r = voters > ' + str(MAX_VOTERS) + ' ? { ok: 0, errmsg: "would have " + voters + " voting members" } : rs.reconfig(c); '
+        'if (r.ok == 1) { done = done.concat(batches[i]); } } '
+        'print("' + RESULT_MARKER + '" + JSON.stringify({ ok: r.ok, errmsg: r.errmsg || "", done: done }));')
+
+def parse_status(lines):
+    status, members = ssm_command.read_listing(lines, STATUS_MARKER, MEMBER_MARKER)
+    status['members'] = members
+    return status
+
+def parse_reconfig(lines):
+    outcomes = list(ssm_command.json_lines(lines, RESULT_MARKER))
+    if not outcomes:
+        raise ValueError("No reconfig result in command output")
+    return outcomes[-1]
+
+def candidates(status, dnsnames, tracked):
+    """Tracked non-voting, electable-to-be members, in inventory order."""
+    members = dict((m['host'], m) for m in status['members'])
+    result = []
+    for dnsname in dnsnames:
+        if dnsname not in tracked:
+            continue
+        m = members.get(dnsname + ':' + MONGO_PORT)
+        if m is None or m['votes'] != 0 or m['priority'] != 0 or m['hidden'] or m['arbiterOnly']:
+            continue
+        result.append(dnsname)
+    return result
+
+def is_reachable(member):
+    return member['health'] == 1 and member['state'] in SYNC_STATES
+
+def lag_secs(status, host):
+    primary = [m['optime'] for m in status['members'] if m['state'] == 'PRIMARY' and m['optime'] is not None]
+    member = next(m for m in status['members'] if m['host'] == host)
+    if not primary or member['state'] != 'SECONDARY' or member['optime'] is None:
+        return None
+    return max(0.0, (primary[0] - member['optime']) / 1000.0)
+
+def handler(event, context):
+
+    try:
+        metrics.begin(context)
+        metrics.log_event("SFN metadata", event)
+        event, journal_key = command_journal.unwrap(event)
+        journal = command_journal.open_journal(ssm, journal_key)
+        metrics.set_dimensions(event['project'], event['environment'], event['role'])
+        instanceids = event['nodes']['id']
+        dnsnames = event['nodes']['dns']
+        primary = event.get('rsstatus', {}).get('primary', '')
+        added = event.get('addstatus', {})
+        previous = event.get('promotion') or {}
+        now = int(time.time() * 1000)
+        started_at = previous.get('started_at', now)
+        tracked = set(m for m, outcome in added.get('members', {}).items() if outcome['ok'] == 1)
+        tracked.update(previous.get('members', {}).keys())
+
+        # The reconfig has to run on the primary
+        iid = instanceids[0]
+        if primary in dnsnames:
+            iid = instanceids[dnsnames.index(primary)]
+
+        result = ssm_command.run_command(ssm, iid, ["mongo --quiet --eval '{0}'".format(SYNC_SCRIPT)], context, journal=journal)
+        if not result.ok:
+            LOGGER.warn("RS {0} status error: {1}".format(iid, result.status_details))
+            return {'code': 0, 'started_at': started_at, 'members': {}, 'syncing': [], 'failed': [], 'promoted': []}
+        status = parse_status(result.lines())
+
+        voters = sum(m['votes'] or 0 for m in status['members'])
+        members = {}
+        syncing = []
+        failed = []
+        ready = []
+        for dnsname in candidates(status, dnsnames, tracked):
+            host = dnsname + ':' + MONGO_PORT
+            member = next(m for m in status['members'] if m['host'] == host)
+            state = member['state']
+            lag = lag_secs(status, host)
+            before = previous.get('members', {}).get(dnsname, {})
+            # Time the initial sync from the rs.add on the first pass
+            since = before.get('since')
+            if since is None and dnsname in added.get('members', {}):
+                since = added.get('added_at')
+            members[dnsname] = {'state': state, 'lag_secs': lag, 'since': since,
+                'caught_up_secs': before.get('caught_up_secs'), 'promoted': 0}
+            if not is_reachable(member):
+                failed.append(dnsname)
+            elif lag is not None and lag <= promote_max_lag_secs:
+                if since is not None and members[dnsname]['caught_up_secs'] is None:
+                    members[dnsname]['caught_up_secs'] = round((now - since) / 1000.0, 1)
+                    metrics.put('TimeToCaughtUp', members[dnsname]['caught_up_secs'])
+                    LOGGER.info("Member {0} caught up after {1}s".format(dnsname, members[dnsname]['caught_up_secs']))
+                ready.append(dnsname)
+            else:
+                syncing.append(dnsname)
+            LOGGER.info("Member {0}: {1}, lag {2}s".format(dnsname, state, lag))
+
+        # Promote caught-up members in inventory order while there are votes to give
+        promote = ready[:max(0, MAX_VOTERS - voters)]
+        if len(promote) < len(ready):
+            LOGGER.info("Voting member limit reached, leaving {0} as non-voting".format(ready[len(promote):]))
+        if promote:
+            targets = dict((m + ':' + MONGO_PORT, {'votes': 1, 'priority': member_priority}) for m in promote)
+            result = ssm_command.run_command(ssm, iid, ["mongo --quiet --eval '{0}'".format(build_reconfig_script(targets))], context, journal=journal)
+            outcome = parse_reconfig(result.lines()) if result.ok else {'ok': 0, 'errmsg': result.status_details, 'done': []}
+            # One reconfig per member on 4.4+ can stop part way
+            done = [m for m in promote if m + ':' + MONGO_PORT in outcome['done']]
+            for m in done:
+                members[m]['promoted'] = 1
+            if outcome['ok'] != 1:
+                LOGGER.warn("RS reconfig failed after promoting {0}: {1}".format(done, outcome['errmsg']))
+                return {'code': 0, 'started_at': started_at, 'members': members, 'syncing': syncing, 'failed': failed, 'promoted': done}
+            LOGGER.info("Promoted members: {0}".format(promote))
+
+        metrics.put('MembersSyncing', len(syncing), 'Count')
+        metrics.put('MembersFailed', len(failed), 'Count')
+        metrics.put('MembersPromoted', len(promote), 'Count')
+        metrics.put('VotingMembers', voters + len(promote), 'Count')
+
+        code = 1
+        if syncing:
+            if (now - started_at) / 1000.0 > sync_timeout_secs:
+                LOGGER.warn("Members still syncing after {0}s: {1}".format(sync_timeout_secs, syncing))
+                code = 0
+            else:
+                LOGGER.info("Members still syncing: {0}".format(syncing))
+                code = 2
+        elif failed:
+            LOGGER.warn("Members failed during initial sync: {0}".format(failed))
+            code = 0
+        return {'code': code, 'started_at': started_at, 'members': members, 'syncing': syncing, 'failed': failed, 'promoted': promote}
+    except ssm_command.CommandTimeoutException as e:
+        # Fail the task so the state machine retries it; the retry resumes the command
+        LOGGER.warn("Command still running: {0}".format(str(e)))
+        raise e
+    except Exception as e:
+        trc = traceback.format_exc()
+        LOGGER.error("Failed promoting RS members {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
+        return {'code': 0, 'started_at': 0, 'members': {}, 'syncing': [], 'failed': [], 'promoted': []}
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
@@ -0,0 +1,155 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import calendar
+import json
+import logging
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+SOURCE_MEMBER = 0
+MAX_WRITE_ATTEMPTS = 3
+
+"""
+Latest data volume snapshot per replica set, kept in the SSM parameter
+/Project/Environment/Role/latestsnapshot so that restoring a data volume
+does not have to scan the whole snapshot history:
+
+{
+    "SnapshotId": "snap-0123456789abcdef0",
+    "StartTime": 1546475202.0,
+    "VolumeSize": 100
+}
+
+The index is updated by snapshot_index_fn when a snapshot completes and
+by the lifecycle function whenever it has to fall back to a scan.
+
+Only snapshots of member SOURCE_MEMBER's data volume are used.  Every
+member is snapshotted, but a member that is still in initial sync or has
+failed holds an incomplete copy of the data, so restores stick to the
+member that seeds the replica set.
+"""
+
+def index_name(project, environment, role):
+    return "/{0}/{1}/{2}/latestsnapshot".format(project, environment, role)
+
+def source_name(role):
+    return "datavol-{0}-{1}".format(role, SOURCE_MEMBER)
+
+def to_entry(snapshot):
+    return {
+        'SnapshotId': snapshot['SnapshotId'],
+        'StartTime': calendar.timegm(snapshot['StartTime'].utctimetuple()),
+        'VolumeSize': snapshot['VolumeSize']
+    }
+
+def parse_entry(value):
+    if not value:
+        return None
+    return json.loads(value)
+
+def read_versioned(ssm, name):
+    """Return (entry, parameter version); (None, 0) if there is no index yet."""
+    try:
+        response = ssm.get_parameter(Name=name)
+    except ssm.exceptions.ParameterNotFound:
+        return None, 0
+    return parse_entry(response['Parameter']['Value']), response['Parameter']['Version']
+
+def read_index(ssm, project, environment, role):
+    return read_versioned(ssm, index_name(project, environment, role))[0]
+
+def write_index(ssm, project, environment, role, entry):
+    """Write entry and return the parameter version it was written as."""
+    response = ssm.put_parameter(
+        Name=index_name(project, environment, role),
+        Value=json.dumps(entry),
+        Type='String',
+        Overwrite=True
+    )
+    LOGGER.info("Latest snapshot for {0}/{1}/{2}: {3}".format(project, environment, role, entry['SnapshotId']))
+    return response['Version']
+
+def update_index(ssm, project, environment, role, entry):
+    """
+    Record entry unless the index already points at a newer snapshot.
+    SSM has no conditional put, so when the version we wrote shows that
+    other updates landed between our read and write, those versions are
+    read back and the newest entry of all is written again.
+    """
+    name = index_name(project, environment, role)
+    current, version = read_versioned(ssm, name)
+    if current is not None and current['StartTime'] >= entry['StartTime']:
+        LOGGER.info("Snapshot index already at {0}, keeping it".format(current['SnapshotId']))
+        return False
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        written = write_index(ssm, project, environment, role, entry)
+        newest = entry
+        for other_version in range(version + 1, written):
+            other = parse_entry(ssm.get_parameter(Name="{0}:{1}".format(name, other_version))['Parameter']['Value'])
+            if other is not None and other['StartTime'] > newest['StartTime']:
+                newest = other
+        if newest is entry:
+            return True
+        LOGGER.info("Snapshot index moved to {0} while updating, restoring it".format(newest['SnapshotId']))
+        entry = newest
+        version = written
+    LOGGER.warn("Snapshot index still changing after {0} writes".format(MAX_WRITE_ATTEMPTS))
+    return True
+
+def snapshot_filters(project, environment, role):
+    return [
+        {
+            'Name': 'tag:Name',
+            'Values': [ source_name(role) ]
+        },
+        {
+            'Name': 'tag:Project',
+            'Values': [ project ]
+        },
+        {
+            'Name': 'tag:Environment',
+            'Values': [ environment ]
+        },
+        {
+            'Name': 'status',
+            'Values': [ 'completed' ]
+        }
+    ]
+
+def scan_latest(ec2, project, environment, role):
+    """
+    Page through the replica set's completed snapshots keeping only the
+    newest one seen, instead of collecting and sorting the whole history.
+    """
+    latest = None
+    kwargs = {'Filters': snapshot_filters(project, environment, role), 'DryRun': False}
+    while True:
+        response = ec2.describe_snapshots(**kwargs)
+        for snap in response['Snapshots']:
+            if latest is None or snap['StartTime'] > latest['StartTime']:
+                latest = snap
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    if latest is None:
+        raise Exception("No completed snapshots for {0}/{1}/{2}".format(project, environment, role))
+    return to_entry(latest)
+
+def is_available(ec2, entry):
+    """Check that an indexed snapshot has not been deleted since it was recorded."""
+    response = ec2.describe_snapshots(
+        Filters=[
+            {
+                'Name': 'snapshot-id',
+                'Values': [ entry['SnapshotId'] ]
+            },
+            {
+                'Name': 'status',
+                'Values': [ 'completed' ]
+            }
+        ],
+        DryRun=False
+    )
+    return len(response['Snapshots']) > 0
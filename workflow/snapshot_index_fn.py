@@ -0,0 +1,89 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import json
+import logging
+import traceback
+import metrics
+import snapshot_index
+
+# Create AWS clients
+ec2 = aws_clients.client('ec2')
+ssm = aws_clients.client('ssm')
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+DATAVOL_PREFIX = 'datavol-'
+
+"""
+Keeps the snapshot index (see snapshot_index.py) current by recording
+every completed snapshot of the source member's data volume as it
+finishes.
+
+Example input (EventBridge EBS snapshot notification):
+{
+  "version": "0",
+  "id": "01234567-0123-0123-0123-012345678901",
+  "detail-type": "EBS Snapshot Notification",
+  "source": "aws.ec2",
+  "account": "111111111111",
+  "time": "2019-01-07T15:04:10Z",
+  "region": "us-west-2",
+  "resources": [
+    "arn:aws:ec2::us-west-2:snapshot/snap-0123456789abcdef0"
+  ],
+  "detail": {
+    "event": "createSnapshot",
+    "result": "succeeded",
+    "cause": "",
+    "request-id": "",
+    "snapshot_id": "arn:aws:ec2::us-west-2:snapshot/snap-0123456789abcdef0",
+    "source": "arn:aws:ec2::us-west-2:volume/vol-0123456789abcdef0",
+    "startTime": "2019-01-07T15:00:12Z",
+    "endTime": "2019-01-07T15:04:09Z"
+  }
+}
+"""
+
+def get_tag(snapshot, key):
+    for tag in snapshot.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+def handler(event, context):
+
+    try:
+        metrics.begin(context)
+        metrics.log_event("Snapshot event", event)
+        detail = event['detail']
+        if detail.get('result') != 'succeeded':
+            LOGGER.info("Snapshot did not succeed: {0}".format(detail.get('cause')))
+            return
+        snapshot_id = detail['snapshot_id'].split('/')[-1]
+
+        response = ec2.describe_snapshots(SnapshotIds=[snapshot_id], DryRun=False)
+        snapshot = response['Snapshots'][0]
+        name = get_tag(snapshot, 'Name') or ''
+        project = get_tag(snapshot, 'Project')
+        environment = get_tag(snapshot, 'Environment')
+        if not name.startswith(DATAVOL_PREFIX) or project is None or environment is None:
+            LOGGER.info("Snapshot {0} is not a data volume snapshot".format(snapshot_id))
+            return
+        # Name tag is datavol-<role>-<member index>
+        role = name[len(DATAVOL_PREFIX):].rsplit('-', 1)[0]
+        metrics.set_dimensions(project, environment, role)
+        if name != snapshot_index.source_name(role):
+            LOGGER.info("Snapshot {0} is of {1}, not the source member".format(snapshot_id, name))
+            return
+
+        snapshot_index.update_index(ssm, project, environment, role, snapshot_index.to_entry(snapshot))
+    except Exception as e:
+        trc = traceback.format_exc()
+        LOGGER.error("Failed updating snapshot index {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
+        raise e
+    finally:
+        aws_clients.log_stats()
+        metrics.flush()
@@ -0,0 +1,368 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import codecs
+import datetime
+import json
+import logging
+import metrics
+import os
+import random
+import time
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+DOCNAME = 'AWS-RunShellScript'
+FIRST_POLL_DELAY = 0.5 # seconds before the first status probe
+BASE_POLL_DELAY = 1.0 # seconds, doubled after every pending probe
+MAX_POLL_DELAY = 5.0 # never sleep longer than the old fixed interval
+TIME_BUFFER_MS = 2000 # leave this much time for the handler to return
+TERMINAL_STATUSES = ['Success', 'Failed', 'TimedOut', 'Cancelled']
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ']
+GET_OUTPUT_LIMIT = 24000 # characters of output returned by get_command_invocation
+LIST_OUTPUT_LIMIT = 2500 # characters of plugin output returned by list_command_invocations
+OUTPUT_PLUGIN_PATH = 'awsrunShellScript/0.awsrunShellScript/stdout'
+READ_CHUNK_BYTES = 64 * 1024
+
+# Env variables
+output_bucket = os.environ.get('COMMAND_OUTPUT_BUCKET', '')
+output_prefix = os.environ.get('COMMAND_OUTPUT_PREFIX', 'command-output')
+output_endpoint = os.environ.get('COMMAND_OUTPUT_ENDPOINT', '')
+
+"""
+Shared SSM Run Command helper for the workflow Lambda functions.
+
+Rather than sleeping a fixed 5 seconds before and between calls to
+get_command_invocation, we probe quickly once and then back off
+exponentially with jitter.  The wait is bounded by the remaining
+Lambda execution time so that a slow command surfaces as an exception
+instead of a hard function timeout.
+
+Every finished invocation records how long it sat in the agent's queue
+(CommandQueueWait) and how long it ran (CommandExecution), and every wait
+records its CommandPolls, through metrics.py.
+
+Given a command_journal.Journal, send_or_resume and run_command pick up
+the command a failed attempt of the same state already sent, and poll it
+straight away rather than sending it again.
+
+Run Command only returns the first 24,000 characters of output (2,500 in
+listings).  When COMMAND_OUTPUT_BUCKET is set, commands also write their
+full output under COMMAND_OUTPUT_PREFIX in that bucket, and
+CommandResult.lines streams it from S3 a chunk at a time whenever the
+inline copy was cut short, so handlers can parse it line by line without
+holding it all in memory.  Short output is read inline as before.
+COMMAND_OUTPUT_ENDPOINT points the S3 client at a local stand-in.
+"""
+
+class CommandTimeoutException(Exception): pass
+
+class CommandResult(object):
+    """Outcome of one command invocation on one instance."""
+
+    def __init__(self, command_id, instance_id, status, status_details='',
+                 stdout='', stderr='', polls=0, elapsed=0.0, queued=None, runtime=None,
+                 truncated=False, started=None):
+        self.command_id = command_id
+        self.instance_id = instance_id
+        self.status = status
+        self.status_details = status_details
+        self.stdout = stdout
+        self.stderr = stderr
+        self.polls = polls
+        self.elapsed = elapsed
+        self.queued = queued
+        self.runtime = runtime
+        self.truncated = truncated
+        # When the command started running on the instance, which a
+        # resumed command keeps across task retries
+        self.started = parse_time(started)
+
+    @property
+    def ok(self):
+        return self.status == 'Success'
+
+    def lines(self):
+        """
+        Yield the command's output one line at a time, streamed from S3
+        when the inline copy was truncated.  If the full output is not
+        available the inline lines are used, minus the cut-off last one.
+        """
+        body = open_output(self.command_id, self.instance_id) if self.truncated else None
+        if body is None:
+            inline = self.stdout.splitlines()
+            if self.truncated:
+                LOGGER.warn("Using truncated output of command {0} on {1}".format(self.command_id, self.instance_id))
+                inline = inline[:-1]
+            for line in inline:
+                yield line
+            return
+        try:
+            for line in iter_lines(body):
+                yield line
+        finally:
+            body.close()
+
+    def __repr__(self):
+        return "CommandResult({0}, {1}, {2}, polls={3}, elapsed={4:.2f}s)".format(
+            self.command_id, self.instance_id, self.status, self.polls, self.elapsed)
+
+# Request time of commands sent from this container, until they finish
+_requested = {}
+
+def parse_time(value):
+    """Run Command reports datetimes from List calls and ISO strings from Get calls."""
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+def epoch_millis(value):
+    value = parse_time(value)
+    if value is None:
+        return None
+    return int((value - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)).total_seconds() * 1000)
+
+def seconds_between(start, end):
+    start = parse_time(start)
+    end = parse_time(end)
+    if start is None or end is None:
+        return None
+    return max(0.0, (end - start).total_seconds())
+
+# S3 client for full command output, created on first use
+_s3 = {}
+
+def output_key(command_id, instance_id):
+    return "{0}/{1}/{2}/{3}".format(output_prefix, command_id, instance_id, OUTPUT_PLUGIN_PATH)
+
+def open_output(command_id, instance_id):
+    """Return the streaming body of a command's full output in S3, or None."""
+    if not output_bucket:
+        return None
+    try:
+        if 's3' not in _s3:
+            _s3['s3'] = aws_clients.client('s3', endpoint_url=output_endpoint or None)
+        response = _s3['s3'].get_object(Bucket=output_bucket, Key=output_key(command_id, instance_id))
+    except Exception as e:
+        LOGGER.warn("Could not read output of command {0} on {1} from S3: {2}".format(command_id, instance_id, str(e)))
+        return None
+    metrics.put('CommandOutputBytes', response.get('ContentLength', 0), 'Bytes')
+    return response['Body']
+
+def iter_lines(body, chunk_bytes=READ_CHUNK_BYTES):
+    """Decode a streaming body as UTF-8 and yield its lines without line endings."""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = ''
+    while True:
+        chunk = body.read(chunk_bytes)
+        pending += decoder.decode(chunk or b'', final=not chunk)
+        lines = pending.split('\n')
+        # Only the last piece can be an incomplete line
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+def json_lines(lines, marker):
+    """Yield the JSON documents printed after marker, one per line, ignoring shell noise."""
+    for line in lines:
+        line = line.strip()
+        if line.startswith(marker + '{'):
+            yield json.loads(line[len(marker):])
+
+def read_listing(lines, header_marker, item_marker):
+    """
+    Parse output printed as a header line holding a count, then one line
+    per item, and return (header, items).  Raises ValueError when items
+    are missing, so a cut-off listing is never taken for a short one.
+    """
+    header = None
+    items = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(header_marker + '{'):
+            header = json.loads(line[len(header_marker):])
+        elif line.startswith(item_marker + '{'):
+            items.append(json.loads(line[len(item_marker):]))
+    if header is None:
+        raise ValueError("No {0}line in command output".format(header_marker))
+    if len(items) != header['count']:
+        raise ValueError("Incomplete command output: {0} of {1} {2}lines".format(len(items), header['count'], item_marker))
+    return header, items
+
+def record_result(result):
+    metrics.put('CommandQueueWait', result.queued)
+    metrics.put('CommandExecution', result.runtime)
+
+def poll_delays(context=None, first_delay=FIRST_POLL_DELAY):
+    """
+    Yield the sleep before each status probe: a short first probe, then
+    jittered exponential backoff capped at MAX_POLL_DELAY.  Stops yielding
+    once the next sleep would run into the Lambda's time buffer.
+    """
+    delay = first_delay
+    attempt = 0
+    while True:
+        if context is not None:
+            remaining = (context.get_remaining_time_in_millis() - TIME_BUFFER_MS) / 1000.0
+            if remaining <= 0:
+                return
+            delay = min(delay, remaining)
+        yield delay
+        attempt += 1
+        delay = min(MAX_POLL_DELAY, BASE_POLL_DELAY * (2 ** (attempt - 1)))
+        delay = random.uniform(delay / 2, delay)
+
+def output_location():
+    if not output_bucket:
+        return {}
+    return {'OutputS3BucketName': output_bucket, 'OutputS3KeyPrefix': output_prefix}
+
+def send_command(ssm, instance_ids, commands, timeout_seconds=30):
+    response = ssm.send_command(
+        InstanceIds = instance_ids,
+        DocumentName = DOCNAME,
+        TimeoutSeconds = timeout_seconds,
+        Parameters = {
+            'commands': commands
+        },
+        **output_location()
+    )
+    command_id = response['Command']['CommandId']
+    _requested[command_id] = response['Command'].get('RequestedDateTime')
+    LOGGER.info("Doc command id: {0}".format(command_id))
+    return command_id
+
+def send_or_resume(ssm, instance_ids, commands, timeout_seconds=30, journal=None):
+    """
+    Send the command unless the journal shows this state already sent it.
+    Returns (command ID, whether it was resumed).
+    """
+    if journal is not None:
+        command_id = journal.lookup(instance_ids, commands)
+        if command_id is not None:
+            LOGGER.info("Resuming command {0} from an earlier attempt".format(command_id))
+            metrics.put('CommandsResumed', 1, 'Count')
+            return command_id, True
+    command_id = send_command(ssm, instance_ids, commands, timeout_seconds)
+    if journal is not None:
+        journal.record(instance_ids, commands, command_id)
+    return command_id, False
+
+def wait_for_command(ssm, command_id, instance_id, context=None, resumed=False):
+    """
+    Poll get_command_invocation until the invocation reaches a terminal
+    status and return a CommandResult.  InvocationDoesNotExist just means
+    the invocation has not been registered yet, so it counts as pending.
+    """
+    start = time.time()
+    polls = 0
+    for delay in poll_delays(context, 0 if resumed else FIRST_POLL_DELAY):
+        time.sleep(delay)
+        polls += 1
+        try:
+            response = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+        except ssm.exceptions.InvocationDoesNotExist:
+            LOGGER.info("Command {0} not yet registered on {1}".format(command_id, instance_id))
+            continue
+        status = response['Status']
+        if status in TERMINAL_STATUSES:
+            stdout = response.get('StandardOutputContent', '')
+            result = CommandResult(command_id, instance_id, status,
+                status_details=response.get('StatusDetails', ''),
+                stdout=stdout, truncated=len(stdout) >= GET_OUTPUT_LIMIT,
+                stderr=response.get('StandardErrorContent', ''),
+                polls=polls, elapsed=time.time() - start,
+                queued=seconds_between(_requested.pop(command_id, None), response.get('ExecutionStartDateTime')),
+                runtime=seconds_between(response.get('ExecutionStartDateTime'), response.get('ExecutionEndDateTime')),
+                started=response.get('ExecutionStartDateTime'))
+            LOGGER.info("Command finished: {0}".format(result))
+            record_result(result)
+            metrics.put('CommandPolls', polls, 'Count')
+            return result
+    _requested.pop(command_id, None)
+    metrics.put('CommandPolls', polls, 'Count')
+    raise CommandTimeoutException("Command {0} on {1} still running after {2} polls".format(
+        command_id, instance_id, polls))
+
+def list_invocations(ssm, command_id, instance_id=None):
+    """Page through list_command_invocations and return every invocation."""
+    invocations = []
+    kwargs = {'CommandId': command_id, 'Details': True}
+    if instance_id is not None:
+        kwargs['InstanceId'] = instance_id
+    while True:
+        response = ssm.list_command_invocations(**kwargs)
+        invocations.extend(response['CommandInvocations'])
+        if not response.get('NextToken'):
+            return invocations
+        kwargs['NextToken'] = response['NextToken']
+
+def invocation_result(invocation, polls, elapsed):
+    plugins = invocation.get('CommandPlugins') or [{}]
+    stdout = plugins[0].get('Output', '')
+    return CommandResult(invocation['CommandId'], invocation['InstanceId'], invocation['Status'],
+        status_details=invocation.get('StatusDetails', ''),
+        stdout=stdout, truncated=len(stdout) >= LIST_OUTPUT_LIMIT,
+        polls=polls, elapsed=elapsed,
+        queued=seconds_between(invocation.get('RequestedDateTime'), plugins[0].get('ResponseStartDateTime')),
+        runtime=seconds_between(plugins[0].get('ResponseStartDateTime'), plugins[0].get('ResponseFinishDateTime')),
+        started=plugins[0].get('ResponseStartDateTime'))
+
+def wait_for_command_all(ssm, command_id, instance_ids, context=None, resumed=False):
+    """
+    Wait for a command sent to many instances and return a dict of
+    instance ID -> CommandResult.  Each probe is one paginated
+    list_command_invocations call covering the whole fleet; once a node
+    reaches a terminal status it is no longer tracked, and when a single
+    node is left we filter the listing down to it.  Instances that are
+    still pending when time runs out are reported with their last status.
+    """
+    start = time.time()
+    polls = 0
+    pending = set(instance_ids)
+    last_status = dict((iid, 'Pending') for iid in instance_ids)
+    results = {}
+    for delay in poll_delays(context, 0 if resumed else FIRST_POLL_DELAY):
+        time.sleep(delay)
+        polls += 1
+        only = next(iter(pending)) if len(pending) == 1 else None
+        for invocation in list_invocations(ssm, command_id, only):
+            iid = invocation['InstanceId']
+            if iid not in pending:
+                continue
+            last_status[iid] = invocation['Status']
+            if invocation['Status'] in TERMINAL_STATUSES:
+                results[iid] = invocation_result(invocation, polls, time.time() - start)
+                record_result(results[iid])
+                pending.discard(iid)
+        LOGGER.info("Command {0}: {1} done, {2} pending after {3} polls".format(
+            command_id, len(results), len(pending), polls))
+        if not pending:
+            break
+    _requested.pop(command_id, None)
+    metrics.put('CommandPolls', polls, 'Count')
+    if not pending:
+        return results
+    for iid in pending:
+        results[iid] = CommandResult(command_id, iid, last_status[iid],
+            status_details='Still running when the poll budget ran out',
+            polls=polls, elapsed=time.time() - start)
+    return results
+
+def run_command(ssm, instance_id, commands, context=None, timeout_seconds=30, journal=None):
+    """Send a shell command to a single instance, or resume it, and wait for its result."""
+    command_id, resumed = send_or_resume(ssm, [instance_id], commands, timeout_seconds, journal)
+    return wait_for_command(ssm, command_id, instance_id, context, resumed)
@@ -39,96 +39,41 @@ parameters:
     type: String
     description: SQS URL
     default: ""
+  Hydrate:
+    type: String
+    description: Read every block of a snapshot-restored data volume ("true" or "false")
+    default: "false"
+  LifecycleHookName:
+    type: String
+    description: ASG lifecycle hook name, used by the completion handler
+    default: ""
+  AutoScalingGroupName:
+    type: String
+    description: ASG name, used by the completion handler
+    default: ""
+  LifecycleActionToken:
+    type: String
+    description: ASG lifecycle action token, used by the completion handler
+    default: ""
 mainSteps:
-- name: get_interfaces
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api: DescribeNetworkInterfaces
-    NetworkInterfaceIds: ["{{EniId}}"]
-  outputs:
-  - Name: isAttached
-    Selector: "$.NetworkInterfaces[0].Status"
-    Type: "String"
-- name: Check_if_ENI_attached
-  action: aws:branch
-  inputs:
-    Choices:
-    - NextStep: attachENI
-      Variable: "{{get_interfaces.isAttached}}"
-      StringEquals: "available"
-    Default:
-      get_data_volume_status
-- name: attachENI
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api:  AttachNetworkInterface
-    InstanceId: "{{InstanceId}}"
-    NetworkInterfaceId: "{{EniId}}"
-    DeviceIndex: 1
-- name: get_data_volume_status
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api: DescribeVolumes
-    VolumeIds: ["{{VolumeIdData}}"]
-  outputs:
-  - Name: volStatusData
-    Selector: "$.Volumes[0].State"
-    Type: "String"
-- name: Check_if_data_vol_attached
-  action: aws:branch
-  inputs:
-    Choices:
-    - NextStep: attachDataVol
-      Variable: "{{get_data_volume_status.volStatusData}}"
-      StringEquals: "available"
-    Default:
-      get_logs_volume_status
-- name: attachDataVol
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api:  AttachVolume
-    InstanceId: "{{InstanceId}}"
-    VolumeId: "{{VolumeIdData}}"
-    Device: /dev/xvdg
-- name: get_logs_volume_status
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api: DescribeVolumes
-    VolumeIds: ["{{VolumeIdLogs}}"]
+- name: attachResources
+  action: aws:executeScript
+  timeoutSeconds: 600
+  inputs:
+    Runtime: python3.8
+    Handler: attach_resources
+    InputPayload:
+      InstanceId: "{{InstanceId}}"
+      EniId: "{{EniId}}"
+      VolumeIdData: "{{VolumeIdData}}"
+      VolumeIdLogs: "{{VolumeIdLogs}}"
+    # attach_resources.py, JSON-encoded by Terraform
+    Script: ${AttachScript}
   outputs:
-  - Name: volStatusLogs
-    Selector: "$.Volumes[0].State"
-    Type: "String"
-- name: Check_if_logs_vol_attached
-  action: aws:branch
-  isEnd: true
-  inputs:
-    Choices:
-    - NextStep: attachLogsVol
-      Variable: "{{get_logs_volume_status.volStatusLogs}}"
-      StringEquals: "available"
-    Default:
-      updateSSMAgent
-- name: attachLogsVol
-  action: aws:executeAwsApi
-  inputs:
-    Service: ec2
-    Api:  AttachVolume
-    InstanceId: "{{InstanceId}}"
-    VolumeId: "{{VolumeIdLogs}}"
-    Device: /dev/xvdh
-- name: updateSSMAgent
-  action: aws:runCommand
-  inputs:
-    DocumentName: AWS-UpdateSSMAgent
-    InstanceIds:
-    - "{{InstanceId}}"
-- name: installCollectd
+  - Name: AttachSeconds
+    Selector: "$.Payload.AttachSeconds"
+    Type: "Integer"
+- name: hydrateDataVolume
   action: aws:runCommand
   inputs:
     DocumentName: AWS-RunShellScript
@@ -136,29 +81,28 @@ mainSteps:
     - "{{InstanceId}}"
     Parameters:
         commands: 
-        - yum install -y collectd
-- name: installCWAgent
-  action: aws:runCommand
-  inputs:
-    DocumentName: AWS-ConfigureAWSPackage
-    InstanceIds:
-    - "{{InstanceId}}"
-    Parameters:
-        action: Install 
-        name:  AmazonCloudWatchAgent
-- name: startCWAgent
+        # EBS restores blocks from S3 lazily; read the whole device in 1GiB
+        # chunks, 8 at a time, in the background.  Each finished chunk is
+        # appended to a file so check_node_status_fn can report progress.
+        # A prewarm cut short (reboot, OOM kill) resumes with the chunks
+        # not read yet.
+        - if [ "{{Hydrate}}" != "true" ] || pgrep -f 'of=/dev/null bs=1M skip=' > /dev/null; then exit 0; fi
+        # NVMe device names follow attach order, so find the volume by ID
+        - export DEV=/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_$(echo "{{VolumeIdData}}" | tr -d -)
+        - for i in $(seq 30); do [ -e $DEV ] && break; sleep 1; done
+        - mkdir -p /var/lib/mongo-hydration
+        - touch /var/lib/mongo-hydration/done
+        - if [ ! -f /var/lib/mongo-hydration/total ]; then echo $(( ($(blockdev --getsize64 $DEV) / 1048576 + 1023) / 1024 )) > /var/lib/mongo-hydration/total; fi
+        - CHUNKS=$(cat /var/lib/mongo-hydration/total)
+        - if [ $(wc -l < /var/lib/mongo-hydration/done) -ge $CHUNKS ]; then exit 0; fi
+        - seq 0 $((CHUNKS - 1)) | grep -vxF -f /var/lib/mongo-hydration/done | nohup xargs -P 8 -I{} sh -c 'dd if=$DEV of=/dev/null bs=1M skip=$(({} * 1024)) count=1024 iflag=direct 2>/dev/null; echo {} >> /var/lib/mongo-hydration/done' > /dev/null 2>&1 &
+- name: updateSSMAgent
   action: aws:runCommand
   inputs:
-    DocumentName: AmazonCloudWatch-ManageAgent
+    DocumentName: AWS-UpdateSSMAgent
     InstanceIds:
     - "{{InstanceId}}"
-    Parameters:
-        action: "configure"
-        mode:  "ec2"
-        optionalConfigurationSource: "ssm"
-        optionalConfigurationLocation: "AmazonCloudWatch-mongo"
-        optionalRestart: "yes"
-- name: installPip
+- name: installAgents
   action: aws:runCommand
   inputs:
     DocumentName: AWS-RunShellScript
@@ -166,7 +110,12 @@ mainSteps:
     - "{{InstanceId}}"
     Parameters:
         commands: 
-        - pip install ansible boto3 botocore
+        - (rpm -q collectd amazon-cloudwatch-agent || yum install -y collectd https://s3.amazonaws.com/amazoncloudwatch-agent/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm) && /opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl -a fetch-config -m ec2 -c ssm:AmazonCloudWatch-mongo -s &
+        - AGENTS=$!
+        - (python -c "import ansible, boto3, botocore" || pip install ansible boto3 botocore) &
+        - PIP=$!
+        - wait $AGENTS || exit 1
+        - wait $PIP || exit 1
 - name: runPlaybook
   action: aws:runCommand
   inputs:
@@ -175,7 +124,7 @@ mainSteps:
     - "{{InstanceId}}"
     Parameters:
       playbookurl: "${PlaybookUrl}"
-      extravars: "Project={{Project}} Role={{Role}} Environment={{Environment}} ID={{ID}}"
+      extravars: "Project={{Project}} Role={{Role}} Environment={{Environment}} ID={{ID}} MongoRepoUrl=${MongoRepoUrl} VolumeIdData={{VolumeIdData}} VolumeIdLogs={{VolumeIdLogs}}"
 - name: notifySqs
   action: aws:executeAwsApi
   inputs:
@@ -0,0 +1,127 @@
+---
+description: Bring a MongoDB replica set server out of the ASG warm pool.
+schemaVersion: "0.3"
+assumeRole: "${SSMRoleArn}"
+parameters:
+  EniId:
+    type: String
+    description: ENI ID
+    default: ""
+  VolumeIdData:
+    type: String
+    description: Volume ID for data
+    default: ""
+  VolumeIdLogs:
+    type: String
+    description: Volume ID for logs
+    default: ""
+  InstanceId:
+    type: String
+    description: EC2 instance ID
+    default: ""
+  Project:
+    type: String
+    description: Project
+    default: ""
+  Environment:
+    type: String
+    description: Environment
+    default: ""
+  Role:
+    type: String
+    description: Role
+    default: ""
+  ID:
+    type: String
+    description: ID
+    default: ""
+  QueueUrl:
+    type: String
+    description: SQS URL
+    default: ""
+  Hydrate:
+    type: String
+    description: Read every block of a snapshot-restored data volume ("true" or "false")
+    default: "false"
+  LifecycleHookName:
+    type: String
+    description: ASG lifecycle hook name, used by the completion handler
+    default: ""
+  AutoScalingGroupName:
+    type: String
+    description: ASG name, used by the completion handler
+    default: ""
+  LifecycleActionToken:
+    type: String
+    description: ASG lifecycle action token, used by the completion handler
+    default: ""
+mainSteps:
+- name: attachResources
+  action: aws:executeScript
+  timeoutSeconds: 600
+  inputs:
+    Runtime: python3.8
+    Handler: attach_resources
+    InputPayload:
+      InstanceId: "{{InstanceId}}"
+      EniId: "{{EniId}}"
+      VolumeIdData: "{{VolumeIdData}}"
+      VolumeIdLogs: "{{VolumeIdLogs}}"
+    # attach_resources.py, JSON-encoded by Terraform
+    Script: ${AttachScript}
+  outputs:
+  - Name: AttachSeconds
+    Selector: "$.Payload.AttachSeconds"
+    Type: "Integer"
+- name: hydrateDataVolume
+  action: aws:runCommand
+  inputs:
+    DocumentName: AWS-RunShellScript
+    InstanceIds:
+    - "{{InstanceId}}"
+    Parameters:
+        commands: 
+        # EBS restores blocks from S3 lazily; read the whole device in 1GiB
+        # chunks, 8 at a time, in the background.  Each finished chunk is
+        # appended to a file so check_node_status_fn can report progress.
+        # A prewarm cut short (reboot, OOM kill) resumes with the chunks
+        # not read yet.
+        - if [ "{{Hydrate}}" != "true" ] || pgrep -f 'of=/dev/null bs=1M skip=' > /dev/null; then exit 0; fi
+        # NVMe device names follow attach order, so find the volume by ID
+        - export DEV=/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_$(echo "{{VolumeIdData}}" | tr -d -)
+        - for i in $(seq 30); do [ -e $DEV ] && break; sleep 1; done
+        - mkdir -p /var/lib/mongo-hydration
+        - touch /var/lib/mongo-hydration/done
+        - if [ ! -f /var/lib/mongo-hydration/total ]; then echo $(( ($(blockdev --getsize64 $DEV) / 1048576 + 1023) / 1024 )) > /var/lib/mongo-hydration/total; fi
+        - CHUNKS=$(cat /var/lib/mongo-hydration/total)
+        - if [ $(wc -l < /var/lib/mongo-hydration/done) -ge $CHUNKS ]; then exit 0; fi
+        - seq 0 $((CHUNKS - 1)) | grep -vxF -f /var/lib/mongo-hydration/done | nohup xargs -P 8 -I{} sh -c 'dd if=$DEV of=/dev/null bs=1M skip=$(({} * 1024)) count=1024 iflag=direct 2>/dev/null; echo {} >> /var/lib/mongo-hydration/done' > /dev/null 2>&1 &
+- name: runPlaybook
+  action: aws:runCommand
+  inputs:
+    DocumentName: AWS-RunAnsiblePlaybook
+    InstanceIds:
+    - "{{InstanceId}}"
+    Parameters:
+      playbookurl: "${PlaybookUrl}"
+      extravars: "Project={{Project}} Role={{Role}} Environment={{Environment}} ID={{ID}} MongoRepoUrl=${MongoRepoUrl} VolumeIdData={{VolumeIdData}} VolumeIdLogs={{VolumeIdLogs}} Stage=resume"
+- name: notifySqs
+  action: aws:executeAwsApi
+  inputs:
+    Service: sqs
+    Api: SendMessage
+    QueueUrl: "{{QueueUrl}}"
+    MessageBody: "Ready"
+    MessageAttributes:
+      Project:
+        DataType: String
+        StringValue: "{{Project}}"
+      Environment:
+        DataType: String
+        StringValue: "{{Environment}}"
+      Role:
+        DataType: String
+        StringValue: "{{Role}}"
+      ID:
+        DataType: String
+        StringValue: "{{ID}}"
\ No newline at end of file
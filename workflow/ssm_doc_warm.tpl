@@ -0,0 +1,67 @@
+---
+description: Prepare a MongoDB replica set server for the ASG warm pool.
+schemaVersion: "0.3"
+assumeRole: "${SSMRoleArn}"
+parameters:
+  InstanceId:
+    type: String
+    description: EC2 instance ID
+    default: ""
+  Project:
+    type: String
+    description: Project
+    default: ""
+  Environment:
+    type: String
+    description: Environment
+    default: ""
+  Role:
+    type: String
+    description: Role
+    default: ""
+  ID:
+    type: String
+    description: ID
+    default: ""
+  LifecycleHookName:
+    type: String
+    description: ASG lifecycle hook name, used by the completion handler
+    default: ""
+  AutoScalingGroupName:
+    type: String
+    description: ASG name, used by the completion handler
+    default: ""
+  LifecycleActionToken:
+    type: String
+    description: ASG lifecycle action token, used by the completion handler
+    default: ""
+mainSteps:
+- name: updateSSMAgent
+  action: aws:runCommand
+  inputs:
+    DocumentName: AWS-UpdateSSMAgent
+    InstanceIds:
+    - "{{InstanceId}}"
+- name: installAgents
+  action: aws:runCommand
+  inputs:
+    DocumentName: AWS-RunShellScript
+    InstanceIds:
+    - "{{InstanceId}}"
+    Parameters:
+        commands: 
+        - (rpm -q collectd amazon-cloudwatch-agent || yum install -y collectd https://s3.amazonaws.com/amazoncloudwatch-agent/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm) && /opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl -a fetch-config -m ec2 -c ssm:AmazonCloudWatch-mongo -s &
+        - AGENTS=$!
+        - (python -c "import ansible, boto3, botocore" || pip install ansible boto3 botocore) &
+        - PIP=$!
+        - wait $AGENTS || exit 1
+        - wait $PIP || exit 1
+- name: runPlaybook
+  action: aws:runCommand
+  inputs:
+    DocumentName: AWS-RunAnsiblePlaybook
+    InstanceIds:
+    - "{{InstanceId}}"
+    Parameters:
+      playbookurl: "${PlaybookUrl}"
+      extravars: "Project={{Project}} Role={{Role}} Environment={{Environment}} ID={{ID}} MongoRepoUrl=${MongoRepoUrl} Stage=warm"
\ No newline at end of file
@@ -0,0 +1,287 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import aws_clients
+import json
+import logging
+import traceback
+import metrics
+import os
+import param_cache
+import snapshot_index
+import ssm_command
+import time
+
+# Create AWS clients
+asg = aws_clients.client('autoscaling')
+ssm = aws_clients.client('ssm')
+ec2 = aws_clients.client('ec2')
+
+# Constants
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+TEST = 'test'
+TEST_NOTIFICATION = 'autoscaling:TEST_NOTIFICATION'
+WARM_POOL = 'WarmPool'
+MONGO_PORT = '27017'
+RESULT_MARKER = 'RSREMOVE '
+CATCH_UP_SECS = 10 # secondaryCatchUpPeriodSecs for the step down
+MAX_SURVIVORS_TRIED = 3
+SNAPSHOT_STATES = ['PRIMARY', 'SECONDARY']
+
+# Env variables
+stepdown_secs = int(os.environ.get('STEPDOWN_SECS', '60'))
+election_timeout_secs = int(os.environ.get('ELECTION_TIMEOUT_SECS', '30'))
+
+"""
+Handles the termination lifecycle hook of the replica set's Auto Scaling
+groups, so a departing node leaves the replica set instead of lingering in
+its configuration as an unreachable member.
+
+Event is the SNS notification for EC2_INSTANCE_TERMINATING; the message
+carries the same notification metadata as the launch hook:
+
+{
+  "LifecycleHookName": "rs_instance_terminate",
+  "AutoScalingGroupName": "rsmember-asg-...",
+  "LifecycleActionToken": "...",
+  "EC2InstanceId": "i-0123456789abcdef0",
+  "LifecycleTransition": "autoscaling:EC2_INSTANCE_TERMINATING",
+  "NotificationMetadata": "{ \"role\": \"rsmember\", \"id\": \"2\", \"project\": ..., \"environment\": ... }"
+}
+
+The function runs one mongo shell script on a surviving member that
+notes the node's state, steps the node down if it is primary, waits for a
+new primary and removes the node in a single reconfig.
+
+If the node is the snapshot index's source member (see snapshot_index.py)
+and was a healthy PRIMARY or SECONDARY until it was removed, the function
+then starts an EBS snapshot of its data volume, tagged like the DLM
+snapshots so that snapshot_index_fn records it once it completes.  The
+snapshot's point in time is fixed when create_snapshot returns, and by
+default the journal lives on the same volume, so the node can go away
+while the snapshot is still pending.  When the tuning profile moves the
+journal to the logs volume (journal_on_logs), a data volume snapshot alone
+is not consistent and none is taken.  Other members are not snapshotted,
+as nothing would restore from their snapshots.
+
+It then drops the node's instance ID from the inventory and completes the
+lifecycle action, so scale-in takes seconds rather than the hook's
+heartbeat timeout.  Instances terminated straight from an ASG warm pool
+("Origin": "WarmPool") were never members and are let go at once.
+
+On failure, for instance when the reconfig collides with one from the
+cluster workflow, the lifecycle action is left open and the invocation
+fails, so Lambda's asynchronous retries run within the hook's heartbeat.
+The hook's default result only applies once those are used up.
+"""
+
+def complete_lifecycle(hookname, asgname, token, result):
+    if token == TEST:
+        return
+    LOGGER.info("Sending lifecycle {0} hook".format(result))
+    asg.complete_lifecycle_action(
+        LifecycleHookName=hookname,
+        AutoScalingGroupName=asgname,
+        LifecycleActionToken=token,
+        LifecycleActionResult=result
+    )
+
+def param_name(metadata, kind):
+    return "/{0}/{1}/{2}/{3}/{4}".format(metadata['project'], metadata['environment'], metadata['role'], kind, metadata['id'])
+
+def role_prefix(metadata):
+    return "/{0}/{1}/{2}".format(metadata['project'], metadata['environment'], metadata['role'])
+
+def journal_on_logs(value):
+    """Read journal_on_logs from the JSON tuning profile; missing means the default, false."""
+    if not value:
+        return False
+    return str(json.loads(value).get('journal_on_logs', 'false')).lower() == 'true'
+
+def build_remove_script(host):
+    """
+    Note host's state, step it down if it is primary, wait for another
+    primary and remove host from the configuration in one reconfig, from a
+    surviving member.  Prints one RSREMOVE result line.
+    """
+    return ('var host = ' + json.dumps(host) + '; '
+        'var out = { ok: 0, errmsg: "", primary: "", state: "", stepped_down: false, removed: false }; '
+        'function primary() { return db.isMaster().primary || ""; } '
+        'var departing = (rs.status().members || []).filter(function(m) { return m.name == host; })[0]; '
+        'if (departing && departing.health == 1) { out.state = departing.stateStr; } '
+        'var p = primary(); '
+        'if (p == host) { out.stepped_down = true; '
+        'try { new Mongo(host).getDB("admin").runCommand({ replSetStepDown: ' + str(stepdown_secs) + ', '
+        'secondaryCatchUpPeriodSecs: ' + str(CATCH_UP_SECS) + ' }); } catch (e) { } } '
+        'var deadline = Date.now() + ' + str(election_timeout_secs * 1000) + '; '
+        'while ((p == "" || p == host) && Date.now() < deadline) { sleep(1000); p = primary(); } '
+        'out.primary = p; '
+        'if (p == "" || p == host) { out.errmsg = "no primary other than " + host; } else { '
+        'var admin = new Mongo(p).getDB("admin"); var c = admin.runCommand({ replSetGetConfig: 1 }).config; '
+        'var members = c.members.filter(function(m) { return m.host != host; }); '
+        'if (members.length == c.members.length) { out.ok = 1; } else { '
+        'c.members = members; c.version++; var r = admin.runCommand({ replSetReconfig: c }); '
+        'out.ok = r.ok; out.errmsg = r.errmsg || ""; out.removed = r.ok == 1; } } '
+        'print("' + RESULT_MARKER + '" + JSON.stringify(out));')
+
+def surviving_instances(metadata, instanceid):
+    """Instance IDs of the other members in the inventory, in member order."""
+    ids = {}
+    kwargs = {'Path': role_prefix(metadata) + "/instanceid/", 'Recursive': True}
+    while True:
+        response = ssm.get_parameters_by_path(**kwargs)
+        for param in response['Parameters']:
+            ids[param['Name'].rsplit('/', 1)[1]] = param['Value']
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    order = sorted(ids, key=lambda idx: (0, int(idx), idx) if idx.isdigit() else (1, 0, idx))
+    return [ids[idx] for idx in order if ids[idx] != instanceid]
+
+def remove_member(metadata, instanceid, host, context):
+    """
+    Run the removal from the first surviving member that answers.  Other
+    members may be terminating too, so a few are tried in turn.
+    """
+    survivors = surviving_instances(metadata, instanceid)
+    if not survivors:
+        LOGGER.info("No other members, nothing to remove {0} from".format(host))
+        return {'ok': 1, 'errmsg': '', 'primary': '', 'state': '', 'stepped_down': False, 'removed': False}
+    script = build_remove_script(host)
+    outcome = {'ok': 0, 'errmsg': 'no surviving member answered'}
+    for iid in survivors[:MAX_SURVIVORS_TRIED]:
+        result = ssm_command.run_command(ssm, iid, ["mongo --quiet --eval '{0}'".format(script)], context)
+        if not result.ok:
+            LOGGER.warn("Removal from {0} failed: {1}".format(iid, result.status_details))
+            continue
+        outcomes = list(ssm_command.json_lines(result.lines(), RESULT_MARKER))
+        if not outcomes:
+            LOGGER.warn("No removal result from {0}".format(iid))
+            continue
+        outcome = outcomes[-1]
+        if outcome['ok'] == 1:
+            break
+        LOGGER.warn("Removal from {0} failed: {1}".format(iid, outcome['errmsg']))
+    return outcome
+
+def snapshot_data_volume(metadata, volumeid):
+    with metrics.timer('SnapshotStart'):
+        response = ec2.create_snapshot(
+            VolumeId=volumeid,
+            Description="Data volume of terminated member {0}".format(metadata['id']),
+            TagSpecifications=[
+                {
+                    'ResourceType': 'snapshot',
+                    'Tags': [
+                        {
+                            'Key': 'Name',
+                            'Value': snapshot_index.source_name(metadata['role'])
+                        },
+                        {
+                            'Key': 'Project',
+                            'Value': metadata['project']
+                        },
+                        {
+                            'Key': 'Environment',
+                            'Value': metadata['environment']
+                        },
+                        {
+                            'Key': 'SnapshotCreator',
+                            'Value': 'TerminationHook'
+                        }
+                    ]
+                },
+            ],
+            DryRun=False
+        )
+    LOGGER.info("Started snapshot {0} of data volume {1}".format(response['SnapshotId'], volumeid))
+    return response['SnapshotId']
+
+def deregister_instance(metadata, instanceid):
+    """
+    Drop the node's instance ID from the inventory, unless a replacement
+    has registered already, and bump the inventory version.
+    """
+    name = param_name(metadata, 'instanceid')
+    try:
+        current = ssm.get_parameter(Name=name)['Parameter']['Value']
+    except ssm.exceptions.ParameterNotFound:
+        return
+    if current != instanceid:
+        LOGGER.info("Member {0} already registered as {1}".format(metadata['id'], current))
+        return
+    ssm.delete_parameter(Name=name)
+    param_cache.invalidate(name)
+    param_cache.bump_version(ssm, role_prefix(metadata), "{0}:{1}".format(instanceid, int(time.time() * 1000)))
+
+def elapsed(start):
+    return round(time.time() - start, 3)
+
+def handler(event, context):
+
+    try:
+        metrics.begin(context)
+        metrics.log_event("SNS metadata", event)
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        if message.get('Event') == TEST_NOTIFICATION:
+            LOGGER.info("Ignoring test notification")
+            return
+        instanceid = message['EC2InstanceId']
+        metadata = json.loads(message['NotificationMetadata'])
+        hookname = message['LifecycleHookName']
+        asgname = message['AutoScalingGroupName']
+        token = message['LifecycleActionToken']
+
+        LOGGER.info("instance-id: %s" % instanceid)
+        LOGGER.info("metadata: %s" % json.dumps(metadata))
+        metrics.set_dimensions(metadata['project'], metadata['environment'], metadata['role'])
+        if message.get('Origin') == WARM_POOL:
+            # Never in service: no replica set membership and no volumes
+            LOGGER.info("Instance is leaving the warm pool, nothing to remove")
+            complete_lifecycle(hookname, asgname, token, 'CONTINUE')
+            return
+        start = time.time()
+
+        # A launch may have created the data volume since we last looked
+        tuning_name = role_prefix(metadata) + "/tuning"
+        values = param_cache.get_parameters(ssm, [param_name(metadata, 'dns'), param_name(metadata, 'datavol'), tuning_name],
+            recheck_missing=[param_name(metadata, 'datavol')])
+        dnsname = values.get(param_name(metadata, 'dns'))
+        if dnsname is None:
+            raise Exception("Parameter not found: {0}".format(param_name(metadata, 'dns')))
+        host = dnsname + ':' + MONGO_PORT
+        datavolid = values.get(param_name(metadata, 'datavol'))
+
+        with metrics.timer('MemberRemoval'):
+            outcome = remove_member(metadata, instanceid, host, context)
+        if outcome['ok'] != 1:
+            LOGGER.error("Member {0} left in the replica set configuration".format(host))
+            raise Exception("Failed removing {0} from the replica set: {1}".format(host, outcome['errmsg']))
+        LOGGER.info("Member {0} removed: {1}, state: {2}, stepped down: {3}, primary: {4}".format(
+            host, outcome.get('removed'), outcome.get('state'), outcome.get('stepped_down'), outcome.get('primary')))
+
+        if metadata['id'] != str(snapshot_index.SOURCE_MEMBER):
+            LOGGER.info("Member {0} is not the snapshot source, not snapshotting it".format(metadata['id']))
+        elif outcome.get('state') not in SNAPSHOT_STATES:
+            LOGGER.warn("Member {0} was not healthy ({1}), not snapshotting it".format(metadata['id'], outcome.get('state')))
+        elif journal_on_logs(values.get(tuning_name)):
+            LOGGER.warn("Journal is on the logs volume, not snapshotting data volume {0}".format(datavolid))
+        elif datavolid:
+            snapshot_data_volume(metadata, datavolid)
+        else:
+            LOGGER.warn("No data volume recorded for member {0}".format(metadata['id']))
+        deregister_instance(metadata, instanceid)
+
+        metrics.put('ScaleIn', elapsed(start))
+        complete_lifecycle(hookname, asgname, token, 'CONTINUE')
+    except Exception as e:
+        trc = traceback.format_exc()
+        LOGGER.error("Failed processing termination hook {0}: {1}\n\n{2}".format(json.dumps(event), str(e), trc))
+        # ABANDON would terminate the instance all the same; fail the
+        # invocation instead so Lambda retries it within the heartbeat
+        raise e
+    finally:
+        param_cache.log_stats()
+        aws_clients.log_stats()
+        metrics.flush()
@@ -10,3 +10,89 @@ variable "BucketName" { }
 variable "data_vol_iops" {
   default = "1000"
 }
+variable "max_lag_secs" {
+  default = "30"
+}
+variable "lifecycle_wait_mode" {
+  default = "async"
+}
+variable "workflow_batch_size" {
+  default = "10"
+}
+variable "workflow_batch_window" {
+  default = "20"
+}
+variable "expected_workflow_secs" {
+  default = "60"
+}
+variable "mongo_repo_url" {
+  description = "Yum repo for mongodb-org; point at a local mirror or package cache to speed up launches"
+  default = "https://repo.mongodb.org/yum/amazon/2013.03/mongodb-org/4.0/x86_64/"
+}
+variable "hydrate_data_volumes" {
+  description = "Prewarm data volumes restored from snapshots before adding the member"
+  default = "true"
+}
+variable "hydration_threshold" {
+  description = "Percent of a restored data volume that must be read before the member is added"
+  default = "90"
+}
+variable "hydration_poll_secs" {
+  default = "60"
+}
+variable "hydration_timeout_secs" {
+  description = "How long the workflow waits for restored data volumes to be prewarmed before adding them anyway"
+  default = "7200"
+}
+variable "cache_ttl_secs" {
+  description = "How long warm Lambda containers may reuse SSM parameter values"
+  default = "300"
+}
+variable "client_rate_limits" {
+  description = "JSON map of AWS API family (e.g. ssm:Get) to client-side calls per second per Lambda container"
+  default = "{}"
+}
+variable "metrics_namespace" {
+  description = "CloudWatch namespace for the embedded metrics the Lambda functions emit"
+  default = "MongoDBLifecycle"
+}
+variable "event_log_sample" {
+  description = "Fraction of invocations that log their full input event; the rest log a truncated copy"
+  default = "0.01"
+}
+variable "sync_poll_secs" {
+  description = "Seconds between initial sync checks of newly added members"
+  default = "60"
+}
+variable "promote_max_lag_secs" {
+  description = "Replication lag below which a new member is given its vote and priority"
+  default = "10"
+}
+variable "member_priority" {
+  description = "Priority given to new members once they have caught up"
+  default = "1"
+}
+variable "sync_timeout_secs" {
+  description = "How long the workflow waits for new members to finish initial sync"
+  default = "3600"
+}
+variable "task_retry_attempts" {
+  description = "Retries of a failed workflow task; a retry resumes the Run Command its first attempt sent"
+  default = "2"
+}
+variable "command_output_prefix" {
+  description = "Key prefix in the template bucket for the full output of Run Commands"
+  default = "command-output"
+}
+variable "command_output_retention_days" {
+  description = "Days to keep Run Command output in the template bucket"
+  default = "7"
+}
+variable "stepdown_secs" {
+  description = "How long a terminating primary steps down for, so it is not re-elected before it is removed"
+  default = "60"
+}
+variable "election_timeout_secs" {
+  description = "How long the termination hook waits for a new primary after stepping one down"
+  default = "30"
+}